@@ -1,4 +1,9 @@
+from ipcbroker.asyncclient import AsyncClient
 from ipcbroker.broker import Broker
 from ipcbroker.client import Client
+from ipcbroker.message import Priority
+from ipcbroker.tracing import Tracer
+from ipcbroker.transport import RemoteBroker
 
-__all__ = ["Broker", "Client"]
+__all__ = ["AsyncClient", "Broker", "Client", "Priority", "RemoteBroker",
+           "Tracer"]
@@ -0,0 +1,445 @@
+import asyncio
+import inspect
+import logging
+from functools import partial
+from itertools import count
+
+from ipcbroker.broker import Broker
+from ipcbroker.cache import check_cache
+from ipcbroker.client import CallProxy
+from ipcbroker.message import Flag
+from ipcbroker.message import Message
+from ipcbroker.message import Priority
+from ipcbroker.sharedmem import SharedPayload
+from ipcbroker.sharedmem import discard
+from ipcbroker.sharedmem import get_pool
+from ipcbroker.transport import RemoteBroker
+
+
+class AsyncClient:
+    """
+    Client for asyncio applications
+
+    The connection to the broker is read by the event loop, there is no
+    worker thread. ``await client.add(1, 2)`` calls a remote method, any
+    number of calls can be in flight at the same time. Registered
+    coroutine functions run as tasks on the loop, plain functions are
+    called on the loop and should return quickly.
+
+    All methods have to be called from the thread running the loop.
+    """
+    # messages read per readable event, the rest waits for the next one
+    MAX_BATCH = 64
+
+    def __init__(self,
+                 broker: Broker,
+                 shared_memory_threshold=None,
+                 timeout=None):
+        """
+        :param broker: the broker to connect to, a Broker or a
+                       RemoteBroker listening on a socket
+        :param shared_memory_threshold: buffers of at least this many
+                                        bytes in arguments and return
+                                        values are passed in shared memory
+        :param timeout: default timeout of remote calls in seconds, None
+                        to wait for ever
+        """
+        if not isinstance(broker, (Broker, RemoteBroker)):
+            raise TypeError('broker is not a Broker: {}'.format(type(broker)))
+
+        self.__broker_con = broker.register_client()
+        self.__connected = True
+        self.__loop = None
+        self.__com_ids = count()
+        self.__registered_funcs = dict()
+        # com_id -> future of requests waiting for their return message
+        self.__pending = dict()
+        # com_id -> task of a running coroutine function
+        self.__tasks = dict()
+        self.__shared_memory_threshold = shared_memory_threshold
+        self.__timeout = timeout
+
+        self.__logger = logging.getLogger(__name__)
+
+    def __getattr__(self, item):
+        # special names are looked up by asyncio, e.g. __await__
+        if item.startswith('__'):
+            raise AttributeError(item)
+        return partial(self.call, item)
+
+    @property
+    def client_id(self):
+        """
+        Id the broker assigned to this client
+        """
+        return self.__broker_con.client_id
+
+    @property
+    def notify(self):
+        """
+        Proxy for one-way calls
+
+        ``client.notify.log('text')`` sends the call without waiting for
+        it and without a return message.
+        """
+        return CallProxy(self.__notify)
+
+    def start(self):
+        """
+        Read the connection on the running event loop
+        """
+        if self.__loop is not None:
+            raise Exception('Client already started')
+        self.__loop = asyncio.get_running_loop()
+        self.__loop.add_reader(self.__broker_con.fileno(), self.__read)
+        return self
+
+    def stop(self):
+        """
+        Stop reading the connection, calls waiting for an answer and
+        running coroutine functions are cancelled
+        """
+        if self.__loop is None:
+            raise Exception('Client is not started')
+        if self.__connected:
+            self.__loop.remove_reader(self.__broker_con.fileno())
+        self.__loop = None
+        for future in self.__pending.values():
+            future.cancel()
+        self.__pending.clear()
+        for task in list(self.__tasks.values()):
+            task.cancel()
+        return self
+
+    def close(self):
+        """
+        Disconnect from the broker, it forgets the functions of the
+        client
+
+        The client has to be stopped before.
+        """
+        if self.__connected:
+            self.__send(Message('close', None, self.__next_com_id()))
+            self.__connected = False
+        self.__broker_con.close()
+
+    async def call(self, name, *args, timeout=None, priority=None, **kwargs):
+        """
+        Call a method
+
+        The timeout travels with the request like with Client.call().
+        Cancelling the awaiting task cancels the call at the broker.
+
+        :param name: name of the method
+        :param timeout: seconds to wait, defaults to the timeout of the
+                        client
+        :param priority: Priority of the call at the broker, defaults to
+                         the priority of the function
+        :return: the return value
+        """
+        if name in self.__registered_funcs:
+            result = self.__registered_funcs[name](*args, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        if timeout is None:
+            timeout = self.__timeout
+
+        message = self.__message(name,
+                                 {'args': args,
+                                  'kwargs': kwargs},
+                                 self.__next_com_id(),
+                                 timeout=timeout,
+                                 priority=priority)
+        return await self.__request(message, timeout)
+
+    async def register_function(self,
+                                name,
+                                callback,
+                                cacheable=False,
+                                ttl=None,
+                                max_entries=128,
+                                priority=None,
+                                coalesce=False):
+        """
+        Register a function at the broker
+
+        :param name: name of the function
+        :param callback: a coroutine function, or a function that is
+                         called on the loop
+        :param cacheable: the function is pure, the broker may answer
+                          repeated calls from its cache
+        :param ttl: seconds a cached result stays valid, None for ever
+        :param max_entries: maximum number of cached results
+        :param priority: Priority of calls that do not have one
+        :param coalesce: identical calls in flight share one call of the
+                         function, see Client.register_function()
+        :return: True if the function was registered
+        """
+        if name in self.__registered_funcs:
+            raise KeyError('Function already locally registered')
+        if not callable(callback):
+            raise TypeError('Callback is not callable')
+
+        options = {'name': name}
+        if priority is not None:
+            options['priority'] = int(Priority(priority))
+        if coalesce:
+            options['coalesce'] = True
+        if cacheable:
+            check_cache(ttl, max_entries)
+            options['cache'] = {'ttl': ttl,
+                                'max_entries': max_entries}
+
+        # register locally first, calls may arrive right after the
+        # broker accepted the function
+        self.__registered_funcs[name] = callback
+        try:
+            return_value = await self.__request(
+                Message('register_function', options, self.__next_com_id()))
+        except KeyError:
+            return_value = None
+        if return_value == 'OK':
+            return True
+        del self.__registered_funcs[name]
+        return False
+
+    def __notify(self, name, *args, **kwargs):
+        if name in self.__registered_funcs:
+            result = self.__registered_funcs[name](*args, **kwargs)
+            if inspect.isawaitable(result):
+                asyncio.ensure_future(result)
+            return
+        self.__send(self.__message(name,
+                                   {'args': args,
+                                    'kwargs': kwargs},
+                                   self.__next_com_id(),
+                                   Flag.NO_REPLY))
+
+    async def __request(self, message: Message, timeout=None):
+        """
+        Send a request and wait for its return message
+
+        :param message: the request
+        :param timeout: seconds to wait, None to wait for ever
+        :return: the payload of the return message
+        """
+        if self.__loop is None:
+            raise Exception('Client is not started')
+        future = self.__loop.create_future()
+        # register before sending, the answer may arrive immediately
+        self.__pending[message.com_id] = future
+        try:
+            self.__send(message)
+            if timeout is None:
+                return await future
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('Call timed out') from None
+        finally:
+            if self.__pending.pop(message.com_id, None) is not None:
+                # not answered, the broker can forget the request
+                self.__cancel(message.com_id)
+
+    def __cancel(self, com_id):
+        if not self.__connected:
+            return
+        try:
+            self.__send(Message('cancel', None, com_id))
+        except (EOFError, OSError):
+            pass
+
+    def __next_com_id(self):
+        # unique per broker: the client id followed by a counter
+        return ((self.__broker_con.client_id << 32) |
+                (next(self.__com_ids) & 0xffffffff))
+
+    def __message(self,
+                  action,
+                  payload,
+                  com_id,
+                  flags=Flag.NONE,
+                  timeout=None,
+                  priority=None):
+        """
+        Create a message, large buffers of the payload are moved to
+        shared memory if enabled
+
+        :return: the message
+        """
+        if self.__shared_memory_threshold is None:
+            return Message(action, payload, com_id, flags, timeout, priority)
+        raw, shared = get_pool().dumps(payload,
+                                       self.__shared_memory_threshold)
+        if shared:
+            flags |= Flag.SHARED_MEMORY
+        return Message.from_raw(action,
+                                raw,
+                                com_id,
+                                flags,
+                                timeout,
+                                priority)
+
+    @staticmethod
+    def __payload(message: Message):
+        """
+        Payload of a message with buffers restored from shared memory
+
+        :return: the payload
+        """
+        payload = message.payload
+        if isinstance(payload, SharedPayload):
+            payload = get_pool().loads(payload)
+        return payload
+
+    def __send(self, message: Message):
+        self.__broker_con.send(message)
+
+    def __read(self):
+        """
+        Handle the messages waiting in the connection
+        """
+        try:
+            for _ in range(self.MAX_BATCH):
+                if not self.__broker_con.poll():
+                    break
+                self.__handle(self.__broker_con.recv())
+        except (EOFError, OSError):
+            self.__disconnected()
+
+    def __disconnected(self):
+        """
+        The broker is gone, fail the calls waiting for it
+        """
+        self.__connected = False
+        self.__loop.remove_reader(self.__broker_con.fileno())
+        for future in self.__pending.values():
+            if not future.done():
+                future.set_exception(
+                    ConnectionError('Connection to the broker lost'))
+        self.__pending.clear()
+
+    def __handle(self, message: Message):
+        """
+        Resolve the future of a return message or call a function
+        """
+        if message.action == 'return':
+            future = self.__pending.pop(message.com_id, None)
+            if future is None or future.done():
+                # late answer of a cancelled request
+                discard(message)
+                return
+            try:
+                future.set_result(self.__payload(message))
+            except Exception as exception:
+                future.set_exception(exception)
+        elif message.action == 'cancel':
+            task = self.__tasks.get(message.com_id)
+            if task is not None:
+                task.cancel()
+        elif message.action == '__ping__':
+            self.__send(Message('return', None, message.com_id))
+        elif not message.flags & Flag.PUBLISH:
+            self.__process_message(message)
+
+    def __process_message(self, message: Message):
+        payload = self.__payload(message)
+        if not isinstance(payload, dict):
+            self.__reply(message, TypeError('Payload is not argument dict'))
+            return
+        func = self.__registered_funcs.get(message.action)
+        if func is None:
+            self.__reply(message, KeyError('Function not known'))
+            return
+        if message.flags & Flag.STREAM:
+            self.__reply(message,
+                         TypeError('Streams are not supported by '
+                                   'AsyncClient'))
+            return
+        args = payload.get('args', tuple())
+        kwargs = payload.get('kwargs', dict())
+
+        if message.flags & Flag.BATCH:
+            results = list()
+            for item in args:
+                try:
+                    results.append(func(*item, **kwargs))
+                except Exception as exception:
+                    results.append(exception)
+            if any(inspect.isawaitable(result) for result in results):
+                self.__run(message, self.__gather(results))
+            else:
+                self.__reply(message, results)
+            return
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exception:
+            self.__reply(message, exception)
+            return
+        if inspect.isawaitable(result):
+            self.__run(message, result)
+        else:
+            self.__reply(message, result)
+
+    def __run(self, message: Message, awaitable):
+        """
+        Answer a request once its awaitable completes
+        """
+        task = asyncio.ensure_future(awaitable)
+        self.__tasks[message.com_id] = task
+        task.add_done_callback(partial(self.__done, message))
+
+    def __done(self, message: Message, task):
+        self.__tasks.pop(message.com_id, None)
+        if task.cancelled():
+            # the caller is not waiting for it any more
+            return
+        exception = task.exception()
+        if exception is not None:
+            self.__reply(message, exception)
+        else:
+            self.__reply(message, task.result())
+
+    @staticmethod
+    async def __gather(results):
+        """
+        Await the awaitable results of a batch
+
+        :return: list of return values, exceptions in place of the return
+                 value of failed calls
+        """
+        gathered = list()
+        for result in results:
+            if inspect.isawaitable(result):
+                try:
+                    result = await result
+                except Exception as exception:
+                    result = exception
+            gathered.append(result)
+        return gathered
+
+    def __reply(self, message: Message, result):
+        """
+        Send the result of a call back
+
+        :param message: the request
+        :param result: return value or exception of the call
+        """
+        if message.flags & Flag.NO_REPLY or not self.__connected:
+            return
+        if isinstance(result, Exception):
+            return_message = Message('return', result, message.com_id)
+        else:
+            return_message = self.__message('return',
+                                            result,
+                                            message.com_id)
+        try:
+            self.__send(return_message)
+        except (EOFError, OSError):
+            pass
+        except Exception as exception:
+            # the return value could not be serialized
+            self.__send(Message('return',
+                                TypeError(str(exception)),
+                                message.com_id))
@@ -0,0 +1,12 @@
+"""
+Throughput and latency benchmarks of broker and clients
+
+Run ``python -m ipcbroker.benchmark --help`` or ``ipcbroker-benchmark``
+for the command line interface.
+"""
+from ipcbroker.benchmark.runner import MODES
+from ipcbroker.benchmark.runner import compare
+from ipcbroker.benchmark.runner import run
+from ipcbroker.benchmark.runner import run_case
+
+__all__ = ["MODES", "compare", "run", "run_case"]
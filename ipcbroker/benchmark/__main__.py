@@ -0,0 +1,118 @@
+import argparse
+import json
+
+from ipcbroker.benchmark.runner import MODES
+from ipcbroker.benchmark.runner import compare
+from ipcbroker.benchmark.runner import run
+
+
+def int_list(text):
+    return [int(item) for item in text.split(',')]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='ipcbroker-benchmark',
+        description='Measure calls per second and round trip latency')
+    parser.add_argument('--modes',
+                        default=','.join(MODES),
+                        type=lambda text: text.split(','),
+                        help='comma separated modes out of {} '
+                             '(default: all)'.format(', '.join(MODES)))
+    parser.add_argument('--clients',
+                        default=[1, 4],
+                        type=int_list,
+                        help='comma separated numbers of calling clients '
+                             '(default: 1,4)')
+    parser.add_argument('--sizes',
+                        default=[16, 1024, 65536, 1048576],
+                        type=int_list,
+                        help='comma separated payload sizes in bytes '
+                             '(default: 16,1024,65536,1048576)')
+    parser.add_argument('--calls',
+                        default=1000,
+                        type=int,
+                        help='calls per client (default: 1000)')
+    parser.add_argument('--warmup',
+                        default=10,
+                        type=int,
+                        help='calls per client before measuring '
+                             '(default: 10)')
+    parser.add_argument('--compact',
+                        action='store_true',
+                        help='use compact framing')
+    parser.add_argument('--compression',
+                        default=None,
+                        help='codec of the connections, e.g. zlib (the '
+                             'payloads are random and do not compress)')
+    parser.add_argument('--shards',
+                        default=1,
+                        type=int,
+                        help='router threads of the broker (default: 1)')
+    parser.add_argument('--peer',
+                        action='store_true',
+                        help='call the provider over direct connections')
+    parser.add_argument('--shared-memory-threshold',
+                        default=None,
+                        type=int,
+                        help='pass buffers of at least this many bytes in '
+                             'shared memory')
+    parser.add_argument('--output',
+                        help='write the results as JSON to this file')
+    parser.add_argument('--compare',
+                        help='JSON file of an earlier run to compare with')
+    args = parser.parse_args(argv)
+    for mode in args.modes:
+        if mode not in MODES:
+            parser.error('unknown mode: {}'.format(mode))
+    return args
+
+
+def print_results(results):
+    print('{:<8} {:>7} {:>9} {:>10} {:>10} {:>10}'.format(
+        'mode', 'clients', 'size', 'calls/s', 'p50 ms', 'p99 ms'))
+    for result in results['results']:
+        print('{:<8} {:>7} {:>9} {:>10.0f} {:>10.3f} {:>10.3f}'.format(
+            result['mode'],
+            result['clients'],
+            result['size'],
+            result['calls_per_second'],
+            result['p50'] * 1000,
+            result['p99'] * 1000))
+
+
+def print_comparison(baseline, results):
+    print()
+    print('{:<8} {:>7} {:>9} {:>10} {:>10} {:>10}'.format(
+        'mode', 'clients', 'size', 'calls/s', 'p50', 'p99'))
+    for case, before, after in compare(baseline, results):
+        print('{:<8} {:>7} {:>9} {:>+9.1%} {:>+9.1%} {:>+9.1%}'.format(
+            *case,
+            after['calls_per_second'] / before['calls_per_second'] - 1,
+            after['p50'] / before['p50'] - 1,
+            after['p99'] / before['p99'] - 1))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(modes=args.modes,
+                  clients=args.clients,
+                  sizes=args.sizes,
+                  calls=args.calls,
+                  warmup=args.warmup,
+                  compact=args.compact,
+                  compression=args.compression,
+                  shards=args.shards,
+                  peer=args.peer,
+                  shared_memory_threshold=args.shared_memory_threshold)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            print_comparison(json.load(baseline), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+
+from ipcbroker.broker import Broker
+from ipcbroker.client import Client
+
+# where the callers run: 'local' calls a function registered at the
+# calling client, 'thread' and 'process' call a provider through the
+# broker from threads or forked processes
+MODES = ('local', 'thread', 'process')
+
+
+def echo(value):
+    return value
+
+
+def call_loop(client: Client, payload, calls, warmup):
+    """
+    Call echo through Client.__call__ and time each call
+
+    :return: list of round trip times in seconds
+    """
+    for _ in range(warmup):
+        client('echo', payload)
+    samples = list()
+    for _ in range(calls):
+        start = time.perf_counter()
+        client('echo', payload)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def percentile(samples, percent):
+    """
+    :param samples: sorted samples
+    :param percent: the percentile, e.g. 99
+    :return: the nearest rank percentile
+    """
+    index = int(round(percent / 100.0 * (len(samples) - 1)))
+    return samples[index]
+
+
+def summarize(samples, seconds):
+    """
+    Throughput and latency of a finished case
+
+    :param samples: round trip times of all callers
+    :param seconds: wall time of the case
+    :return: dict with calls, seconds, calls_per_second and p50, p99 and
+             mean latency in seconds
+    """
+    samples = sorted(samples)
+    return {'calls': len(samples),
+            'seconds': seconds,
+            'calls_per_second': len(samples) / seconds,
+            'p50': percentile(samples, 50),
+            'p99': percentile(samples, 99),
+            'mean': statistics.mean(samples)}
+
+
+def run_threads(callers, payload, calls, warmup):
+    """
+    Run the call loops of the callers on threads
+
+    :return: samples and wall time
+    """
+    barrier = threading.Barrier(len(callers) + 1)
+    results = [None] * len(callers)
+
+    def run(index, client):
+        barrier.wait()
+        results[index] = call_loop(client, payload, calls, warmup)
+
+    threads = [threading.Thread(target=run, args=(index, client))
+               for index, client in enumerate(callers)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    return [sample for result in results for sample in result], seconds
+
+
+def run_processes(callers, payload, calls, warmup):
+    """
+    Run the call loops of the callers in forked processes
+
+    The callers are not started, the processes read their answers while
+    waiting for them.
+
+    :return: samples and wall time
+    """
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(len(callers) + 1)
+    queue = context.Queue()
+
+    def run(client):
+        barrier.wait()
+        queue.put(call_loop(client, payload, calls, warmup))
+
+    processes = [context.Process(target=run, args=(client,))
+                 for client in callers]
+    for process in processes:
+        process.start()
+    barrier.wait()
+    start = time.perf_counter()
+    samples = list()
+    for _ in processes:
+        samples.extend(queue.get())
+    seconds = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    return samples, seconds
+
+
+def run_case(mode, clients, size, calls, warmup=10, **options):
+    """
+    Measure one combination of mode, number of callers and payload size
+
+    :param mode: one of MODES
+    :param clients: number of calling clients
+    :param size: payload size in bytes
+    :param calls: calls per client
+    :param warmup: calls per client before measuring
+    :param options: keyword arguments of the Broker and the Clients:
+                    compact, compression, shards and
+                    shared_memory_threshold, peer to call the provider
+                    over direct connections
+    :return: dict with the case and its results, see summarize()
+    """
+    if mode not in MODES:
+        raise ValueError('Unknown mode: {}'.format(mode))
+    threshold = options.pop('shared_memory_threshold', None)
+    peer = options.pop('peer', False)
+    broker = Broker(**options).start()
+    provider = None
+    callers = list()
+    try:
+        if mode != 'local':
+            provider = Client(broker,
+                              shared_memory_threshold=threshold).start()
+            provider.register_function('echo', echo)
+            if peer:
+                provider.listen()
+        for _ in range(clients):
+            client = Client(broker, shared_memory_threshold=threshold)
+            if mode == 'local':
+                client.register_function('echo', echo)
+            elif mode == 'thread':
+                client.start()
+            if peer and mode != 'local':
+                client.connect_peer('echo')
+            callers.append(client)
+
+        payload = os.urandom(size)
+        if mode == 'process':
+            samples, seconds = run_processes(callers,
+                                             payload,
+                                             calls,
+                                             warmup)
+        else:
+            samples, seconds = run_threads(callers, payload, calls, warmup)
+    finally:
+        for client in callers:
+            if client.is_alive():
+                client.stop()
+        if provider is not None:
+            provider.stop()
+        broker.stop()
+
+    result = {'mode': mode,
+              'clients': clients,
+              'size': size}
+    result.update(summarize(samples, seconds))
+    return result
+
+
+def run(modes=MODES,
+        clients=(1,),
+        sizes=(16,),
+        calls=1000,
+        warmup=10,
+        **options):
+    """
+    Run all combinations of modes, numbers of clients and payload sizes
+
+    :return: dict with the environment, the options and the results of
+             all cases
+    """
+    results = list()
+    for mode in modes:
+        for n_clients in clients:
+            for size in sizes:
+                results.append(run_case(mode,
+                                        n_clients,
+                                        size,
+                                        calls,
+                                        warmup,
+                                        **dict(options)))
+    return {'environment': environment(),
+            'options': dict(options, calls=calls, warmup=warmup),
+            'results': results}
+
+
+def environment():
+    """
+    Describe the machine a run was measured on
+    """
+    return {'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+
+def compare(baseline, current):
+    """
+    Match the cases of two runs
+
+    :param baseline: result of run() to compare against
+    :param current: result of run()
+    :return: list of (case, baseline result, current result) for the
+             cases that are in both runs, case is (mode, clients, size)
+    """
+    def key(result):
+        return result['mode'], result['clients'], result['size']
+
+    baseline_results = {key(result): result
+                        for result in baseline['results']}
+    return [(key(result), baseline_results[key(result)], result)
+            for result in current['results']
+            if key(result) in baseline_results]
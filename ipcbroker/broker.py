@@ -1,165 +1,1498 @@
+import heapq
 import logging
-from multiprocessing import Lock
+import random
+import time
+from functools import partial
+from multiprocessing import AuthenticationError
 from multiprocessing import Pipe
-from multiprocessing.connection import Connection
-from multiprocessing.connection import wait
-from queue import Queue
+from multiprocessing.connection import Listener
+from multiprocessing.connection import address_type
+from multiprocessing.connection import answer_challenge
+from multiprocessing.connection import deliver_challenge
+from queue import Full
+from threading import RLock
+from threading import Thread
 
+from ipcbroker.cache import ResultCache
+from ipcbroker.compression import COMPRESSION_THRESHOLD
+from ipcbroker.compression import get_codec
+from ipcbroker.connection import MessageConnection
+from ipcbroker.lanes import LANE_WEIGHTS
+from ipcbroker.lanes import LaneQueue
+from ipcbroker.message import Flag
 from ipcbroker.message import Message
+from ipcbroker.message import Priority
+from ipcbroker.policy import get_policy
+from ipcbroker.router import Router
+from ipcbroker.sender import Sender
+from ipcbroker.sharedmem import discard
+from ipcbroker.stats import CallStats
+from ipcbroker.stats import Histogram
 from ipcbroker.threaded import Threaded
+from ipcbroker.transport import accept
+from ipcbroker.transport import close_listener
+from ipcbroker.transport import connect
 
 
 class Broker(Threaded):
     POLL_TIMEOUT = 0.1
+    OVERFLOW = ('fail', 'shed')
+    # heartbeat intervals a connection may stay silent before it is
+    # dropped
+    HEARTBEAT_MISSES = 3
+    # seconds a new socket connection has to send its handshake
+    HANDSHAKE_TIMEOUT = 10
+    # messages queued for a connection that does not read them
+    SEND_QUEUE_SIZE = 10000
+    # entries of forgotten requests the deadline heap keeps before it is
+    # rebuilt
+    MIN_STALE_DEADLINES = 1024
 
     def __init__(self,
-                 name=None):
+                 name=None,
+                 compact=False,
+                 policy=None,
+                 shards=1,
+                 timeout=None,
+                 max_outstanding=None,
+                 queue_size=None,
+                 overflow='fail',
+                 lane_weights=LANE_WEIGHTS,
+                 failover=False,
+                 heartbeat=None,
+                 compression=None,
+                 compression_threshold=COMPRESSION_THRESHOLD,
+                 send_queue_size=SEND_QUEUE_SIZE):
+        """
+        :param name: name of the worker thread
+        :param compact: use compact binary framing on new connections
+        :param policy: how to pick one of several providers of a
+                       function: 'round_robin' (default),
+                       'least_outstanding' or a Policy
+        :param shards: number of router threads the client connections
+                       are spread over, all but the first one are only
+                       running after start(). The routers share one lock
+                       and the GIL, more shards do not add throughput
+        :param timeout: seconds after which calls without a timeout of
+                        their own are answered with a TimeoutError,
+                        None to wait for ever
+        :param max_outstanding: credits of a provider, the number of
+                                requests it gets at the same time. Further
+                                requests wait in the queue of the function.
+                                None for no limit
+        :param queue_size: maximum number of requests waiting for a
+                           provider per function, None for no limit
+        :param overflow: what happens to a request that finds the queue
+                         full: 'fail' answers it with queue.Full, 'shed'
+                         answers the oldest queued request with queue.Full
+                         and queues the new one
+        :param lane_weights: weight of each Priority, queued requests are
+                             dispatched in proportion to the weights of
+                             their lanes
+        :param failover: requests in flight at a provider that
+                         disconnects go to another provider of the
+                         function, which runs them again. Only enable it
+                         if the functions are idempotent. By default
+                         they are answered with a ConnectionError
+        :param heartbeat: seconds after which silent providers and
+                          federated brokers are pinged. A connection that
+                          stays silent for HEARTBEAT_MISSES intervals is
+                          closed like a connection that hit EOF. None
+                          disables heartbeats
+        :param compression: Codec or codec name ('zlib', 'lzma') of new
+                            connections, None to send payloads as they
+                            are. Payloads compressed by a client are
+                            forwarded without decoding them
+        :param compression_threshold: smallest payload in bytes that is
+                                      compressed
+        :param send_queue_size: messages the broker queues for a
+                                connection that does not read them. A
+                                connection whose queue is full is closed
+                                like a connection that hit EOF. None for
+                                no limit
+        """
         if name is not None:
             super().__init__(name=name)
         else:
             super().__init__()
+        if shards < 1:
+            raise ValueError('At least one shard is required')
+        if overflow not in self.OVERFLOW:
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
         self.__client_connections = list()
         self.__registered_functions = dict()
-        self.__message_queue = Queue()
-        self.__return_queue = Queue()
+        # com_id -> caller, provider, cache key and deadline of the
+        # request
         self.__open_messages = dict()
+        # heap of (deadline, com_id), entries of forgotten requests are
+        # skipped when they are popped and counted in __stale_deadlines,
+        # the heap is rebuilt once they are the majority
+        self.__deadlines = list()
+        self.__stale_deadlines = 0
+        # (function name, cache key of the arguments) -> com_id of the
+        # request identical requests of coalescing functions follow
+        self.__flights = dict()
+        self.__timeout = timeout
+        self.__max_outstanding = max_outstanding
+        self.__queue_size = queue_size
+        self.__overflow = overflow
+        self.__lane_weights = tuple(lane_weights)
+        # fails early on invalid weights
+        LaneQueue(self.__lane_weights)
+        # time requests of each lane wait for a provider
+        self.__lane_waits = [Histogram() for _ in Priority]
+        self.__failover = failover
+        self.__heartbeat = heartbeat
+        self.__next_heartbeat = None
+        # function name -> CallStats
+        self.__call_stats = dict()
+        # provider -> number of unanswered requests
+        self.__outstanding = dict()
+        # provider -> names of the functions it provides
+        self.__provided = dict()
+        # topic -> subscribed connections
+        self.__subscriptions = dict()
+        # connection -> address, authkey and framing of the listener the
+        # client accepts direct connections on
+        self.__peer_addresses = dict()
+        self.__policy = get_policy(policy)
+
+        # listeners with their authkey, connections made over sockets and
+        # the connections to federated brokers among them
+        self.__listeners = list()
+        self.__sockets = list()
+        self.__brokers = list()
+
+        # function name -> WorkerPool
+        self.__pools = dict()
 
-        self.__connection_lock = Lock()
+        # the first router runs on the thread of the broker and expires
+        # the overdue requests of all shards, each router has a sender
+        # for the connections it reads
+        self.__routers = list()
+        self.__senders = list()
+        for shard in range(shards):
+            router_name = None
+            sender_name = None
+            if name is not None:
+                sender_name = '{}-sender-{}'.format(name, shard)
+            if name is not None and shard > 0:
+                router_name = '{}-{}'.format(name, shard)
+            self.__senders.append(Sender(sender_name, send_queue_size))
+            self.__routers.append(Router(self.__process_message,
+                                         self.__return_message,
+                                         self.__remove_client,
+                                         router_name,
+                                         None if shard else self.__expire,
+                                         self.__route_failed))
+        # connection -> router reading it and sender writing it
+        self.__client_routers = dict()
+        self.__client_senders = dict()
+
+        # client ids prefix the com_ids of their clients, the random
+        # part keeps ids of federated brokers apart
+        self.__compact = compact
+        self.__compression = get_codec(compression)
+        self.__compression_threshold = compression_threshold
+        self.__broker_id = random.getrandbits(16)
+        self.__next_client = 0
+
+        # guards registry, open messages and connections, the routers
+        # share it
+        self.__connection_lock = RLock()
 
         self.__logger = logging.getLogger(__name__)
 
-    def register_client(self):
+    def register_client(self, compact=None, compression=None):
         """
         Register a client at the broker
 
-        :return: a multiprocessing connection to communicate with the broker
+        :param compact: use compact binary framing on the connection,
+                        defaults to the setting of the broker
+        :param compression: Codec or codec name of the connection, False
+                            for none, defaults to the setting of the
+                            broker
+        :return: a connection to communicate with the broker
         """
+        if compact is None:
+            compact = self.__compact
+        if compression is None:
+            compression = self.__compression
+        compression = get_codec(compression or None)
         recv, send = Pipe(True)
-        self.__client_connections.append(send)
-        return recv
+        client_id = self.__next_client_id()
+        self.__add_connection(MessageConnection(send,
+                                                compact,
+                                                client_id,
+                                                compression,
+                                                self.__compression_threshold))
+        return MessageConnection(recv,
+                                 compact,
+                                 client_id,
+                                 compression,
+                                 self.__compression_threshold)
+
+    def listen(self, address=None, authkey=None):
+        """
+        Accept clients and other brokers over a socket
+
+        Clients connect with a RemoteBroker of the address, brokers with
+        connect_broker(). They can come and go at any time and live in
+        other process trees or on other hosts.
+
+        Messages are unpickled, a listener that is not a Unix domain
+        socket requires an authkey.
+
+        :param address: path of a Unix domain socket, (host, port) for TCP
+                        or None for a new Unix domain socket
+        :param authkey: key the other side has to know, required for
+                        connections from other hosts
+        :return: the address of the listener
+        """
+        if (
+            authkey is None and
+            address is not None and
+            address_type(address) != 'AF_UNIX'
+        ):
+            raise ValueError('Listening on {} requires an authkey'.format(
+                address))
+        # connections authenticate on a handshake thread, a client that
+        # does not answer does not hold up the others
+        listener = Listener(address)
+        with self.__connection_lock:
+            self.__listeners.append((listener, authkey))
+        Thread(target=self.__accept,
+               args=(listener, authkey),
+               daemon=True).start()
+        return listener.address
+
+    def connect_broker(self, address, authkey=None):
+        """
+        Federate with a broker listening on a socket
+
+        Both brokers announce the functions of their own clients to each
+        other. A function the other broker provides is called through it,
+        requests of the other broker are only passed on to own clients.
+        Functions of a third broker are not passed on, federate every pair
+        of brokers that call each other.
+
+        :param address: address the other broker listens on
+        :param authkey: key the other broker was started with
+        """
+        connection = connect(address,
+                             authkey,
+                             self.__compact,
+                             self.__compression)
+        with self.__connection_lock:
+            self.__brokers.append(connection)
+            self.__sockets.append(connection)
+        self.__add_connection(connection)
+        self.__send(connection, Message('__federate__',
+                                        self.__announcement()))
+
+    def spawn_pool(self,
+                   name,
+                   func,
+                   min_workers=1,
+                   max_workers=None,
+                   target_load=1,
+                   idle_timeout=30,
+                   context='spawn',
+                   **options):
+        """
+        Provide a function on worker processes that are started and
+        retired with its load
+
+        The pool starts workers until each has at most target_load
+        requests in flight or queued, and retires workers above
+        min_workers that were idle for idle_timeout seconds. Workers that
+        die are replaced.
+
+        :param name: name of the function
+        :param func: the function, it has to be picklable
+        :param min_workers: workers kept running without load
+        :param max_workers: most workers at the same time, None for the
+                            number of CPUs
+        :param target_load: requests in flight or queued per worker
+        :param idle_timeout: seconds without requests after which a worker
+                             is retired
+        :param context: multiprocessing context or start method of the
+                        workers
+        :param options: keyword arguments of Client.register_function()
+        :return: the started WorkerPool
+        """
+        # the workers are clients, the client module imports this one
+        from ipcbroker.pool import WorkerPool
+
+        with self.__connection_lock:
+            if name in self.__pools:
+                raise KeyError('Pool already running: {}'.format(name))
+            pool = WorkerPool(name,
+                              func,
+                              self.register_client,
+                              partial(self.__pool_load, name),
+                              partial(self.__retire, name),
+                              min_workers,
+                              max_workers,
+                              target_load,
+                              idle_timeout,
+                              context,
+                              options)
+            self.__pools[name] = pool
+        try:
+            return pool.start()
+        except BaseException:
+            with self.__connection_lock:
+                del self.__pools[name]
+            pool.stop()
+            raise
+
+    def __pool_load(self, name):
+        """
+        :return: number of queued requests of a function and client id ->
+                 requests in flight of its providers
+        """
+        with self.__connection_lock:
+            function = self.__registered_functions.get(name)
+            if function is None:
+                return 0, dict()
+            return len(function['queue']), {
+                provider.client_id: self.__outstanding[provider]
+                for provider in function['providers']}
+
+    def __retire(self, name, client_id):
+        """
+        Stop sending requests of a function to an idle provider
+
+        :return: False if the provider has requests in flight
+        """
+        with self.__connection_lock:
+            function = self.__registered_functions.get(name)
+            if function is None:
+                return True
+            for provider in function['providers']:
+                if provider.client_id == client_id:
+                    break
+            else:
+                return True
+            if self.__outstanding[provider]:
+                return False
+            orphaned = self.__remove_provider(provider, name)
+        self.__orphan(orphaned)
+        return True
+
+    def __next_client_id(self):
+        with self.__connection_lock:
+            self.__next_client += 1
+            return ((self.__broker_id << 16) |
+                    (self.__next_client & 0xffff))
+
+    def __add_connection(self, connection: MessageConnection):
+        """
+        Read a new client connection on the least loaded router
+        """
+        with self.__connection_lock:
+            self.__client_connections.append(connection)
+            shard = min(range(len(self.__routers)),
+                        key=lambda index: self.__routers[index].n_connections)
+            router = self.__routers[shard]
+            self.__client_routers[connection] = router
+            self.__client_senders[connection] = self.__senders[shard]
+        router.add_connection(connection)
+
+    def __accept(self, listener: Listener, authkey):
+        """
+        Accept connections until the listener is closed, each one
+        shakes hands on a thread of its own
+        """
+        while True:
+            try:
+                connection = listener.accept()
+            except (EOFError, OSError):
+                if not self.__is_listening(listener):
+                    return
+                continue
+            if not self.__is_listening(listener):
+                # woken up by stop()
+                connection.close()
+                return
+            Thread(target=self.__handshake,
+                   args=(listener, connection, authkey),
+                   daemon=True).start()
+
+    def __handshake(self, listener: Listener, connection, authkey):
+        """
+        Authenticate a new connection and add it as a client
+        """
+        try:
+            if authkey is not None:
+                # the challenges of Listener.accept()
+                deliver_challenge(connection, authkey)
+                answer_challenge(connection, authkey)
+            connection = accept(connection,
+                                self.__next_client_id(),
+                                self.__compact,
+                                self.__compression,
+                                self.__compression_threshold,
+                                self.HANDSHAKE_TIMEOUT)
+        except (EOFError, OSError, AuthenticationError):
+            connection.close()
+            return
+        with self.__connection_lock:
+            if not self.__is_listening(listener):
+                connection.close()
+                return
+            self.__sockets.append(connection)
+        self.__add_connection(connection)
+
+    def __is_listening(self, listener: Listener):
+        with self.__connection_lock:
+            return any(listener is open_listener
+                       for open_listener, _ in self.__listeners)
+
+    def __announcement(self, names=None, withdrawn=()):
+        """
+        Payload of a '__federate__' message: the functions of own clients
+        and the functions they do not provide any more
+
+        :param names: announced functions, None for all
+        """
+        with self.__connection_lock:
+            functions = list()
+            for name, function in self.__registered_functions.items():
+                if names is not None and name not in names:
+                    continue
+                if self.__local(function['providers']):
+                    functions.append({'name': name,
+                                      'long_running':
+                                          function['long_running'],
+                                      'priority': function['priority'],
+                                      'coalesce': function['coalesce']})
+            return {'functions': functions, 'withdrawn': list(withdrawn)}
+
+    def __announce(self, names=None, withdrawn=()):
+        """
+        Tell the federated brokers about changed functions
+        """
+        with self.__connection_lock:
+            brokers = list(self.__brokers)
+        if not brokers:
+            return
+        message = Message('__federate__',
+                          self.__announcement(names, withdrawn))
+        for broker in brokers:
+            self.__send(broker, message)
+
+    def __federate(self, client: MessageConnection, message: Message):
+        """
+        Register the functions a federated broker announced
+        """
+        with self.__connection_lock:
+            # a broker that connected to this one gets an answer
+            answer = client not in self.__brokers
+            if answer:
+                self.__brokers.append(client)
+            for function in message.payload['functions']:
+                self.__add_provider(client,
+                                    function['name'],
+                                    function['long_running'],
+                                    priority=function.get('priority'),
+                                    coalesce=function.get('coalesce', False))
+            orphaned = list()
+            for name in message.payload['withdrawn']:
+                orphaned.extend(self.__remove_provider(client, name))
+        if answer:
+            self.__send(client, Message('__federate__',
+                                        self.__announcement()))
+        self.__orphan(orphaned)
+        self.__dispatch(client)
+
+    def __local(self, providers):
+        """
+        The providers that are clients and not federated brokers
+        """
+        return [provider for provider in providers
+                if provider not in self.__brokers]
+
+    def start(self):
+        super().start()
+        for router in self.__routers[1:]:
+            router.start()
+        return self
+
+    def stop(self):
+        with self.__connection_lock:
+            listeners = list(self.__listeners)
+            del self.__listeners[:]
+            pools = list(self.__pools.values())
+            self.__pools.clear()
+        # the workers close their connections while the broker runs
+        for pool in pools:
+            pool.stop()
+        for listener, _ in listeners:
+            close_listener(listener)
+        for router in self.__routers[1:]:
+            if router.is_alive():
+                router.stop()
+        super().stop()
+        for sender in self.__senders:
+            sender.stop()
+        # clients and brokers on sockets see the broker go away
+        for connection in self.__sockets:
+            connection.close()
+        return self
+
+    def wakeup(self):
+        # the thread of the broker waits in the first router
+        self.__routers[0].wakeup()
 
     def work(self):
+        self.__routers[0].work()
+
+    def __send(self, client: MessageConnection, message: Message):
+        # never block the router on a full pipe
+        sender = self.__client_senders.get(client, self.__senders[0])
+        if sender.send(client, message):
+            return
+        discard(message)
+        router = self.__client_routers.get(client)
+        if router is not None and router.drop(client):
+            self.__logger.warning(
+                'Client {} does not read its messages'.format(
+                    client.client_id))
+
+    def invalidate_cache(self, name=None):
+        """
+        Drop the cached results of a function
+
+        :param name: name of the function, None for all functions
+        """
+        with self.__connection_lock:
+            functions = self.__registered_functions
+            for function_name, function in functions.items():
+                if function['cache'] is None:
+                    continue
+                if name is None or name == function_name:
+                    function['cache'].invalidate()
+
+    def cache_stats(self):
+        """
+        Hits, misses and entries of the result caches
+
+        :return: dict of function name -> statistics
+        """
+        with self.__connection_lock:
+            return {name: function['cache'].stats()
+                    for name, function in self.__registered_functions.items()
+                    if function['cache'] is not None}
+
+    def stats(self):
+        """
+        Snapshot of the metrics of the broker
+
+        Latencies are measured from receiving a request to forwarding
+        its return message. Connections are keyed by client id, the
+        bytes are counted from the view of the broker.
+
+        :return: dict with the keys 'clients', 'brokers' (federated
+                 brokers among the clients), 'open_messages',
+                 'functions' (name -> calls, errors, timeouts, rejected,
+                 coalesced, failovers and latency histogram),
+                 'in_flight' (client id -> requests at the provider),
+                 'queued' (name -> requests waiting for a credit),
+                 'lanes' (lane -> queued requests and histogram of the
+                 time requests waited for a provider), 'pools' (name ->
+                 workers of spawn_pool()), 'routers' (queue depth per
+                 router), 'connections' (client id -> bytes and
+                 messages moved) and 'compression' (codec -> payloads
+                 and bytes the broker compressed)
+        """
+        with self.__connection_lock:
+            return {
+                'clients': len(self.__client_connections),
+                'brokers': len(self.__brokers),
+                'open_messages': len(self.__open_messages),
+                'functions': {name: call_stats.snapshot()
+                              for name, call_stats
+                              in self.__call_stats.items()},
+                'in_flight': {provider.client_id: outstanding
+                              for provider, outstanding
+                              in self.__outstanding.items()
+                              if provider in self.__client_routers},
+                'queued': {name: len(function['queue'])
+                           for name, function
+                           in self.__registered_functions.items()},
+                'lanes': self.__lane_stats(),
+                'pools': {name: pool.stats()
+                          for name, pool in self.__pools.items()},
+                'routers': [router.n_queued for router in self.__routers],
+                'connections': {connection.client_id: connection.stats()
+                                for connection
+                                in self.__client_connections},
+                'compression': self.__compression_stats()
+            }
+
+    def __compression_stats(self):
+        """
+        Compressor stats of the connections summed up per codec, the
+        connection lock has to be held
+        """
+        codecs = dict()
+        for connection in self.__client_connections:
+            stats = connection.stats().get('compression')
+            if stats is None:
+                continue
+            totals = codecs.setdefault(stats['codec'], {'compressed': 0,
+                                                        'skipped': 0,
+                                                        'bytes_in': 0,
+                                                        'bytes_out': 0})
+            for key in totals:
+                totals[key] += stats[key]
+        for totals in codecs.values():
+            totals['ratio'] = (totals['bytes_out'] / totals['bytes_in']
+                               if totals['bytes_in'] else None)
+        return codecs
+
+    def __lane_stats(self):
+        """
+        Queued requests and wait times per lane, the connection lock has
+        to be held
+        """
+        queued = [0] * len(Priority)
+        for function in self.__registered_functions.values():
+            for lane, length in enumerate(function['queue'].lengths()):
+                queued[lane] += length
+        return {lane.name.lower(): {'queued': queued[lane],
+                                    'wait': self.__lane_waits[lane].snapshot()}
+                for lane in Priority}
+
+    def __expire(self):
+        """
+        Answer requests past their deadline with a TimeoutError and
+        cancel them at their provider, check the heartbeats
+
+        :return: seconds until the next deadline or heartbeat check or
+                 None
+        """
+        expired = list()
+        # (caller, com_id) of leaders whose call goes on for followers
+        late = list()
+        with self.__connection_lock:
+            now = time.monotonic()
+            while self.__deadlines and self.__deadlines[0][0] <= now:
+                deadline, com_id = heapq.heappop(self.__deadlines)
+                request = self.__open_messages.get(com_id)
+                if request is None or request['deadline'] != deadline:
+                    self.__stale_deadlines -= 1
+                    continue
+                if self.__outlive(com_id, request, now):
+                    if not request.get('abandoned'):
+                        request['abandoned'] = True
+                        self.__call_stats[request['name']].timeouts += 1
+                        late.append((request['caller'], com_id))
+                    continue
+                # its entry is gone already, __forget() counts it
+                self.__stale_deadlines -= 1
+                self.__forget(com_id)
+                callers = self.__callers(com_id, request)
+                self.__call_stats[request['name']].timeouts += len(callers)
+                expired.append((com_id, request, callers))
+            next_deadline = None
+            if self.__deadlines:
+                next_deadline = self.__deadlines[0][0] - now
+        exception = TimeoutError('Call timed out')
+        for caller, com_id in late:
+            self.__send(caller, Message('return', exception, com_id))
+        freed = set()
+        for com_id, request, callers in expired:
+            for caller, caller_id in callers:
+                self.__send(caller, Message('return', exception, caller_id))
+            if request['provider'] is None:
+                discard(request['message'])
+            else:
+                self.__send(request['provider'],
+                            Message('cancel', None, com_id))
+                freed.add(request['provider'])
+        for provider in freed:
+            self.__dispatch(provider)
+        next_heartbeat = self.__check_heartbeats()
+        if next_deadline is None:
+            return next_heartbeat
+        if next_heartbeat is None:
+            return next_deadline
+        return min(next_deadline, next_heartbeat)
+
+    def __outlive(self, com_id, request, now):
+        """
+        Keep an expired request open for followers that wait longer, the
+        connection lock has to be held
+
+        Its deadline becomes the latest deadline of the followers.
+
+        :return: True if the request stays open
+        """
+        deadlines = [follower['deadline']
+                     for follower in request.get('followers', {}).values()]
+        if not deadlines:
+            return False
+        if None in deadlines:
+            request['deadline'] = None
+            return True
+        deadline = max(deadlines)
+        if deadline <= now:
+            # the followers expire as well
+            return False
+        request['deadline'] = deadline
+        self.__push_deadline(deadline, com_id)
+        return True
+
+    def __push_deadline(self, deadline, com_id):
+        """
+        Add a deadline to the heap, the connection lock has to be held
+
+        Only the thread of the broker expires requests, it is woken up
+        if the new deadline comes before the one it waits for.
+        """
+        heapq.heappush(self.__deadlines, (deadline, com_id))
+        if (
+            self.__deadlines[0] == (deadline, com_id) and
+            not self.is_worker_thread()
+        ):
+            self.wakeup()
+
+    def __check_heartbeats(self):
+        """
+        Ping the providers and federated brokers that were silent for a
+        heartbeat interval, drop the ones that missed HEARTBEAT_MISSES
+        intervals
+
+        Clients answer pings while their worker thread runs a function,
+        a client whose worker thread stopped or whose process hangs is
+        dropped.
+
+        :return: seconds until the next check or None
+        """
+        if self.__heartbeat is None:
+            return None
+        pings = list()
+        dead = list()
+        with self.__connection_lock:
+            now = time.monotonic()
+            if self.__next_heartbeat is None:
+                self.__next_heartbeat = now + self.__heartbeat
+            if now < self.__next_heartbeat:
+                return self.__next_heartbeat - now
+            self.__next_heartbeat = now + self.__heartbeat
+            watched = set(self.__brokers)
+            for function in self.__registered_functions.values():
+                watched.update(function['providers'])
+            for connection in watched:
+                router = self.__client_routers.get(connection)
+                heard = None if router is None else router.heard(connection)
+                if heard is None:
+                    continue
+                if now - heard >= self.__heartbeat * self.HEARTBEAT_MISSES:
+                    dead.append((router, connection))
+                elif now - heard >= self.__heartbeat:
+                    pings.append(connection)
+        for connection in pings:
+            self.__send(connection, Message('__ping__', None, 0))
+        for router, connection in dead:
+            self.__logger.warning('Client {} missed its heartbeats'.format(
+                connection.client_id))
+            router.drop(connection)
+        return self.__heartbeat
+
+    def __forget(self, com_id):
+        """
+        Remove an open request, the connection lock has to be held
+
+        :return: the request
+        """
+        request = self.__open_messages.pop(com_id)
+        self.__forget_deadline(request)
+        leader_id = request.get('leader')
+        if leader_id is not None:
+            # a coalesced request, it does not wait for a call of its own
+            leader = self.__open_messages.get(leader_id)
+            if leader is not None:
+                leader['followers'].pop(com_id, None)
+            return request
+        for follower_id, follower in request['followers'].items():
+            del self.__open_messages[follower_id]
+            self.__forget_deadline(follower)
+        if self.__flights.get(request['flight']) == com_id:
+            del self.__flights[request['flight']]
+        if request['provider'] is not None:
+            self.__outstanding[request['provider']] -= 1
+        else:
+            # still queued for a provider
+            function = self.__registered_functions.get(request['name'])
+            if function is not None:
+                function['queue'].remove((request['caller'], com_id),
+                                         request['lane'])
+        return request
+
+    def __forget_deadline(self, request):
+        """
+        Count the heap entry of a forgotten request as stale, rebuild the
+        heap once most of its entries are stale, the connection lock has
+        to be held
+        """
+        if request['deadline'] is None:
+            return
+        self.__stale_deadlines += 1
+        if (
+            self.__stale_deadlines < self.MIN_STALE_DEADLINES or
+            self.__stale_deadlines * 2 < len(self.__deadlines)
+        ):
+            return
+        deadlines = list()
+        for deadline, com_id in self.__deadlines:
+            request = self.__open_messages.get(com_id)
+            if request is not None and request['deadline'] == deadline:
+                deadlines.append((deadline, com_id))
+        heapq.heapify(deadlines)
+        self.__deadlines = deadlines
+        self.__stale_deadlines = 0
+
+    @staticmethod
+    def __callers(com_id, request):
+        """
+        The callers waiting for the answer of a request: its own caller
+        unless it cancelled, and the callers of the requests following it
+
+        :return: list of (caller, com_id)
+        """
+        callers = list()
+        if not request.get('abandoned'):
+            callers.append((request['caller'], com_id))
+        for follower_id, follower in request.get('followers', {}).items():
+            callers.append((follower['caller'], follower_id))
+        return callers
+
+    def __follow(self, leader_id, client, message, deadline, lane):
+        """
+        Attach a request to an identical request in flight, the
+        connection lock has to be held
+        """
+        if deadline is not None:
+            self.__push_deadline(deadline, message.com_id)
+        follower = {
+            'name': message.action,
+            'caller': client,
+            'provider': None,
+            'cache': None,
+            'cache_key': None,
+            'deadline': deadline,
+            'received': time.monotonic(),
+            'lane': lane,
+            'leader': leader_id,
+            # asked again if the answer can only be read once
+            'message': message
+        }
+        self.__open_messages[message.com_id] = follower
+        self.__open_messages[leader_id]['followers'][message.com_id] = follower
+
+    def __dispatch(self, provider=None):
+        """
+        Send queued requests to providers with free credits
+
+        :param provider: the provider that got a credit back or was
+                         added, only the queues of its functions are
+                         served. None serves all functions
+        """
+        if self.__max_outstanding is None:
+            return
+        requests = list()
         with self.__connection_lock:
-            # read connections
-            recv_cons = wait(self.__client_connections, self.POLL_TIMEOUT)
-
-            # fill message queue
-            for recv_con in recv_cons:
-                while recv_con.poll(self.POLL_TIMEOUT):
-                    try:
-                        message = recv_con.recv()
-                        if message.action == 'return':
-                            self.__return_queue.put((recv_con, message))
-                        else:
-                            self.__message_queue.put((recv_con, message))
-                    except (EOFError, OSError):
-                        self.__logger.error('Error receiving from pipe')
+            if provider is None:
+                names = list(self.__registered_functions)
+            else:
+                names = self.__provided.get(provider, ())
+            for name in names:
+                function = self.__registered_functions[name]
+                while function['queue']:
+                    caller, com_id = function['queue'].peek()
+                    selected = self.__select(name, function, caller)
+                    if selected is None:
                         break
+                    function['queue'].popleft()
+                    request = self.__open_messages[com_id]
+                    request['provider'] = selected
+                    self.__lane_waits[request['lane']].record(
+                        time.monotonic() - request['received'])
+                    self.__outstanding[selected] += 1
+                    requests.append((selected, request['message']))
+        for selected, message in requests:
+            self.__send(selected, message)
 
-        qsize = self.__return_queue.qsize()
-        if qsize > 0:
-            while not self.__return_queue.empty():
-                client, message = self.__return_queue.get()
-                if message.com_id in self.__open_messages:
-                    self.__open_messages[message.com_id].send(message)
-                    del self.__open_messages[message.com_id]
-
-        qsize = self.__message_queue.qsize()
-        if qsize > 0:
-            self.__logger.debug('{} messages queued'.format(qsize))
-            # process messages in queue
-            while not self.__message_queue.empty():
-                client, message = self.__message_queue.get()
-                self.__process_message(client, message)
+    def __select(self, name, function, caller):
+        """
+        Select a provider with free credits, the connection lock has to
+        be held
+
+        :param caller: the connection of the request, requests of
+                       federated brokers only go to own clients
+        :return: the provider or None if all are busy
+        """
+        providers = function['providers']
+        if caller in self.__brokers:
+            providers = self.__local(providers)
+        if self.__max_outstanding is not None:
+            providers = [provider for provider in providers
+                         if self.__outstanding[provider] <
+                         self.__max_outstanding]
+            if not providers:
+                return None
+        return self.__policy.select(name, providers, self.__outstanding)
+
+    def __cancel(self, client: MessageConnection, com_id):
+        """
+        Forget a request the caller is not waiting for any more and pass
+        the cancellation on to its provider
+        """
+        with self.__connection_lock:
+            request = self.__open_messages.get(com_id)
+            if (
+                request is None or
+                request['caller'] is not client or
+                request.get('abandoned')
+            ):
+                return
+            if request.get('followers'):
+                # the call goes on for the requests following it
+                request['abandoned'] = True
+                return
+            self.__forget(com_id)
+        if request['provider'] is None:
+            discard(request['message'])
+        else:
+            self.__send(request['provider'], Message('cancel', None, com_id))
+            self.__dispatch(request['provider'])
+
+    def __credit(self, client: MessageConnection, message: Message):
+        """
+        Pass the credits of the consumer of a stream on to its producer
+        """
+        with self.__connection_lock:
+            request = self.__open_messages.get(message.com_id)
+        if (
+            request is not None and
+            request['caller'] is client and
+            request['provider'] is not None
+        ):
+            self.__send(request['provider'], message)
+
+    def __return_message(self, client, message):
+        if message.flags & Flag.STREAM:
+            # an item of a stream, the request stays open
+            with self.__connection_lock:
+                request = self.__open_messages.get(message.com_id)
+            if request is not None and request['provider'] is client:
+                self.__send(request['caller'], message)
+            else:
+                discard(message)
+            return
+        with self.__connection_lock:
+            if message.com_id not in self.__open_messages:
+                discard(message)
+                return
+            request = self.__forget(message.com_id)
+            now = time.monotonic()
+            error = bool(message.flags & Flag.ERROR)
+            call_stats = self.__call_stats[request['name']]
+            call_stats.record(now - request['received'], error)
+
+            # payloads in shared memory are only valid once
+            shared = bool(message.flags & Flag.SHARED_MEMORY)
+            followers = request['followers']
+            if not shared:
+                for follower in followers.values():
+                    call_stats.record(now - follower['received'], error)
+            cache = request['cache']
+            if cache is not None and not error and not shared:
+                # a compressed payload keeps its flag
+                cache.put(request['cache_key'],
+                          (message.raw_payload,
+                           message.flags & Flag.COMPRESSED))
+        if not request.get('abandoned'):
+            self.__send(request['caller'], message)
+        else:
+            discard(message)
+        for follower_id, follower in followers.items():
+            if shared:
+                # the followers ask again, the first one leads
+                self.__call_function(follower['caller'], follower['message'])
+            else:
+                self.__send(follower['caller'],
+                            Message.from_raw('return',
+                                             message.raw_payload,
+                                             follower_id,
+                                             message.flags))
+        self.__dispatch(client)
+
+    def __remove_client(self, client: MessageConnection):
+        with self.__connection_lock:
+            if client in self.__client_connections:
+                self.__client_connections.remove(client)
+            router = self.__client_routers.pop(client, None)
+            self.__client_senders.pop(client, None)
+            self.__peer_addresses.pop(client, None)
+            # the client does not provide its functions any more, the
+            # federated brokers forget the functions without own providers
+            orphaned = list()
+            withdrawn = list()
+            local = client not in self.__brokers
+            for name, function in list(self.__registered_functions.items()):
+                if client not in function['providers']:
+                    continue
+                orphaned.extend(self.__remove_provider(client, name))
+                if local and not self.__local(function['providers']):
+                    withdrawn.append(name)
+            if client in self.__brokers:
+                self.__brokers.remove(client)
+            if client in self.__sockets:
+                self.__sockets.remove(client)
+            for topic in list(self.__subscriptions):
+                self.__unsubscribe(client, topic)
+            # nobody waits for the calls of the client any more
+            for com_id, request in list(self.__open_messages.items()):
+                if request['caller'] is client:
+                    self.__cancel(client, com_id)
+            resent, failed = self.__reroute(client)
+            self.__outstanding.pop(client, None)
+        if router is not None:
+            router.remove_connection(client)
+        self.__orphan(orphaned)
+        self.__fail(failed, ConnectionError('Provider disconnected'))
+        for provider, message in resent:
+            self.__send(provider, message)
+        if withdrawn:
+            self.__announce(list(), withdrawn)
+        self.__dispatch()
+
+    def __reroute(self, provider):
+        """
+        Take the requests in flight at a provider that disconnected, the
+        connection lock has to be held
+
+        With failover they go to another provider of their function or
+        wait in its queue. The items of a stream were delivered already
+        and payloads in shared memory are only valid once, those requests
+        fail like all requests without failover.
+
+        :return: (provider, message) of the requests to send again and
+                 (request, com_id) of the failed requests
+        """
+        resent = list()
+        failed = list()
+        for com_id, request in list(self.__open_messages.items()):
+            if request['provider'] is not provider:
+                continue
+            name = request['name']
+            caller = request['caller']
+            function = self.__registered_functions.get(name)
+            message = request['message']
+            if (
+                not self.__failover or
+                function is None or
+                message.flags & (Flag.STREAM | Flag.SHARED_MEMORY) or
+                (caller in self.__brokers and
+                 not self.__local(function['providers']))
+            ):
+                failed.append((self.__forget(com_id), com_id))
+                continue
+            self.__call_stats[name].failovers += 1
+            request['provider'] = self.__select(name, function, caller)
+            if request['provider'] is None:
+                function['queue'].append((caller, com_id), request['lane'])
+            else:
+                self.__outstanding[request['provider']] += 1
+                resent.append((request['provider'], message))
+        return resent, failed
 
     def __process_message(self, client, message):
-        if message.action == 'register_function':
+        if message.flags & Flag.PUBLISH:
+            self.__publish(message)
+            return
+        elif message.action == 'register_function':
             self.__register_function(client, message)
             return
         elif message.action == 'close':
-            self.__client_connections.remove(client)
+            self.__remove_client(client)
+            return
+        elif message.action == 'subscribe':
+            with self.__connection_lock:
+                subscribers = self.__subscriptions.setdefault(
+                    message.payload, list())
+                if client not in subscribers:
+                    subscribers.append(client)
+            self.__send(client, Message('return', 'OK', message.com_id))
+            return
+        elif message.action == 'unsubscribe':
+            with self.__connection_lock:
+                self.__unsubscribe(client, message.payload)
+            self.__send(client, Message('return', 'OK', message.com_id))
+            return
+        elif message.action == '__stats__':
+            self.__send(client, Message('return',
+                                        self.stats(),
+                                        message.com_id))
+            return
+        elif message.action == '__peer__':
+            with self.__connection_lock:
+                if message.payload is None:
+                    self.__peer_addresses.pop(client, None)
+                else:
+                    self.__peer_addresses[client] = message.payload
+            self.__send(client, Message('return', 'OK', message.com_id))
+            return
+        elif message.action == '__lookup__':
+            self.__send(client, Message('return',
+                                        self.__lookup(message.payload),
+                                        message.com_id))
+            return
+        elif message.action == 'cancel':
+            self.__cancel(client, message.com_id)
+            return
+        elif message.action == '__ping__':
+            # a federated broker checks the connection
+            self.__send(client, Message('return', None, message.com_id))
+            return
+        elif message.action == '__credit__':
+            self.__credit(client, message)
+            return
+        elif message.action == '__federate__':
+            self.__federate(client, message)
+            return
+        elif message.action == 'invalidate':
+            self.invalidate_cache(message.payload)
+            self.__send(client, Message('return', 'OK', message.com_id))
             return
         self.__call_function(client, message)
 
+    def __route_failed(self, client, message, exception):
+        """
+        Answer a request the broker failed to route with the exception
+        """
+        if (
+            message.action == 'return' or
+            message.flags & (Flag.NO_REPLY | Flag.PUBLISH)
+        ):
+            return
+        self.__send(client, Message('return', exception, message.com_id))
+
+    def __lookup(self, name):
+        """
+        Find a provider of a function that accepts direct connections
+
+        :param name: name of the function
+        :return: dict with address, authkey, compact and client_id of the
+                 provider or None
+        """
+        with self.__connection_lock:
+            function = self.__registered_functions.get(name)
+            if function is None:
+                return None
+            providers = [provider for provider in function['providers']
+                         if provider in self.__peer_addresses]
+            if not providers:
+                return None
+            provider = self.__policy.select(name,
+                                            providers,
+                                            self.__outstanding)
+            peer = dict(self.__peer_addresses[provider])
+        peer['client_id'] = provider.client_id
+        return peer
+
+    def __unsubscribe(self, client: MessageConnection, topic):
+        subscribers = self.__subscriptions.get(topic, list())
+        if client in subscribers:
+            subscribers.remove(client)
+        if not subscribers:
+            self.__subscriptions.pop(topic, None)
+
+    def __publish(self, message: Message):
+        """
+        Forward a published message to all subscribers of its topic
+
+        The same message object is sent to every subscriber, its payload
+        is encoded only once.
+        """
+        with self.__connection_lock:
+            subscribers = list(self.__subscriptions.get(message.action,
+                                                        list()))
+        for subscriber in subscribers:
+            self.__send(subscriber, message)
+
     def __register_function(self,
-                            client: Connection,
+                            client: MessageConnection,
                             message: Message):
-        # function name is in payload
-        name = message.payload
+        # function name and options are in payload
+        name = message.payload['name']
+        cache = message.payload.get('cache')
+        priority = message.payload.get('priority')
+        coalesce = message.payload.get('coalesce', False)
 
-        long_running = False
-        if 'long_running' in message.flags:
-            long_running = True
+        long_running = bool(message.flags & Flag.LONG_RUNNING)
 
-        # check if function is already registered
-        if name in self.__registered_functions:
-            exception = KeyError('Method already registered'),
-            return_message = Message('return',
-                                     exception,
-                                     message.com_id)
-            client.send(return_message)
-            return
+        with self.__connection_lock:
+            # check if function is already registered by this client
+            added = self.__add_provider(client,
+                                        name,
+                                        long_running,
+                                        cache,
+                                        priority,
+                                        coalesce)
+            if added:
+                # register function and send OK back
+                return_message = Message('return',
+                                         'OK',
+                                         message.com_id)
+            else:
+                exception = KeyError('Method already registered')
+                return_message = Message('return',
+                                         exception,
+                                         message.com_id)
+        self.__send(client, return_message)
+        if added:
+            self.__announce([name])
+        # the new provider takes queued requests
+        self.__dispatch(client)
 
-        # register function and send OK back
-        self.__registered_functions[name] = {
-            'client': client,
-            'long_running': long_running
-        }
-        return_message = Message('return',
-                                 'OK',
-                                 message.com_id)
-        client.send(return_message)
+    def __add_provider(self,
+                       client,
+                       name,
+                       long_running,
+                       cache=None,
+                       priority=None,
+                       coalesce=False):
+        """
+        Add a provider of a function, the connection lock has to be held
+
+        :param cache: ResultCache options, only used by the first provider
+        :param priority: default Priority of calls, only used by the first
+                         provider
+        :param coalesce: identical calls in flight share one call, only
+                         used by the first provider
+        :return: False if the client provides the function already
+        """
+        # several clients may provide the same function, the first
+        # one decides about caching
+        function = self.__registered_functions.setdefault(name, {
+            'providers': list(),
+            'long_running': long_running,
+            'cache': None if cache is None else ResultCache(**cache),
+            # (caller, com_id) of requests waiting for a credit
+            'queue': LaneQueue(self.__lane_weights),
+            # lane of calls without a priority of their own
+            'priority': priority,
+            'coalesce': coalesce
+        })
+        if client in function['providers']:
+            return False
+        function['providers'].append(client)
+        function['long_running'] |= long_running
+        self.__outstanding.setdefault(client, 0)
+        self.__provided.setdefault(client, list()).append(name)
+        return True
+
+    def __remove_provider(self, client, name):
+        """
+        Remove a provider of a function, the connection lock has to be held
+
+        :return: (request, com_id) of the queued requests nobody provides
+                 the function for any more
+        """
+        function = self.__registered_functions.get(name)
+        if function is None or client not in function['providers']:
+            return list()
+        function['providers'].remove(client)
+        provided = self.__provided[client]
+        provided.remove(name)
+        if not provided:
+            del self.__provided[client]
+        if function['providers']:
+            return list()
+        orphaned = [(self.__forget(com_id), com_id)
+                    for _, com_id in list(function['queue'])]
+        del self.__registered_functions[name]
+        return orphaned
+
+    def __orphan(self, orphaned):
+        """
+        Answer requests whose function has no provider any more
+        """
+        self.__fail(orphaned, AttributeError('No such method registered'))
+
+    def __fail(self, requests, exception):
+        """
+        Answer all callers of forgotten requests with an exception
+
+        Requests still queued are never read, their shared memory is
+        released. A provider may have read a request sent to it already,
+        so its segments are left alone.
+
+        :param requests: list of (request, com_id)
+        """
+        for request, com_id in requests:
+            for caller, caller_id in self.__callers(com_id, request):
+                self.__send(caller, Message('return', exception, caller_id))
+            if request['provider'] is None:
+                discard(request['message'])
 
     def __call_function(self,
-                        client: Connection,
+                        client: MessageConnection,
                         message: Message):
         # function name in action field
         name = message.action
+        received = time.monotonic()
 
-        # check if function is registered
-        if name not in self.__registered_functions:
-            # send back KeyError (AttributeError better?)
-            exception = AttributeError('No such method registered')
-            return_msg = Message('return',
-                                 exception,
-                                 message.com_id)
-            client.send(return_msg)
-            return
+        # one-way calls are forwarded without waiting for an answer
+        no_reply = bool(message.flags & Flag.NO_REPLY)
 
-        # get the appropriate method connection and send the request
-        func_client = self.__registered_functions[name]['client']
-        long_running = self.__registered_functions[name]['long_running']
-        func_client.send(message)
-        self.__open_messages[message.com_id] = client
+        with self.__connection_lock:
+            # check if function is registered, requests of federated
+            # brokers need an own provider
+            function = self.__registered_functions.get(name)
+            if (
+                function is not None and
+                client in self.__brokers and
+                not self.__local(function['providers'])
+            ):
+                function = None
+            if function is None:
+                discard(message)
+                if no_reply:
+                    self.__logger.debug('Dropped notification {}'.format(
+                        name))
+                    return
+                # send back KeyError (AttributeError better?)
+                exception = AttributeError('No such method registered')
+                return_msg = Message('return',
+                                     exception,
+                                     message.com_id)
+                self.__send(client, return_msg)
+                return
+            call_stats = self.__call_stats.get(name)
+            if call_stats is None:
+                call_stats = self.__call_stats[name] = CallStats()
 
-        return
+            # answer from the cache without asking a provider, the items
+            # of streams are not cached. The payload of a shared memory
+            # request only holds segment handles, which are reused by
+            # requests with other data
+            cache = function['cache']
+            if message.flags & (Flag.STREAM | Flag.SHARED_MEMORY):
+                cache = None
+            cache_key = None
+            if cache is not None and not no_reply:
+                cache_key = cache.key(message.raw_payload,
+                                      message.flags &
+                                      (Flag.BATCH | Flag.COMPRESSED))
+                cached = cache.get(cache_key)
+                if cached is not None:
+                    raw, flags = cached
+                    call_stats.record(time.monotonic() - received)
+                    self.__send(client, Message.from_raw('return',
+                                                         raw,
+                                                         message.com_id,
+                                                         flags))
+                    return
 
-        poll_timeout = self.POLL_TIMEOUT * 10
+            lane = message.priority
+            if lane is None:
+                lane = function['priority']
+            if lane is None:
+                lane = Priority.NORMAL
 
-        try:
-            with self.__connection_lock:
-                # wait for return
-                if not long_running and not func_client.poll(poll_timeout):
-                    raise Exception('No response')
-                return_msg = func_client.recv()
-                while (
-                    return_msg.com_id != message.com_id and
-                    return_msg.action != 'return'
-                ):
-                    if return_msg.action == 'return':
-                        self.__return_queue.put((func_client, return_msg))
-                    else:
-                        self.__message_queue.put((func_client, return_msg))
-
-                    if not long_running and not func_client.poll(poll_timeout):
-                        raise Exception('No response')
-                    return_msg = func_client.recv()
-                client.send(return_msg)
-        except Exception as exception:
-            exc_message = Message('return',
-                                  exception,
-                                  message.com_id)
-            client.send(exc_message)
+            timeout = message.timeout or self.__timeout
+            deadline = None
+            if timeout and not no_reply:
+                deadline = received + timeout
+
+            # identical requests in flight share the call of the first one
+            flight = None
+            if (
+                function['coalesce'] and
+                not no_reply and
+                not message.flags & (Flag.STREAM | Flag.SHARED_MEMORY)
+            ):
+                flight = (name, ResultCache.key(message.raw_payload,
+                                                message.flags &
+                                                (Flag.BATCH |
+                                                 Flag.COMPRESSED)))
+                leader_id = self.__flights.get(flight)
+                if leader_id is not None:
+                    self.__follow(leader_id, client, message, deadline, lane)
+                    call_stats.coalesced += 1
+                    return
+
+            # notifications do not take credits
+            shed = None
+            if no_reply:
+                providers = function['providers']
+                if client in self.__brokers:
+                    providers = self.__local(providers)
+                func_client = self.__policy.select(name,
+                                                   providers,
+                                                   self.__outstanding)
+            else:
+                func_client = self.__select(name, function, client)
+                if func_client is None:
+                    queue = function['queue']
+                    if (
+                        self.__queue_size is not None and
+                        len(queue) >= self.__queue_size
+                    ):
+                        call_stats.rejected += 1
+                        # the oldest request of the lowest lane makes room
+                        # unless it is more urgent than the new one
+                        if self.__overflow == 'shed' and queue:
+                            (_, shed_id), shed_lane = queue.victim()
+                            if shed_lane >= lane:
+                                shed = (self.__forget(shed_id), shed_id)
+                        if shed is None:
+                            discard(message)
+                            self.__send(client, Message(
+                                'return',
+                                Full('Queue of {} is full'.format(name)),
+                                message.com_id))
+                            return
+                    queue.append((client, message.com_id), lane)
+                else:
+                    self.__lane_waits[lane].record(
+                        time.monotonic() - received)
+
+                if deadline is not None:
+                    self.__push_deadline(deadline, message.com_id)
+                self.__open_messages[message.com_id] = {
+                    'name': name,
+                    'caller': client,
+                    'provider': func_client,
+                    'cache': cache,
+                    'cache_key': cache_key,
+                    'deadline': deadline,
+                    'received': received,
+                    'lane': lane,
+                    # com_id -> coalesced requests waiting for this one
+                    'followers': dict(),
+                    'flight': flight,
+                    # sent once a provider has a free credit, or again if
+                    # the provider disconnects
+                    'message': message
+                }
+                if flight is not None:
+                    self.__flights[flight] = message.com_id
+                if func_client is not None:
+                    self.__outstanding[func_client] += 1
+
+        if shed is not None:
+            self.__fail([shed], Full('Queue of {} is full'.format(name)))
+        # send the request
+        if func_client is not None:
+            self.__send(func_client, message)
 
     @property
     def n_clients(self):
@@ -168,3 +1501,18 @@ class Broker(Threaded):
     @property
     def n_functions(self):
         return len(self.__registered_functions)
+
+    @property
+    def n_queued_messages(self):
+        """
+        Number of requests waiting for a provider with free credits
+        """
+        return sum(len(function['queue'])
+                   for function in self.__registered_functions.values())
+
+    @property
+    def n_open_messages(self):
+        """
+        Number of requests waiting for their return message
+        """
+        return len(self.__open_messages)
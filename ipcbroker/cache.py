@@ -0,0 +1,99 @@
+import hashlib
+import time
+from collections import OrderedDict
+from numbers import Real
+
+
+def check_cache(ttl, max_entries):
+    """
+    Check the options of a ResultCache
+
+    :param ttl: None or seconds greater than zero
+    :param max_entries: an int greater than zero
+    """
+    if ttl is not None:
+        if isinstance(ttl, bool) or not isinstance(ttl, Real):
+            raise TypeError('ttl is not a number: {!r}'.format(ttl))
+        if not ttl > 0:
+            raise ValueError('ttl has to be positive: {}'.format(ttl))
+    if isinstance(max_entries, bool) or not isinstance(max_entries, int):
+        raise TypeError('max_entries is not an int: {!r}'.format(
+            max_entries))
+    if max_entries < 1:
+        raise ValueError('max_entries has to be positive: {}'.format(
+            max_entries))
+
+
+class ResultCache:
+    """
+    LRU cache of serialized return values with an optional time to live
+
+    Entries are keyed by a digest of the serialized arguments, so equal
+    calls hit the cache without decoding anything.
+    """
+    def __init__(self, ttl=None, max_entries=128):
+        """
+        :param ttl: seconds an entry stays valid, None for no expiry
+        :param max_entries: maximum number of entries
+        """
+        check_cache(ttl, max_entries)
+        self.__ttl = ttl
+        self.__max_entries = max_entries
+        # key -> (expiry time, serialized return value)
+        self.__entries = OrderedDict()
+        self.__hits = 0
+        self.__misses = 0
+
+    @staticmethod
+    def key(raw_payload: bytes, flags=0):
+        """
+        Cache key of a call
+
+        :param raw_payload: the serialized arguments
+        :param flags: flags changing the meaning of the arguments
+        :return: the key
+        """
+        digest = hashlib.blake2b(raw_payload, digest_size=16).digest()
+        return flags, digest
+
+    def get(self, key):
+        """
+        Look up a call
+
+        :param key: key of the call
+        :return: the serialized return value or None
+        """
+        entry = self.__entries.get(key)
+        if entry is not None and entry[0] is not None:
+            if entry[0] < time.monotonic():
+                del self.__entries[key]
+                entry = None
+        if entry is None:
+            self.__misses += 1
+            return None
+        self.__entries.move_to_end(key)
+        self.__hits += 1
+        return entry[1]
+
+    def put(self, key, raw_payload: bytes):
+        """
+        Store the serialized return value of a call
+        """
+        expiry = None
+        if self.__ttl is not None:
+            expiry = time.monotonic() + self.__ttl
+        self.__entries[key] = (expiry, raw_payload)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.__max_entries:
+            self.__entries.popitem(last=False)
+
+    def invalidate(self):
+        """
+        Drop all entries
+        """
+        self.__entries.clear()
+
+    def stats(self):
+        return {'hits': self.__hits,
+                'misses': self.__misses,
+                'entries': len(self.__entries)}
@@ -1,29 +1,170 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from functools import partial
+from itertools import count
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client as connect_listener
+from multiprocessing.connection import Listener
+from multiprocessing.connection import wait as wait_connections
+from queue import Full
 from queue import Queue
+from threading import BoundedSemaphore
 from threading import Lock
+from threading import Thread
+from weakref import WeakValueDictionary
 
 from ipcbroker.broker import Broker
+from ipcbroker.cache import check_cache
+from ipcbroker.connection import MessageConnection
+from ipcbroker.executor import ExecutorPool
+from ipcbroker.executor import FunctionExecutor
+from ipcbroker.executor import call_each
+from ipcbroker.executor import check_executor
+from ipcbroker.message import Flag
 from ipcbroker.message import Message
+from ipcbroker.message import Priority
+from ipcbroker.sharedmem import SharedPayload
+from ipcbroker.sharedmem import discard
+from ipcbroker.sharedmem import get_pool
+from ipcbroker.stats import CallStats
+from ipcbroker.stream import StreamCredits
+from ipcbroker.stream import StreamProxy
 from ipcbroker.threaded import Threaded
+from ipcbroker.transport import RemoteBroker
+from ipcbroker.transport import close_listener
+
+
+class CallProxy:
+    """
+    Map attribute access to a call function of a client
+
+    ``proxy.add(1, 2)`` becomes ``call('add', 1, 2)``.
+    """
+    def __init__(self, call):
+        self.__call = call
+
+    def __getattr__(self, item):
+        return partial(self.__call, item)
+
+    def __call__(self, name, *args, **kwargs):
+        return self.__call(name, *args, **kwargs)
 
 
 class Client(Threaded):
     POLL_TIMEOUT = 0.1
+    # cancellations remembered for requests that are still queued
+    MAX_CANCELLED = 1024
+    # messages read per iteration of the worker
+    MAX_BATCH = 64
+    OVERFLOW = ('block', 'fail')
+    # items a stream producer may send ahead of the consumer
+    STREAM_WINDOW = 16
+    # seconds a stream producer waits for credits of the consumer
+    STREAM_TIMEOUT = 300
 
     def __init__(self,
                  broker: Broker,
-                 name=None):
+                 name=None,
+                 shared_memory_threshold=None,
+                 executor=None,
+                 max_workers=None,
+                 timeout=None,
+                 max_in_flight=None,
+                 overflow='block',
+                 tracer=None):
+        """
+        :param broker: the broker to connect to, a Broker, a
+                       RemoteBroker listening on a socket or a connection
+                       Broker.register_client() returned, e.g. in another
+                       process
+        :param name: name of the worker thread
+        :param shared_memory_threshold: buffers of at least this many
+                                        bytes in arguments and return
+                                        values are passed in shared memory
+        :param executor: default executor of registered functions, see
+                         register_function()
+        :param max_workers: size of the thread and process pool
+        :param timeout: default timeout of remote calls in seconds, None
+                        to wait for ever
+        :param max_in_flight: maximum number of requests waiting for their
+                              return message, None for no limit
+        :param overflow: what a request above max_in_flight does: 'block'
+                         until an answer arrives or 'fail' with queue.Full
+        :param tracer: Tracer sampling the remote calls of the client,
+                       None for no tracing
+        """
         if name is None:
             super().__init__()
         else:
             super().__init__(name)
-        if not isinstance(broker, Broker):
+        if not isinstance(broker, (Broker, RemoteBroker, MessageConnection)):
             raise TypeError('broker is not a Broker: {}'.format(type(broker)))
+        check_executor(executor)
+        if overflow not in self.OVERFLOW:
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
 
-        self.__broker_con = broker.register_client()
+        if isinstance(broker, MessageConnection):
+            self.__broker_con = broker
+        else:
+            self.__broker_con = broker.register_client()
+        self.__connected = True
+        self.__com_ids = count()
         self.__message_queue = Queue()
         self.__registered_funcs = dict()
+        self.__function_executors = dict()
+        # topic -> callbacks
+        self.__subscriptions = dict()
+        self.__executor = executor
+        self.__executor_pool = ExecutorPool(max_workers)
+        # com_id -> future, action, send time and traced request (or
+        # None) of requests waiting for their return message
+        self.__pending = dict()
+        # function name -> CallStats of the round trips
+        self.__call_stats = dict()
+
+        # direct connections to other clients: all of them are read,
+        # calls of a function in peer_routes go to its connection
+        self.__peer_connections = list()
+        self.__peer_routes = dict()
+        # client id of a provider -> connection to it
+        self.__peers = dict()
+        # com_id -> connection and message of requests sent to a peer
+        self.__peer_requests = dict()
+        self.__listener = None
+        self.__listener_authkey = None
+
+        # com_id -> StreamProxy of streams this client consumes, a
+        # stream nobody iterates any more is closed when it is collected
+        self.__streams = WeakValueDictionary()
+        # com_id -> connection of the consumer and StreamCredits of
+        # streams this client produces
+        self.__producers = dict()
+        self.__shared_memory_threshold = shared_memory_threshold
+        self.__timeout = timeout
+        self.__in_flight = None
+        if max_in_flight is not None:
+            self.__in_flight = BoundedSemaphore(max_in_flight)
+        self.__overflow = overflow
+        self.__tracer = tracer
+        # com_ids of cancelled requests that were not started yet
+        self.__cancelled = OrderedDict()
+        self.__cancel_lock = Lock()
 
+        # reads the connections while the worker thread runs a function,
+        # started with the first ping of the broker
+        self.__watcher = None
+        self.__busy = False
+
+        # the connection lock guards reading, the send lock writing
         self.__connection_lock = Lock()
+        self.__send_lock = Lock()
+
+        self.__logger = logging.getLogger(__name__)
 
     def __call__(self, name, *args, **kwargs):
         if name not in self.__registered_funcs:
@@ -39,22 +180,89 @@ class Client(Threaded):
         # if not do a remote call via the broker
         return self.__remote_call(item)
 
+    @property
+    def client_id(self):
+        """
+        Id the broker assigned to this client
+        """
+        return self.__broker_con.client_id
+
+    @property
+    def futures(self):
+        """
+        Proxy for asynchronous calls
+
+        ``client.futures.add(1, 2)`` is ``client.call_async('add', 1, 2)``
+        """
+        return CallProxy(self.call_async)
+
+    @property
+    def notify(self):
+        """
+        Proxy for one-way calls
+
+        ``client.notify.log('text')`` or ``client.notify('log', 'text')``
+        calls the method without waiting for it and without a return
+        message. Return values and errors of remote calls are dropped.
+        """
+        return CallProxy(self.__notify)
+
     def work(self):
-        # check if new message has arrived
+        # block until a message arrives
         try:
-            with self.__connection_lock:
-                while self.__broker_con.poll(self.POLL_TIMEOUT):
-                    message = self.__broker_con.recv()
-                    self.__message_queue.put(message)
+            if self.wait(self.__connections(), self.POLL_TIMEOUT):
+                with self.__connection_lock:
+                    # read a bounded batch without blocking
+                    for _ in range(self.MAX_BATCH):
+                        if not self.__receive(0):
+                            break
         except (EOFError, OSError):
-            pass
+            with self.__connection_lock:
+                self.__disconnected()
 
         # process messages in message queue
+        self.__busy = True
         while not self.__message_queue.empty():
-            message = self.__message_queue.get()
-            self.__process_message(message)
+            connection, message = self.__message_queue.get()
+            self.__process_message(connection, message)
+        self.__busy = False
+
+    def register_function(self,
+                          name,
+                          callback,
+                          long_running=False,
+                          executor=None,
+                          max_concurrency=None,
+                          cacheable=False,
+                          ttl=None,
+                          max_entries=128,
+                          priority=None,
+                          coalesce=False):
+        """
+        Register a function at the broker
 
-    def register_function(self, name, callback, long_running=False):
+        :param name: name of the function
+        :param callback: the function
+        :param long_running: the function takes a long time, it runs on
+                             the thread pool unless an executor is given
+        :param executor: where calls run: 'inline' on the worker thread,
+                         'thread' or 'process' on the pool of the client
+                         or a concurrent.futures.Executor; defaults to
+                         the executor of the client. Calls that do not
+                         run inline are answered as they complete.
+        :param max_concurrency: maximum number of calls running at once
+        :param cacheable: the function is pure, the broker may answer
+                          repeated calls from its cache
+        :param ttl: seconds a cached result stays valid, None for ever
+        :param max_entries: maximum number of cached results
+        :param priority: Priority of calls that do not have one, e.g.
+                         Priority.LOW for bulk work
+        :param coalesce: the function is pure, a call arriving while an
+                         identical call is in flight is answered with the
+                         result of that call instead of calling the
+                         function again
+        :return: True if the function was registered
+        """
         # check if the function is already locally registered
         if name in self.__registered_funcs:
             raise KeyError('Function already locally registered')
@@ -63,32 +271,387 @@ class Client(Threaded):
         if not callable(callback):
             raise TypeError('Callback is not callable')
 
-        with self.__connection_lock:
-            if long_running:
-                message = Message('register_function',
-                                  name,
-                                  flags=['long_running'])
-            else:
-                message = Message('register_function',
-                                  name)
-            # send register request to broker
-            self.__broker_con.send(message)
-
-            # wait for response
-            return_message = self.__broker_con.recv()
-            while (
-                return_message.com_id != message.com_id and
-                return_message.action != 'return'
-            ):
-                self.__message_queue.put(return_message)
-                return_message = self.__broker_con.recv()
-
-            # if response says OK return True otherwise False
-            if return_message.payload == 'OK':
-                self.__registered_funcs[name] = callback
-                return True
-            else:
+        if executor is None:
+            executor = self.__executor
+        if executor is None and long_running:
+            executor = 'thread'
+        check_executor(executor)
+
+        options = {'name': name}
+        if priority is not None:
+            options['priority'] = int(Priority(priority))
+        if coalesce:
+            options['coalesce'] = True
+        if cacheable:
+            check_cache(ttl, max_entries)
+            options['cache'] = {'ttl': ttl,
+                                'max_entries': max_entries}
+        if long_running:
+            message = Message('register_function',
+                              options,
+                              self.__next_com_id(),
+                              Flag.LONG_RUNNING)
+        else:
+            message = Message('register_function',
+                              options,
+                              self.__next_com_id())
+
+        # register locally first, calls may arrive right after the
+        # broker accepted the function
+        self.__registered_funcs[name] = callback
+        self.__function_executors[name] = FunctionExecutor(executor,
+                                                           max_concurrency)
+
+        # send register request to broker and wait for response
+        try:
+            return_value = self.__wait(self.__send_request(message))
+        except KeyError:
+            return_value = None
+
+        # if response says OK return True otherwise False
+        if return_value == 'OK':
+            return True
+        del self.__registered_funcs[name]
+        del self.__function_executors[name]
+        return False
+
+    def stop(self):
+        super().stop()
+        self.__cancel_producers()
+        self.__executor_pool.shutdown()
+        self.__close_listener()
+        return self
+
+    def close(self):
+        """
+        Disconnect from the broker, it forgets the functions and
+        subscriptions of the client
+
+        The worker thread has to be stopped before.
+        """
+        if self.__connected:
+            try:
+                self.__send(Message('close', None, self.__next_com_id()))
+            except (EOFError, OSError):
+                pass
+            self.__connected = False
+        self.__broker_con.close()
+
+    def listen(self):
+        """
+        Accept direct connections from other clients
+
+        The address of the listener is announced to the broker, clients
+        calling connect_peer() for a function of this client connect to
+        it. Requests arriving on direct connections are answered on them.
+
+        :return: the address of the listener
+        """
+        if self.__listener is not None:
+            return self.__listener.address
+        authkey = os.urandom(32)
+        listener = Listener(authkey=authkey)
+        self.__listener = listener
+        self.__listener_authkey = authkey
+        Thread(target=self.__accept, args=(listener,), daemon=True).start()
+        message = Message('__peer__',
+                          {'address': listener.address,
+                           'authkey': authkey,
+                           'compact': self.__broker_con.compact},
+                          self.__next_com_id())
+        self.__wait(self.__send_request(message))
+        return listener.address
+
+    def stop_listening(self):
+        """
+        Withdraw the listener from the broker and close the direct
+        connections accepted on it
+
+        The callers fall back to calls through the broker.
+        """
+        if self.__listener is None:
+            return
+        self.__wait(self.__send_request(Message('__peer__',
+                                                None,
+                                                self.__next_com_id())))
+        self.__close_listener()
+
+    def connect_peer(self, name):
+        """
+        Send the calls of a function directly to one of its providers
+
+        The broker looks up a provider that listens for direct
+        connections. Calls then skip the broker: they are not cached,
+        limited, timed out or counted there. If the connection breaks,
+        calls fall back to the broker and requests that were not answered
+        yet are sent again through it.
+
+        :param name: name of the function
+        :return: True if calls go directly to a provider
+        """
+        message = Message('__lookup__', name, self.__next_com_id())
+        peer = self.__wait(self.__send_request(message))
+        if peer is None:
+            return False
+        connection = self.__peers.get(peer['client_id'])
+        if connection is None:
+            try:
+                connection = MessageConnection(
+                    connect_listener(peer['address'],
+                                     authkey=peer['authkey']),
+                    peer['compact'],
+                    self.__broker_con.client_id,
+                    self.__broker_con.compression,
+                    self.__broker_con.compression_threshold)
+            except (EOFError, OSError, AuthenticationError):
                 return False
+            self.__peers[peer['client_id']] = connection
+            self.__peer_connections.append(connection)
+            self.wakeup()
+        self.__peer_routes[name] = connection
+        return True
+
+    def stats(self):
+        """
+        Snapshot of the metrics of the client
+
+        :return: dict with the keys 'functions' (name -> calls, errors
+                 and round trip latency histogram of remote calls),
+                 'in_flight' (requests waiting for their return message),
+                 'queued' (requests received but not started) and
+                 'connection' (bytes and messages moved)
+        """
+        return {'functions': {name: call_stats.snapshot()
+                              for name, call_stats
+                              in list(self.__call_stats.items())},
+                'in_flight': len(self.__pending),
+                'queued': self.__message_queue.qsize(),
+                'connection': self.__broker_con.stats()}
+
+    def broker_stats(self):
+        """
+        Snapshot of the metrics of the broker, see Broker.stats()
+        """
+        message = Message('__stats__', None, self.__next_com_id())
+        return self.__wait(self.__send_request(message))
+
+    def call(self, name, *args, timeout=None, priority=None, **kwargs):
+        """
+        Call a method and wait for the result
+
+        The timeout travels with the request, the broker answers with a
+        TimeoutError once it passed and cancels the call at the provider
+        if it did not start yet.
+
+        :param name: name of the method
+        :param timeout: seconds to wait, defaults to the timeout of the
+                        client
+        :param priority: Priority of the call at the broker, defaults to
+                         the priority of the function
+        :return: the return value
+        """
+        if name in self.__registered_funcs:
+            return self.__registered_funcs[name](*args, **kwargs)
+        if timeout is None:
+            timeout = self.__timeout
+
+        message = self.__message(name,
+                                 {'args': args,
+                                  'kwargs': kwargs},
+                                 self.__next_com_id(),
+                                 timeout=timeout,
+                                 priority=priority)
+        return self.__wait(self.__send_request(message), timeout)
+
+    def stream(self, name, *args, window=None, timeout=None, **kwargs):
+        """
+        Iterate over the items of a remote generator or iterator
+
+        The provider sends the items one by one as the function produces
+        them, at most window items ahead of the consumer. The stream
+        runs on the thread pool of the provider.
+
+        :param name: name of the method
+        :param window: items the provider may send ahead, defaults to
+                       STREAM_WINDOW
+        :param timeout: seconds the whole stream may take, defaults to the
+                        timeout of the client
+        :return: an iterator over the items, close() stops the stream
+        """
+        if name in self.__registered_funcs:
+            return iter(self.__registered_funcs[name](*args, **kwargs))
+        if window is None:
+            window = self.STREAM_WINDOW
+        if timeout is None:
+            timeout = self.__timeout
+
+        com_id = self.__next_com_id()
+        message = self.__message(name,
+                                 {'args': args,
+                                  'kwargs': kwargs,
+                                  'window': window},
+                                 com_id,
+                                 Flag.STREAM,
+                                 timeout)
+        future = Future()
+        stream = StreamProxy(future,
+                             window,
+                             partial(self.__acknowledge, com_id),
+                             self.__pump)
+        # register before sending, the items may arrive immediately
+        self.__streams[com_id] = stream
+        try:
+            self.__send_request(message, future)
+        except Exception:
+            del self.__streams[com_id]
+            raise
+        return stream
+
+    def call_async(self, name, *args, **kwargs):
+        """
+        Call a method without waiting for the result
+
+        Any number of calls can be in flight at the same time. The
+        returned future is resolved by the worker thread, so the client
+        has to be started (or work() has to be called) for it to finish.
+        Cancelling the future cancels the call at the provider if it did
+        not start yet.
+
+        :param name: name of the method
+        :return: a concurrent.futures.Future for the return value
+        """
+        if name in self.__registered_funcs:
+            future = Future()
+            try:
+                func = self.__registered_funcs[name]
+                future.set_result(func(*args, **kwargs))
+            except Exception as exception:
+                future.set_exception(exception)
+            return future
+
+        message = self.__message(name,
+                                 {'args': args,
+                                  'kwargs': kwargs},
+                                 self.__next_com_id(),
+                                 timeout=self.__timeout)
+        return self.__send_request(message)
+
+    def call_many(self, name, iterable_of_args, priority=None, **kwargs):
+        """
+        Call a method once per argument tuple in a single round trip
+
+        All calls travel as one batch message and are executed in order
+        by the provider.
+
+        :param name: name of the method
+        :param iterable_of_args: argument tuples, one per call
+        :param priority: Priority of the batch at the broker, defaults to
+                         the priority of the function
+        :param kwargs: keyword arguments passed to every call
+        :return: list of the return values, a call that raised has its
+                 exception in place of the return value
+        """
+        args = [tuple(item) for item in iterable_of_args]
+        if name in self.__registered_funcs:
+            return call_each(self.__registered_funcs[name], args, kwargs)
+
+        message = self.__message(name,
+                                 {'args': args,
+                                  'kwargs': kwargs},
+                                 self.__next_com_id(),
+                                 Flag.BATCH,
+                                 self.__timeout,
+                                 priority)
+        return self.__wait(self.__send_request(message), self.__timeout)
+
+    def map(self, name, *iterables):
+        """
+        Like the builtin map() with a method, but all calls are sent in
+        one batch
+
+        :param name: name of the method
+        :param iterables: iterables with the arguments
+        :return: list of the return values
+        """
+        results = self.call_many(name, zip(*iterables))
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def invalidate_cache(self, name=None):
+        """
+        Drop the results the broker cached for a function
+
+        :param name: name of the function, None for all functions
+        """
+        message = Message('invalidate', name, self.__next_com_id())
+        self.__wait(self.__send_request(message))
+
+    def subscribe(self, topic, callback):
+        """
+        Subscribe to a topic
+
+        The callback is called on the worker thread with the payload of
+        every message published to the topic.
+
+        :param topic: name of the topic
+        :param callback: function taking the payload
+        :return: True if subscribed
+        """
+        if not callable(callback):
+            raise TypeError('Callback is not callable')
+
+        callbacks = self.__subscriptions.setdefault(topic, list())
+        callbacks.append(callback)
+        if len(callbacks) > 1:
+            # the broker knows the topic already
+            return True
+        message = Message('subscribe', topic, self.__next_com_id())
+        if self.__wait(self.__send_request(message)) == 'OK':
+            return True
+        self.__subscriptions.pop(topic)
+        return False
+
+    def unsubscribe(self, topic, callback=None):
+        """
+        Remove a callback or all callbacks of a topic
+
+        :param topic: name of the topic
+        :param callback: the callback to remove, None removes all
+        """
+        callbacks = self.__subscriptions.get(topic, list())
+        if callback is not None and callback in callbacks:
+            callbacks.remove(callback)
+        if callback is None or not callbacks:
+            self.__subscriptions.pop(topic, None)
+            message = Message('unsubscribe', topic, self.__next_com_id())
+            self.__wait(self.__send_request(message))
+
+    def publish(self, topic, payload):
+        """
+        Publish a payload to all subscribers of a topic
+
+        :param topic: name of the topic
+        :param payload: the payload
+        """
+        message = Message(topic,
+                          payload,
+                          self.__next_com_id(),
+                          Flag.PUBLISH)
+        self.__send(message)
+
+    def __notify(self, name, *args, **kwargs):
+        if name in self.__registered_funcs:
+            self.__registered_funcs[name](*args, **kwargs)
+            return
+
+        message = self.__message(name,
+                                 {'args': args,
+                                  'kwargs': kwargs},
+                                 self.__next_com_id(),
+                                 Flag.NO_REPLY)
+        self.__route(message)
 
     def __remote_call(self, name):
         """
@@ -103,62 +666,672 @@ class Client(Threaded):
             payload_dict = {'args': args,
                             'kwargs': kwargs}
 
+            # send request to broker and wait for the payload
+            message = self.__message(name,
+                                     payload_dict,
+                                     self.__next_com_id(),
+                                     timeout=self.__timeout)
+            return self.__wait(self.__send_request(message), self.__timeout)
+        return func
+
+    def __next_com_id(self):
+        # unique per broker: the client id followed by a counter
+        return ((self.__broker_con.client_id << 32) |
+                (next(self.__com_ids) & 0xffffffff))
+
+    def __message(self,
+                  action,
+                  payload,
+                  com_id,
+                  flags=Flag.NONE,
+                  timeout=None,
+                  priority=None,
+                  trace=None):
+        """
+        Create a message, large buffers of the payload are moved to
+        shared memory if enabled. Calls the tracer samples are traced.
+
+        :return: the message
+        """
+        if (
+            self.__tracer is not None and
+            action not in Message.ACTIONS and
+            not flags & (Flag.NO_REPLY | Flag.PUBLISH | Flag.STREAM) and
+            self.__tracer.sample()
+        ):
+            flags |= Flag.TRACED
+        if self.__shared_memory_threshold is None:
+            message = Message(action, payload, com_id, flags, timeout,
+                              priority, trace)
+        else:
+            raw, shared = get_pool().dumps(payload,
+                                           self.__shared_memory_threshold)
+            if shared:
+                flags |= Flag.SHARED_MEMORY
+            message = Message.from_raw(action,
+                                       raw,
+                                       com_id,
+                                       flags,
+                                       timeout,
+                                       priority,
+                                       trace)
+        if action != 'return':
+            message.stamp('call')
+        return message
+
+    @staticmethod
+    def __payload(message: Message):
+        """
+        Payload of a message with buffers restored from shared memory
+
+        :return: the payload
+        """
+        payload = message.payload
+        if isinstance(payload, SharedPayload):
+            payload = get_pool().loads(payload)
+        return payload
+
+    def __send_request(self, message: Message, future=None):
+        """
+        Send a message and register a future for its return message
+
+        :param message: the request
+        :param future: the future to resolve, a new one if None
+        :return: future resolved with the return payload
+        """
+        self.__acquire_slot()
+        if future is None:
+            future = Future()
+        # register before sending, the answer may arrive immediately
+        self.__pending[message.com_id] = (future,
+                                          message.action,
+                                          time.monotonic(),
+                                          message if message.traced
+                                          else None)
+        try:
+            self.__route(message)
+        except Exception:
+            del self.__pending[message.com_id]
+            self.__release_slot()
+            raise
+        future.add_done_callback(partial(self.__abandon, message.com_id))
+        return future
+
+    def __route(self, message: Message):
+        """
+        Send a request directly to a peer or through the broker
+        """
+        peer = self.__peer_routes.get(message.action)
+        if peer is None:
+            self.__send(message)
+            return
+        if not message.flags & Flag.NO_REPLY:
+            self.__peer_requests[message.com_id] = (peer, message)
+        message.stamp('send')
+        try:
+            peer.send(message)
+        except (EOFError, OSError):
+            # sends the request again through the broker
+            self.__drop_peer(peer)
+
+    def __acquire_slot(self):
+        """
+        Take one of the max_in_flight slots for a request
+        """
+        if self.__in_flight is None:
+            return
+        if self.__overflow == 'fail':
+            if not self.__in_flight.acquire(False):
+                raise Full('Too many requests in flight')
+            return
+        while not self.__in_flight.acquire(timeout=self.POLL_TIMEOUT):
+            # nobody else reads the answers that free a slot
+            if not self.is_alive() or self.is_worker_thread():
+                with self.__connection_lock:
+                    self.__receive(self.POLL_TIMEOUT)
+
+    def __release_slot(self):
+        if self.__in_flight is not None:
+            self.__in_flight.release()
+
+    def __abandon(self, com_id, future: Future):
+        """
+        Tell the broker about a cancelled future
+        """
+        if not future.cancelled():
+            return
+        if self.__pending.pop(com_id, None) is not None:
+            self.__release_slot()
+        self.__streams.pop(com_id, None)
+        self.__control(Message('cancel', None, com_id))
+        self.__peer_requests.pop(com_id, None)
+
+    def __acknowledge(self, com_id, consumed):
+        """
+        Give the producer of a stream credits for consumed items
+        """
+        self.__control(Message('__credit__', consumed, com_id))
+
+    def __control(self, message: Message):
+        """
+        Send a message about a request where the request went
+        """
+        peer, _ = self.__peer_requests.get(message.com_id, (None, None))
+        try:
+            if peer is None:
+                self.__send(message)
+            else:
+                peer.send(message)
+        except (EOFError, OSError):
+            pass
+
+    def __pump(self, timeout):
+        """
+        Read the connections unless the worker thread does
+
+        :return: False if the worker thread reads the connections
+        """
+        if self.is_alive() and not self.is_worker_thread():
+            return False
+        with self.__connection_lock:
+            self.__receive(timeout)
+        return True
+
+    def __wait(self, future: Future, timeout=None):
+        """
+        Wait for a future of a request and return its result
+
+        If the worker thread is running it resolves the future, otherwise
+        (or if called from within the worker thread) the connection is
+        read here.
+
+        :param future: future of the request
+        :param timeout: seconds to wait, None to wait for ever
+        :return: the return value of the remote method
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while not future.done():
+            poll_timeout = self.POLL_TIMEOUT
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if future.cancel():
+                        raise TimeoutError('Call timed out')
+                    break
+                poll_timeout = min(poll_timeout, remaining)
+            if self.is_alive() and not self.is_worker_thread():
+                wait([future], poll_timeout)
+                continue
             with self.__connection_lock:
-                # send request to broker
-                message = Message(name,
-                                  payload_dict)
-                self.__broker_con.send(message)
+                if not future.done():
+                    self.__receive(poll_timeout)
+        return future.result()
 
-                # wait for response
-                return_message = self.__broker_con.recv()
-                while (
-                    return_message.action != 'return' and
-                    return_message.com_id != message.com_id
-                ):
-                    self.__message_queue.put(return_message)
-                    return_message = self.__broker_con.recv()
-
-                # return the payload
-                return return_message.payload
-        return func
+    def __connections(self):
+        """
+        The connections to read: the broker and the peers
+        """
+        connections = list(self.__peer_connections)
+        if self.__connected:
+            connections.append(self.__broker_con)
+        return connections
+
+    def __receive(self, timeout):
+        """
+        Receive one message from every readable connection
+
+        Return messages of pending requests resolve their future, all
+        other messages are queued for the worker. The connection lock
+        has to be held by the caller.
+
+        :param timeout: time to wait for a message
+        :return: True if a message was received
+        """
+        if not self.__peer_connections and self.__connected:
+            try:
+                if not self.__broker_con.poll(timeout):
+                    return False
+                message = self.__broker_con.recv()
+            except (EOFError, OSError):
+                self.__disconnected()
+                return False
+            self.__handle(self.__broker_con, message)
+            return True
+
+        ready = wait_connections(self.__connections(), timeout)
+        for connection in ready:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                if connection is self.__broker_con:
+                    self.__disconnected()
+                else:
+                    self.__drop_peer(connection)
+                continue
+            self.__handle(connection, message)
+        return bool(ready)
+
+    def __disconnected(self):
+        """
+        The broker is gone, fail the calls waiting for it, the connection
+        lock has to be held
+
+        Calls sent directly to a peer go on.
+        """
+        if not self.__connected:
+            return
+        self.__connected = False
+        self.__cancel_producers(self.__broker_con)
+        exception = ConnectionError('Connection to the broker lost')
+        for com_id in list(self.__pending):
+            if com_id not in self.__peer_requests:
+                self.__handle(self.__broker_con,
+                              Message('return', exception, com_id))
+
+    def __handle(self, connection: MessageConnection, message: Message):
+        """
+        Resolve the future of a return message or queue a request
+        """
+        if message.action == 'return':
+            if message.flags & Flag.STREAM:
+                stream = self.__streams.get(message.com_id)
+                if stream is not None:
+                    stream.put(self.__payload(message))
+                else:
+                    discard(message)
+                return
+            request = self.__pending.pop(message.com_id, None)
+            if request is None:
+                # late answer of a cancelled request
+                discard(message)
+                return
+            self.__peer_requests.pop(message.com_id, None)
+            future, action, sent, traced = request
+            self.__release_slot()
+            if action not in Message.ACTIONS:
+                call_stats = self.__call_stats.get(action)
+                if call_stats is None:
+                    call_stats = self.__call_stats[action] = CallStats()
+                call_stats.record(time.monotonic() - sent,
+                                  bool(message.flags & Flag.ERROR))
+            if traced is not None:
+                self.__record_trace(traced, message)
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.__payload(message))
+                except Exception as exception:
+                    future.set_exception(exception)
+            else:
+                discard(message)
+            stream = self.__streams.pop(message.com_id, None)
+            if stream is not None:
+                stream.end()
+        elif message.action == 'cancel':
+            self.__cancel(message.com_id)
+        elif message.action == '__ping__':
+            self.__send(Message('return', None, message.com_id))
+            if self.__watcher is None and self.is_alive():
+                self.__watcher = Thread(target=self.__watch, daemon=True)
+                self.__watcher.start()
+        elif message.action == '__credit__':
+            producer = self.__producers.get(message.com_id)
+            if producer is not None:
+                producer[1].give(message.payload)
+        else:
+            message.stamp('provider_receive')
+            self.__message_queue.put((connection, message))
+
+    def __record_trace(self, request: Message, message: Message):
+        """
+        Pass the trace of a finished call to the tracer
+
+        :param request: the traced request
+        :param message: its return message
+        """
+        stamps = message.trace or list()
+        if not stamps or stamps[0][0] != 'call':
+            # the provider did not send the trace of the request back,
+            # e.g. an answer from the cache of the broker
+            stamps = request.trace + stamps
+        stamps.append(('receive', time.monotonic()))
+        self.__tracer.record(request.action, request.com_id, stamps)
+
+    def __watch(self):
+        """
+        Read the connections while the worker thread runs functions
+
+        Pings are answered and requests are queued even if a function
+        runs inline for longer than the broker waits for a heartbeat. A
+        client whose worker thread is stopped does not answer.
+        """
+        while self.is_alive():
+            if not self.__busy:
+                time.sleep(self.POLL_TIMEOUT)
+                continue
+            with self.__connection_lock:
+                try:
+                    received = self.__receive(self.POLL_TIMEOUT)
+                except (EOFError, OSError):
+                    return
+            if received:
+                # the worker may wait for the message read here
+                self.wakeup()
+
+    def __accept(self, listener: Listener):
+        """
+        Accept direct connections until the listener is closed
+        """
+        while True:
+            try:
+                connection = listener.accept()
+            except (EOFError, OSError, AuthenticationError):
+                if self.__listener is not listener:
+                    return
+                continue
+            if self.__listener is not listener:
+                # woken up by __close_listener()
+                connection.close()
+                return
+            self.__peer_connections.append(
+                MessageConnection(connection,
+                                  self.__broker_con.compact,
+                                  self.__broker_con.client_id,
+                                  self.__broker_con.compression,
+                                  self.__broker_con.compression_threshold))
+            self.wakeup()
+
+    def __close_listener(self):
+        """
+        Close the listener and the connections accepted on it
+        """
+        listener = self.__listener
+        if listener is None:
+            return
+        self.__listener = None
+        close_listener(listener)
+        outgoing = list(self.__peers.values())
+        for connection in list(self.__peer_connections):
+            if connection not in outgoing:
+                self.__peer_connections.remove(connection)
+                connection.close()
+
+    def __drop_peer(self, connection: MessageConnection):
+        """
+        Forget a broken direct connection, its unanswered requests are
+        sent again through the broker
+        """
+        if connection in self.__peer_connections:
+            self.__peer_connections.remove(connection)
+        for client_id, peer in list(self.__peers.items()):
+            if peer is connection:
+                del self.__peers[client_id]
+        for name, peer in list(self.__peer_routes.items()):
+            if peer is connection:
+                del self.__peer_routes[name]
+        try:
+            connection.close()
+        except OSError:
+            pass
+        self.__cancel_producers(connection)
+        for com_id, (peer, message) in list(self.__peer_requests.items()):
+            if peer is connection:
+                del self.__peer_requests[com_id]
+                if message.flags & Flag.STREAM:
+                    # items were delivered already, a stream can not
+                    # start over
+                    exception = ConnectionError('Peer connection lost')
+                    self.__handle(connection,
+                                  Message('return', exception, com_id))
+                else:
+                    try:
+                        self.__send(message)
+                    except ConnectionError as exception:
+                        self.__handle(connection,
+                                      Message('return', exception, com_id))
+
+    def __cancel(self, com_id):
+        """
+        Drop a request of the broker that did not start yet, or stop a
+        stream
+        """
+        producer = self.__producers.get(com_id)
+        if producer is not None:
+            producer[1].cancel()
+            return
+        for function_executor in list(self.__function_executors.values()):
+            if function_executor.cancel(com_id):
+                return
+        # the request may still be queued for the worker
+        with self.__cancel_lock:
+            self.__cancelled[com_id] = None
+            while len(self.__cancelled) > self.MAX_CANCELLED:
+                self.__cancelled.popitem(last=False)
+
+    def __is_cancelled(self, com_id):
+        with self.__cancel_lock:
+            if com_id not in self.__cancelled:
+                return False
+            del self.__cancelled[com_id]
+            return True
+
+    def __send(self, message: Message):
+        """
+        Send a message to the broker
+
+        :raises ConnectionError: if the connection to the broker is lost
+        """
+        with self.__send_lock:
+            if not self.__connected:
+                raise ConnectionError('Connection to the broker lost')
+            if message.action != 'return':
+                message.stamp('send')
+            try:
+                self.__broker_con.send(message)
+            except (EOFError, OSError) as exception:
+                raise ConnectionError(
+                    'Connection to the broker lost') from exception
 
     def __process_message(self,
+                          connection: MessageConnection,
                           message: Message):
+        if message.flags & Flag.PUBLISH:
+            self.__deliver(message)
+            return
+        if self.__is_cancelled(message.com_id):
+            discard(message)
+            return
+
         # check if the message payload is dict with arguments
         # args and kwargs
         # if not required use empty dict
-        if not isinstance(message.payload, dict):
+        payload = self.__payload(message)
+        if not isinstance(payload, dict):
             exc = TypeError('Payload is not argument dict')
-            return_message = Message('return',
-                                     exc,
-                                     message.com_id)
-            self.__broker_con.send(return_message)
+            self.__reply(connection, message, self.__failed(exc))
             return
 
         # check if requested method is registered
         if message.action not in self.__registered_funcs:
             exc = KeyError('Function not known')
-            return_message = Message('return',
-                                     exc,
-                                     message.com_id)
-            self.__broker_con.send(return_message)
+            self.__reply(connection, message, self.__failed(exc))
             return
 
         # if args not in payload dict add it
-        if 'args' not in message.payload:
-            message.payload['args'] = tuple()
+        if 'args' not in payload:
+            payload['args'] = tuple()
 
         # if kwargs not in payload dict add it
-        if 'kwargs' not in message.payload:
-            message.payload['kwargs'] = dict()
-
-        # call method
-        action_func = getattr(self, message.action)
-        return_value = action_func(*message.payload['args'],
-                                   **message.payload['kwargs'])
-
-        # and return result
-        return_message = Message('return',
-                                 return_value,
-                                 message.com_id)
-        self.__broker_con.send(return_message)
+        if 'kwargs' not in payload:
+            payload['kwargs'] = dict()
+
+        # call method, once per argument tuple for a batch
+        function_executor = self.__function_executors[message.action]
+        executor = self.__executor_pool.get(function_executor.executor)
+        action_func = self.__registered_funcs[message.action]
+        run_each = call_each
+        if message.traced:
+            if isinstance(executor, ProcessPoolExecutor):
+                # a wrapper can not be pickled, the handler span includes
+                # the way to the process and back
+                message.stamp('handler_start')
+            elif message.flags & Flag.BATCH:
+                run_each = partial(self.__traced, message, call_each)
+            else:
+                action_func = partial(self.__traced, message, action_func)
+        if message.flags & Flag.STREAM:
+            credits = StreamCredits(payload.get('window',
+                                                self.STREAM_WINDOW))
+            self.__producers[message.com_id] = (connection, credits)
+            function_executor.submit(self.__executor_pool.get('thread'),
+                                     self.__produce,
+                                     (connection,
+                                      message,
+                                      credits,
+                                      action_func,
+                                      payload['args'],
+                                      payload['kwargs']),
+                                     dict(),
+                                     partial(self.__reply,
+                                             connection,
+                                             message),
+                                     message.com_id)
+        elif message.flags & Flag.BATCH:
+            function_executor.submit(executor,
+                                     run_each,
+                                     (action_func,
+                                      payload['args'],
+                                      payload['kwargs']),
+                                     dict(),
+                                     partial(self.__reply,
+                                             connection,
+                                             message),
+                                     message.com_id)
+        else:
+            function_executor.submit(executor,
+                                     action_func,
+                                     payload['args'],
+                                     payload['kwargs'],
+                                     partial(self.__reply,
+                                             connection,
+                                             message),
+                                     message.com_id)
+
+    def __cancel_producers(self, connection=None):
+        """
+        Stop the streams produced for a connection that is gone
+
+        :param connection: the connection, None for all streams
+        """
+        for consumer, credits in list(self.__producers.values()):
+            if connection is None or consumer is connection:
+                credits.cancel()
+
+    def __produce(self,
+                  connection: MessageConnection,
+                  message: Message,
+                  credits: StreamCredits,
+                  func,
+                  args,
+                  kwargs):
+        """
+        Send the items of a generator function as stream messages, the
+        return message sent afterwards ends the stream
+        """
+        send = self.__sender(connection)
+        try:
+            iterator = iter(func(*args, **kwargs))
+            try:
+                for item in iterator:
+                    if not credits.take(self.STREAM_TIMEOUT):
+                        break
+                    send(self.__message('return',
+                                        item,
+                                        message.com_id,
+                                        Flag.STREAM))
+            finally:
+                close = getattr(iterator, 'close', None)
+                if close is not None:
+                    close()
+        finally:
+            self.__producers.pop(message.com_id, None)
+
+    @staticmethod
+    def __traced(message: Message, func, *args, **kwargs):
+        """
+        Run a function and stamp its start and end on a traced request
+        """
+        message.stamp('handler_start')
+        try:
+            return func(*args, **kwargs)
+        finally:
+            message.stamp('handler_end')
+
+    def __sender(self, connection: MessageConnection):
+        """
+        Send function of a connection
+        """
+        if connection is self.__broker_con:
+            return self.__send
+        return connection.send
+
+    def __deliver(self, message: Message):
+        """
+        Pass a published message to the callbacks of its topic
+        """
+        callbacks = list(self.__subscriptions.get(message.action, list()))
+        if not callbacks:
+            return
+        payload = message.payload
+        for callback in callbacks:
+            try:
+                callback(payload)
+            except Exception:
+                self.__logger.exception('Subscriber of {} failed'.format(
+                    message.action))
+
+    @staticmethod
+    def __failed(exception):
+        future = Future()
+        future.set_exception(exception)
+        return future
+
+    def __reply(self,
+                connection: MessageConnection,
+                message: Message,
+                future: Future):
+        """
+        Send the result of a finished call back
+
+        :param connection: the connection the request came from
+        :param message: the request
+        :param future: future of the call
+        """
+        if message.flags & Flag.NO_REPLY:
+            return
+        send = self.__sender(connection)
+        trace = message.trace
+        if trace is not None and trace[-1][0] == 'handler_start':
+            trace.append(('handler_end', time.monotonic()))
+        exception = future.exception()
+        if exception is not None:
+            return_message = Message('return',
+                                     exception,
+                                     message.com_id,
+                                     trace=trace)
+        else:
+            return_message = self.__message('return',
+                                            future.result(),
+                                            message.com_id,
+                                            trace=trace)
+        return_message.stamp('reply')
+        try:
+            send(return_message)
+        except (EOFError, OSError):
+            pass
+        except Exception as exception:
+            # the return value could not be serialized
+            send(Message('return',
+                         TypeError(str(exception)),
+                         message.com_id))
@@ -0,0 +1,129 @@
+import lzma
+import zlib
+from abc import ABC
+from abc import abstractmethod
+
+# payloads smaller than this many bytes are sent as they are
+COMPRESSION_THRESHOLD = 1024
+
+
+class Codec(ABC):
+    """
+    Compression of serialized payloads
+
+    A compressed payload starts with the codec_id of its codec, so the
+    receiver finds the codec without knowing the settings of the sender.
+    Custom codecs have to be registered with register_codec() in every
+    process that receives their payloads, ids below 128 are reserved.
+    """
+    name = None
+    codec_id = None
+
+    @abstractmethod
+    def compress(self, data: bytes):
+        """
+        :param data: serialized payload
+        :return: the compressed payload
+        """
+
+    @abstractmethod
+    def decompress(self, data: bytes):
+        """
+        :param data: payload returned by compress()
+        :return: the serialized payload
+        """
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+    codec_id = 1
+
+    def __init__(self, level=6):
+        self.__level = level
+
+    def compress(self, data: bytes):
+        return zlib.compress(data, self.__level)
+
+    def decompress(self, data: bytes):
+        return zlib.decompress(data)
+
+
+class LzmaCodec(Codec):
+    name = 'lzma'
+    codec_id = 2
+
+    def __init__(self, preset=None):
+        self.__preset = preset
+
+    def compress(self, data: bytes):
+        # the connection is checked already, skip the checksum
+        return lzma.compress(data,
+                             format=lzma.FORMAT_XZ,
+                             check=lzma.CHECK_NONE,
+                             preset=self.__preset)
+
+    def decompress(self, data: bytes):
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+
+
+CODECS = {
+    'zlib': ZlibCodec(),
+    'lzma': LzmaCodec(),
+}
+# codec_id -> codec
+_CODEC_IDS = {codec.codec_id: codec for codec in CODECS.values()}
+
+
+def register_codec(codec: Codec):
+    """
+    Make a codec known by its name and id
+
+    :param codec: the Codec, it replaces a registered codec of the same
+                  name
+    """
+    if not isinstance(codec, Codec):
+        raise TypeError('codec is not a Codec: {}'.format(type(codec)))
+    if not 0 < codec.codec_id < 256:
+        raise ValueError('Codec ids are between 1 and 255')
+    registered = _CODEC_IDS.get(codec.codec_id)
+    if registered is not None and registered.name != codec.name:
+        raise ValueError('Codec id {} is taken by {}'.format(
+            codec.codec_id, registered.name))
+    CODECS[codec.name] = codec
+    _CODEC_IDS[codec.codec_id] = codec
+
+
+def get_codec(codec):
+    """
+    Get a codec by name or register a given one
+
+    :param codec: a Codec, its name in CODECS or None for no compression
+    :return: the codec or None
+    """
+    if codec is None:
+        return None
+    if isinstance(codec, str):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec: {}'.format(codec))
+        return CODECS[codec]
+    register_codec(codec)
+    return codec
+
+
+def compress(codec: Codec, raw: bytes):
+    """
+    :return: the compressed payload, prefixed with the id of the codec
+    """
+    return bytes([codec.codec_id]) + codec.compress(raw)
+
+
+def decompress(data: bytes):
+    """
+    Undo compress()
+
+    :return: the serialized payload
+    """
+    codec = _CODEC_IDS.get(data[0])
+    if codec is None:
+        raise ValueError('Unknown codec id: {}'.format(data[0]))
+    return codec.decompress(memoryview(data)[1:])
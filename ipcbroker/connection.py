@@ -0,0 +1,219 @@
+from multiprocessing.connection import Connection
+from multiprocessing.reduction import ForkingPickler
+from threading import Lock
+
+from ipcbroker.compression import COMPRESSION_THRESHOLD
+from ipcbroker.compression import compress
+from ipcbroker.compression import get_codec
+from ipcbroker.message import Flag
+from ipcbroker.message import Message
+
+
+class Compressor:
+    """
+    Compresses the payloads sent over a connection
+
+    Payloads below the threshold are sent as they are, as are payloads
+    that do not shrink below MAX_RATIO of their size. Of payloads above
+    four times SAMPLE_SIZE a sample from the middle is compressed first,
+    so incompressible data costs little. After MAX_MISSES misses in a row
+    only every PROBE_INTERVAL-th payload is tried, until one compresses
+    again. Payloads compressed by the sender pass as they are.
+    """
+    MAX_RATIO = 0.9
+    MAX_MISSES = 4
+    PROBE_INTERVAL = 16
+    SAMPLE_SIZE = 4096
+
+    def __init__(self, codec, threshold=COMPRESSION_THRESHOLD):
+        """
+        :param codec: a Codec or its name
+        :param threshold: smallest payload in bytes that is compressed
+        """
+        self.__codec = get_codec(codec)
+        self.__threshold = threshold
+        self.__misses = 0
+        self.__probe = 0
+        self.__compressed = 0
+        self.__skipped = 0
+        self.__bytes_in = 0
+        self.__bytes_out = 0
+        self.__lock = Lock()
+
+    def compress(self, message: Message):
+        """
+        :return: the message with a compressed payload, or the message
+                 itself
+        """
+        if message.flags & (Flag.COMPRESSED | Flag.SHARED_MEMORY):
+            return message
+        raw = message.raw_payload
+        if len(raw) < self.__threshold:
+            return message
+        with self.__lock:
+            if self.__misses >= self.MAX_MISSES:
+                self.__probe += 1
+                if self.__probe < self.PROBE_INTERVAL:
+                    self.__skipped += 1
+                    return message
+                self.__probe = 0
+        data = None
+        if len(raw) < 4 * self.SAMPLE_SIZE or self.__compresses(raw):
+            data = compress(self.__codec, raw)
+        with self.__lock:
+            if data is None or len(data) > len(raw) * self.MAX_RATIO:
+                self.__misses += 1
+                self.__skipped += 1
+                return message
+            self.__misses = 0
+            self.__compressed += 1
+            self.__bytes_in += len(raw)
+            self.__bytes_out += len(data)
+        return Message.from_raw(message.action,
+                                data,
+                                message.com_id,
+                                message.flags | Flag.COMPRESSED,
+                                message.timeout,
+                                message.priority,
+                                message.trace)
+
+    def __compresses(self, raw: bytes):
+        """
+        :return: True if a sample of a large payload compresses well
+        """
+        start = (len(raw) - self.SAMPLE_SIZE) // 2
+        sample = raw[start:start + self.SAMPLE_SIZE]
+        return (len(self.__codec.compress(sample)) <=
+                self.SAMPLE_SIZE * self.MAX_RATIO)
+
+    @property
+    def codec(self):
+        return self.__codec
+
+    def stats(self):
+        """
+        Payloads compressed and payloads above the threshold sent as they
+        are, bytes before and after compression and their ratio
+        """
+        with self.__lock:
+            return {'codec': self.__codec.name,
+                    'compressed': self.__compressed,
+                    'skipped': self.__skipped,
+                    'bytes_in': self.__bytes_in,
+                    'bytes_out': self.__bytes_out,
+                    'ratio': (self.__bytes_out / self.__bytes_in
+                              if self.__bytes_in else None)}
+
+
+class MessageConnection:
+    """
+    Connection that sends and receives Message objects
+
+    With compact framing a message travels as its Message.to_bytes()
+    frame, otherwise it is pickled as a whole. With a codec, large
+    payloads are compressed before they are sent.
+    """
+    def __init__(self,
+                 connection: Connection,
+                 compact=False,
+                 client_id=0,
+                 compression=None,
+                 compression_threshold=COMPRESSION_THRESHOLD):
+        """
+        :param compression: Codec or name of the codec of the payloads
+                            this end sends, None to send them as they are
+        :param compression_threshold: smallest payload in bytes that is
+                                      compressed
+        """
+        self.__connection = connection
+        self.__compact = compact
+        self.__client_id = client_id
+        self.__compression_threshold = compression_threshold
+        self.__compressor = None
+        if compression is not None:
+            self.__compressor = Compressor(compression,
+                                           compression_threshold)
+        # several threads may send on the same connection
+        self.__send_lock = Lock()
+        self.__bytes_sent = 0
+        self.__bytes_received = 0
+        self.__messages_sent = 0
+        self.__messages_received = 0
+
+    def __getstate__(self):
+        return (self.__connection, self.__compact, self.__client_id,
+                self.compression, self.__compression_threshold)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def send(self, message: Message):
+        if self.__compressor is not None:
+            message = self.__compressor.compress(message)
+        if self.__compact:
+            frame = message.to_bytes()
+        else:
+            # what Connection.send() does, but the size is counted
+            frame = ForkingPickler.dumps(message)
+        with self.__send_lock:
+            self.__connection.send_bytes(frame)
+            self.__bytes_sent += len(frame)
+            self.__messages_sent += 1
+
+    def recv(self):
+        frame = self.__connection.recv_bytes()
+        self.__bytes_received += len(frame)
+        self.__messages_received += 1
+        if self.__compact:
+            return Message.from_bytes(frame)
+        return ForkingPickler.loads(frame)
+
+    def poll(self, timeout=0.0):
+        return self.__connection.poll(timeout)
+
+    def fileno(self):
+        return self.__connection.fileno()
+
+    def close(self):
+        self.__connection.close()
+
+    @property
+    def closed(self):
+        return self.__connection.closed
+
+    @property
+    def compact(self):
+        return self.__compact
+
+    @property
+    def compression(self):
+        """
+        Codec of the payloads this end sends or None
+        """
+        if self.__compressor is None:
+            return None
+        return self.__compressor.codec
+
+    @property
+    def compression_threshold(self):
+        return self.__compression_threshold
+
+    def stats(self):
+        """
+        Bytes and messages moved over this end of the connection, and
+        the Compressor stats of the payloads it sent if it compresses
+        """
+        stats = {'bytes_sent': self.__bytes_sent,
+                 'bytes_received': self.__bytes_received,
+                 'messages_sent': self.__messages_sent,
+                 'messages_received': self.__messages_received}
+        if self.__compressor is not None:
+            stats['compression'] = self.__compressor.stats()
+        return stats
+
+    @property
+    def client_id(self):
+        """
+        Id the broker assigned to the client of this connection
+        """
+        return self.__client_id
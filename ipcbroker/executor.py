@@ -0,0 +1,171 @@
+from collections import deque
+from concurrent.futures import Executor
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+
+EXECUTORS = ('inline', 'thread', 'process')
+
+
+def call_each(func, args, kwargs):
+    """
+    Call a function once per argument tuple
+
+    :param func: the function
+    :param args: argument tuples
+    :param kwargs: keyword arguments for every call
+    :return: list of return values, exceptions in place of the return
+             value of failed calls
+    """
+    results = list()
+    for item in args:
+        try:
+            results.append(func(*item, **kwargs))
+        except Exception as exception:
+            results.append(exception)
+    return results
+
+
+def check_executor(executor):
+    """
+    Check an executor argument
+
+    :param executor: None, one of EXECUTORS or a
+                     concurrent.futures.Executor
+    """
+    if executor is None or isinstance(executor, Executor):
+        return
+    if executor not in EXECUTORS:
+        raise ValueError('Unknown executor: {}'.format(executor))
+
+
+class ExecutorPool:
+    """
+    The thread and process pool of a client, created on first use
+    """
+    def __init__(self, max_workers=None):
+        self.__max_workers = max_workers
+        self.__thread_pool = None
+        self.__process_pool = None
+        self.__lock = Lock()
+
+    def get(self, executor):
+        """
+        Resolve an executor argument
+
+        :param executor: see check_executor()
+        :return: the Executor or None to run inline
+        """
+        if executor is None or executor == 'inline':
+            return None
+        if isinstance(executor, Executor):
+            return executor
+        with self.__lock:
+            if executor == 'thread':
+                if self.__thread_pool is None:
+                    self.__thread_pool = ThreadPoolExecutor(
+                        self.__max_workers)
+                return self.__thread_pool
+            if self.__process_pool is None:
+                self.__process_pool = ProcessPoolExecutor(self.__max_workers)
+            return self.__process_pool
+
+    def shutdown(self):
+        """
+        Shut down the pools
+
+        The thread pool is not waited for. The process pool is joined
+        after its submitted calls finished, worker processes left
+        running keep the interpreter from exiting.
+        """
+        with self.__lock:
+            thread_pool = self.__thread_pool
+            process_pool = self.__process_pool
+            self.__thread_pool = None
+            self.__process_pool = None
+        if thread_pool is not None:
+            thread_pool.shutdown(wait=False)
+        if process_pool is not None:
+            process_pool.shutdown(wait=True)
+
+
+class FunctionExecutor:
+    """
+    Runs the calls of one function, with at most max_concurrency
+    calls at the same time
+
+    Calls above the limit wait in a backlog until a running call
+    finishes.
+    """
+    def __init__(self, executor=None, max_concurrency=None):
+        self.__executor = executor
+        self.__max_concurrency = max_concurrency
+        self.__running = 0
+        self.__backlog = deque()
+        self.__lock = Lock()
+
+    @property
+    def executor(self):
+        return self.__executor
+
+    def submit(self, executor: Executor, func, args, kwargs, done, key=None):
+        """
+        Run a call, done is called with the finished future
+
+        :param executor: the Executor to run the call on, None for inline
+        :param key: identifies the call for cancel()
+        """
+        with self.__lock:
+            if (
+                self.__max_concurrency is not None and
+                self.__running >= self.__max_concurrency
+            ):
+                self.__backlog.append((key,
+                                       (executor, func, args, kwargs, done)))
+                return
+            self.__running += 1
+        self.__start(executor, func, args, kwargs, done)
+
+    def cancel(self, key):
+        """
+        Drop a call that waits in the backlog
+
+        :param key: key the call was submitted with
+        :return: True if the call was dropped
+        """
+        with self.__lock:
+            for call in self.__backlog:
+                if call[0] == key:
+                    self.__backlog.remove(call)
+                    return True
+        return False
+
+    def __start(self, executor, func, args, kwargs, done):
+        if executor is None:
+            future = Future()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as exception:
+                future.set_exception(exception)
+            self.__finished(done, future)
+            return
+        try:
+            future = executor.submit(func, *args, **kwargs)
+        except Exception as exception:
+            future = Future()
+            future.set_exception(exception)
+            self.__finished(done, future)
+            return
+        future.add_done_callback(partial(self.__finished, done))
+
+    def __finished(self, done, future):
+        done(future)
+        with self.__lock:
+            if self.__backlog:
+                _, call = self.__backlog.popleft()
+            else:
+                self.__running -= 1
+                return
+        self.__start(*call)
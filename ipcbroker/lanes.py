@@ -0,0 +1,117 @@
+from collections import deque
+
+from ipcbroker.message import Priority
+
+# share of the dispatches of each Priority while all lanes are backlogged
+LANE_WEIGHTS = (16, 4, 1)
+
+
+class LaneQueue:
+    """
+    Requests waiting for a provider, one FIFO lane per Priority
+
+    The lanes are served by smooth weighted round robin: while several
+    lanes hold requests, each lane gets a share of the dispatches in
+    proportion to its weight. Higher lanes overtake lower ones, but the
+    lower ones never starve. A lane does not collect credit while it is
+    empty.
+    """
+    def __init__(self, weights=LANE_WEIGHTS):
+        """
+        :param weights: positive weight per Priority
+        """
+        if len(weights) != len(Priority):
+            raise ValueError('One weight per priority is required')
+        if any(weight <= 0 for weight in weights):
+            raise ValueError('Weights have to be positive')
+        self.__weights = tuple(weights)
+        self.__lanes = [deque() for _ in weights]
+        self.__current = [0] * len(weights)
+        self.__length = 0
+
+    def __len__(self):
+        return self.__length
+
+    def __iter__(self):
+        for lane in self.__lanes:
+            yield from lane
+
+    def append(self, item, lane=Priority.NORMAL):
+        self.__lanes[lane].append(item)
+        self.__length += 1
+
+    def peek(self):
+        """
+        :return: the item popleft() returns next
+        """
+        lane, _ = self.__next_lane()
+        return self.__lanes[lane][0]
+
+    def popleft(self):
+        """
+        Remove the next item of the lane whose turn it is
+
+        :return: the item
+        """
+        lane, total = self.__next_lane()
+        for index, queue in enumerate(self.__lanes):
+            if queue:
+                self.__current[index] += self.__weights[index]
+        self.__current[lane] -= total
+        return self.__take(lane, self.__lanes[lane].popleft())
+
+    def remove(self, item, lane=None):
+        """
+        Remove an item
+
+        :param lane: lane of the item, None to search all lanes
+        """
+        lanes = range(len(self.__lanes)) if lane is None else (lane,)
+        for index in lanes:
+            if item in self.__lanes[index]:
+                self.__lanes[index].remove(item)
+                self.__take(index, item)
+                return
+        raise ValueError('Item not queued')
+
+    def victim(self):
+        """
+        :return: the oldest item of the lowest lane and its lane, the item
+                 to drop first when the queue is full
+        """
+        for lane in reversed(range(len(self.__lanes))):
+            if self.__lanes[lane]:
+                return self.__lanes[lane][0], Priority(lane)
+        raise IndexError('Queue is empty')
+
+    def lengths(self):
+        """
+        :return: number of items per lane
+        """
+        return [len(lane) for lane in self.__lanes]
+
+    def __next_lane(self):
+        """
+        :return: the lane whose turn it is and the sum of the weights of
+                 the non empty lanes
+        """
+        best = None
+        best_current = None
+        total = 0
+        for lane, queue in enumerate(self.__lanes):
+            if not queue:
+                continue
+            total += self.__weights[lane]
+            current = self.__current[lane] + self.__weights[lane]
+            if best is None or current > best_current:
+                best = lane
+                best_current = current
+        if best is None:
+            raise IndexError('Queue is empty')
+        return best, total
+
+    def __take(self, lane, item):
+        self.__length -= 1
+        if not self.__lanes[lane]:
+            self.__current[lane] = 0
+        return item
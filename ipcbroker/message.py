@@ -1,37 +1,245 @@
+import pickle
 import random
-import string
+import struct
+import time
+from enum import IntEnum
+from enum import IntFlag
+
+from ipcbroker.compression import decompress
+
+
+class Flag(IntFlag):
+    NONE = 0
+    LONG_RUNNING = 1
+    # the payload is an exception
+    ERROR = 2
+    # the payload holds the arguments of several calls
+    BATCH = 4
+    # the caller does not expect a return message
+    NO_REPLY = 8
+    # the action is a topic, the message goes to all its subscribers
+    PUBLISH = 16
+    # buffers of the payload are in shared memory segments
+    SHARED_MEMORY = 32
+    # a request asking for the items of an iterator, or a return message
+    # with one of the items; the stream ends with a plain return message
+    STREAM = 64
+    # the serialized payload is compressed, see ipcbroker.compression
+    COMPRESSED = 128
+    # the message carries timestamps of the hops it passed
+    TRACED = 256
+
+
+class Priority(IntEnum):
+    # lanes of the broker queues, lower values are served first
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+# priority byte of a message without a priority
+_NO_PRIORITY = 255
+
+# marks a payload that was not decoded yet
+_UNSET = object()
+
+# hops a traced call passes, in order: the caller creates and sends the
+# request, the broker receives and forwards it, the provider receives it,
+# runs the handler and replies, the broker passes the reply on and the
+# caller receives it
+TRACE_HOPS = ('call', 'send', 'broker_receive', 'broker_forward',
+              'provider_receive', 'handler_start', 'handler_end', 'reply',
+              'receive')
+_HOP_CODES = {hop: code for code, hop in enumerate(TRACE_HOPS)}
+# hop code and time.monotonic() of a timestamp in a compact frame
+_STAMP = struct.Struct('!Bd')
 
 
 class Message:
-    COM_ID_LENGTH = 15
+    """
+    A message exchanged between clients and broker
+
+    The payload is serialized once and only deserialized when it is
+    accessed, so the broker forwards messages without touching their
+    payload.
+    """
+    __slots__ = ('__com_id', '__action', '__payload', '__raw', '__flags',
+                 '__timeout', '__priority', '__frame', '__trace')
+
+    # com_id, flags, action code, length of the action name, timeout and
+    # priority
+    HEADER = struct.Struct('!QIBHfB')
+    # actions with a fixed code (index + 1), code 0 is a call by name
+    ACTIONS = ('return', 'register_function', 'close', 'subscribe',
+               'unsubscribe', 'invalidate', 'cancel', '__peer__',
+               '__lookup__', '__credit__', '__federate__', '__ping__')
 
     def __init__(self,
                  action: str,
                  payload,
                  com_id=None,
-                 flags=None):
+                 flags=Flag.NONE,
+                 timeout=None,
+                 priority=None,
+                 trace=None):
+        """
+        :param action: 'return', a broker action or the function name
+        :param payload: the payload
+        :param com_id: id shared by a request and its return message
+        :param flags: Flag bitmask
+        :param timeout: seconds the caller waits for the return message
+        :param priority: Priority of a request, None for the default of
+                         the function
+        :param trace: (hop, timestamp) pairs to continue, the message is
+                      traced if given or if flags has Flag.TRACED
+        """
         if com_id is None:
-            self.__com_id = ''.join([random.choice(string.ascii_uppercase)
-                                     for _ in range(self.COM_ID_LENGTH)])
-        else:
-            self.__com_id = com_id
+            com_id = random.getrandbits(63)
+
+        if not isinstance(flags, int):
+            raise TypeError('flags is not an int')
 
-        if flags is None:
-            flags = list()
+        if isinstance(payload, Exception):
+            flags |= Flag.ERROR
 
-        if not isinstance(flags, list):
-            raise TypeError('flags is not a list')
+        if priority is not None:
+            priority = Priority(priority)
 
+        if trace is not None:
+            flags |= Flag.TRACED
+            trace = [(_HOP_CODES[hop], stamp) for hop, stamp in trace]
+        elif flags & Flag.TRACED:
+            trace = list()
+
+        self.__com_id = com_id
         self.__action = action
         self.__payload = payload
-        self.__flags = flags
+        self.__raw = None
+        self.__flags = Flag(flags)
+        self.__timeout = timeout
+        self.__priority = priority
+        self.__frame = None
+        self.__trace = trace
+
+    @classmethod
+    def from_raw(cls,
+                 action: str,
+                 raw: bytes,
+                 com_id: int,
+                 flags=Flag.NONE,
+                 timeout=None,
+                 priority=None,
+                 trace=None):
+        """
+        Create a message from an already serialized payload
+
+        :param raw: the serialized payload
+        :return: the message
+        """
+        message = cls(action, _UNSET, com_id, flags, timeout, priority,
+                      trace)
+        message.__raw = raw
+        return message
+
+    @classmethod
+    def from_bytes(cls, frame: bytes):
+        """
+        Parse a compact frame created by to_bytes()
+
+        :param frame: the frame
+        :return: the message
+        """
+        (com_id, flags, code, name_length,
+         timeout, priority) = cls.HEADER.unpack_from(frame)
+        offset = cls.HEADER.size
+        if code == 0:
+            action = bytes(frame[offset:offset + name_length]).decode()
+            offset += name_length
+        else:
+            action = cls.ACTIONS[code - 1]
+        trace = None
+        if flags & Flag.TRACED:
+            trace = list()
+            for _ in range(frame[offset]):
+                hop, stamp = _STAMP.unpack_from(frame, offset + 1)
+                trace.append((TRACE_HOPS[hop], stamp))
+                offset += _STAMP.size
+            offset += 1
+        message = cls.from_raw(action,
+                               bytes(frame[offset:]),
+                               com_id,
+                               flags,
+                               timeout or None,
+                               None if priority == _NO_PRIORITY
+                               else priority,
+                               trace)
+        message.__frame = frame
+        return message
+
+    def to_bytes(self):
+        """
+        Compact frame of the message: a fixed header followed by the
+        action name (only for calls), the number of timestamps and the
+        timestamps (only if traced) and the serialized payload
+
+        :return: the frame
+        """
+        if self.__frame is None:
+            if self.__action in self.ACTIONS:
+                code = self.ACTIONS.index(self.__action) + 1
+                name = b''
+            else:
+                code = 0
+                name = self.__action.encode()
+            header = self.HEADER.pack(self.__com_id,
+                                      self.__flags,
+                                      code,
+                                      len(name),
+                                      self.__timeout or 0.0,
+                                      _NO_PRIORITY
+                                      if self.__priority is None
+                                      else self.__priority)
+            trace = b''
+            if self.__trace is not None:
+                trace = bytes([len(self.__trace)]) + b''.join(
+                    _STAMP.pack(hop, stamp) for hop, stamp in self.__trace)
+            self.__frame = header + name + trace + self.raw_payload
+        return self.__frame
+
+    def __reduce__(self):
+        return (Message.from_raw,
+                (self.__action, self.raw_payload,
+                 self.__com_id, int(self.__flags), self.__timeout,
+                 None if self.__priority is None
+                 else int(self.__priority),
+                 self.trace))
+
+    def stamp(self, hop):
+        """
+        Add a timestamp to the trace of a traced message
+
+        :param hop: one of TRACE_HOPS
+        """
+        # the frame has one byte for the number of timestamps
+        if self.__trace is not None and len(self.__trace) < 255:
+            self.__trace.append((_HOP_CODES[hop], time.monotonic()))
+            # the frame holds the old trace
+            self.__frame = None
+
+    def __decoded(self):
+        if self.__payload is _UNSET:
+            raw = self.__raw
+            if self.__flags & Flag.COMPRESSED:
+                raw = decompress(raw)
+            self.__payload = pickle.loads(raw)
+        return self.__payload
 
     def __str__(self):
         ret_string = str(self.__com_id)
         ret_string += ': '
         ret_string += str(self.__action)
         ret_string += ' - '
-        ret_string += str(self.__payload)
+        ret_string += str(self.__decoded())
         return ret_string
 
     @property
@@ -44,10 +252,39 @@ class Message:
 
     @property
     def payload(self):
-        if isinstance(self.__payload, Exception):
-            raise self.__payload
-        return self.__payload
+        payload = self.__decoded()
+        if isinstance(payload, Exception):
+            raise payload
+        return payload
+
+    @property
+    def raw_payload(self):
+        if self.__raw is None:
+            self.__raw = pickle.dumps(self.__payload,
+                                      pickle.HIGHEST_PROTOCOL)
+        return self.__raw
 
     @property
     def flags(self):
         return self.__flags
+
+    @property
+    def timeout(self):
+        return self.__timeout
+
+    @property
+    def priority(self):
+        return self.__priority
+
+    @property
+    def traced(self):
+        return self.__trace is not None
+
+    @property
+    def trace(self):
+        """
+        (hop, time.monotonic()) pairs of a traced message or None
+        """
+        if self.__trace is None:
+            return None
+        return [(TRACE_HOPS[hop], stamp) for hop, stamp in self.__trace]
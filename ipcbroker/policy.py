@@ -0,0 +1,70 @@
+from abc import ABC
+from abc import abstractmethod
+
+
+class Policy(ABC):
+    """
+    Strategy to pick one of several providers of a function
+    """
+    @abstractmethod
+    def select(self, name, providers, outstanding):
+        """
+        Select the provider for a call
+
+        :param name: name of the function
+        :param providers: connections of the providers
+        :param outstanding: number of unanswered requests per provider
+        :return: the selected provider
+        """
+
+
+class RoundRobin(Policy):
+    """
+    Use the providers of a function in turn
+    """
+    def __init__(self):
+        self.__next = dict()
+
+    def select(self, name, providers, outstanding):
+        index = self.__next.get(name, 0) % len(providers)
+        self.__next[name] = index + 1
+        return providers[index]
+
+
+class LeastOutstanding(Policy):
+    """
+    Use the provider with the fewest unanswered requests, ties are
+    broken in turn
+    """
+    def __init__(self):
+        self.__round_robin = RoundRobin()
+
+    def select(self, name, providers, outstanding):
+        least = min(outstanding.get(provider, 0) for provider in providers)
+        candidates = [provider for provider in providers
+                      if outstanding.get(provider, 0) == least]
+        return self.__round_robin.select(name, candidates, outstanding)
+
+
+POLICIES = {
+    'round_robin': RoundRobin,
+    'least_outstanding': LeastOutstanding,
+}
+
+
+def get_policy(policy):
+    """
+    Get a policy by name or check a given one
+
+    :param policy: a Policy, its name in POLICIES or None for the default
+    :return: the policy
+    """
+    if policy is None:
+        return RoundRobin()
+    if isinstance(policy, str):
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy: {}'.format(policy))
+        return POLICIES[policy]()
+    if not isinstance(policy, Policy):
+        raise TypeError('policy is not a Policy: {}'.format(type(policy)))
+    return policy
@@ -0,0 +1,210 @@
+import logging
+import math
+import multiprocessing
+import os
+import time
+
+from ipcbroker.client import Client
+from ipcbroker.threaded import Threaded
+
+
+def run_worker(connection, name, func, options, retired):
+    """
+    Main function of a worker process: provide the function until the
+    pool retires the worker or the process of the broker is gone
+
+    :param connection: connection from Broker.register_client()
+    :param options: keyword arguments of Client.register_function()
+    :param retired: event the pool sets to stop the worker
+    """
+    client = Client(connection).start()
+    client.register_function(name, func, **options)
+    parent = multiprocessing.parent_process()
+    while not retired.wait(WorkerPool.POLL_TIMEOUT):
+        if parent is not None and not parent.is_alive():
+            break
+    client.stop()
+    client.close()
+
+
+class WorkerPool(Threaded):
+    """
+    Worker processes providing one function, started and stopped by the
+    load of the function
+
+    Every POLL_TIMEOUT seconds the pool looks at the requests in flight at
+    its workers and the requests queued for a provider. It starts workers
+    until each one has at most target_load of them, and retires workers
+    that were idle for idle_timeout seconds. A retiring worker gets no new
+    requests, it exits once it answered the ones it has. Workers that
+    died are replaced, their requests fail over to the other workers if
+    the broker was created with failover=True.
+    """
+    POLL_TIMEOUT = 0.1
+    # seconds a worker gets to exit before it is terminated
+    STOP_TIMEOUT = 5
+
+    def __init__(self,
+                 name,
+                 func,
+                 connect,
+                 load,
+                 retire,
+                 min_workers=1,
+                 max_workers=None,
+                 target_load=1,
+                 idle_timeout=30,
+                 context='spawn',
+                 options=None):
+        """
+        :param name: name of the function
+        :param func: the function, it has to be picklable
+        :param connect: returns a new connection to the broker
+        :param load: returns the number of queued requests of the function
+                     and client id -> requests in flight of its providers
+        :param retire: called with the client id of an idle worker, stops
+                       sending it requests and returns True unless
+                       requests arrived in the meantime
+        :param min_workers: workers kept running without load
+        :param max_workers: most workers at the same time, None for the
+                            number of CPUs
+        :param target_load: requests in flight or queued per worker
+        :param idle_timeout: seconds without requests after which a
+                             worker above min_workers is retired
+        :param context: multiprocessing context or start method of the
+                        workers
+        :param options: keyword arguments of Client.register_function()
+        """
+        super().__init__('pool-{}'.format(name))
+        if max_workers is None:
+            max_workers = max(min_workers, os.cpu_count() or 1)
+        if min_workers < 1:
+            raise ValueError('At least one worker is required')
+        if max_workers < min_workers:
+            raise ValueError('max_workers is less than min_workers')
+        if target_load <= 0:
+            raise ValueError('target_load has to be positive')
+        if isinstance(context, str):
+            context = multiprocessing.get_context(context)
+        self.__name = name
+        self.__func = func
+        self.__connect = connect
+        self.__load = load
+        self.__retire = retire
+        self.__min_workers = min_workers
+        self.__max_workers = max_workers
+        self.__target_load = target_load
+        self.__idle_timeout = idle_timeout
+        self.__context = context
+        self.__options = dict(options or {})
+        # dicts of process, client id, retired event and the time the
+        # worker last had requests
+        self.__workers = list()
+        # workers that get no new requests and exit
+        self.__retiring = list()
+        self.__spawned = 0
+        self.__retired = 0
+
+        self.__logger = logging.getLogger(__name__)
+
+    def start(self):
+        # errors of the first workers, e.g. a function that can not be
+        # pickled, reach the caller
+        while len(self.__workers) < self.__min_workers:
+            self.__spawn()
+        return super().start()
+
+    def stop(self):
+        """
+        Stop the pool and its workers without waiting for their requests
+        """
+        if self.is_alive():
+            super().stop()
+        workers = self.__workers + self.__retiring
+        self.__workers = list()
+        self.__retiring = list()
+        for worker in workers:
+            worker['retired'].set()
+        for worker in workers:
+            worker['process'].join(self.STOP_TIMEOUT)
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+                worker['process'].join()
+        return self
+
+    def work(self):
+        self.wait([], self.POLL_TIMEOUT)
+        now = time.monotonic()
+        queued, in_flight = self.__load()
+
+        for worker in list(self.__workers):
+            if not worker['process'].is_alive():
+                self.__logger.warning('Worker {} of {} died'.format(
+                    worker['process'].pid, self.__name))
+                self.__workers.remove(worker)
+                worker['process'].join()
+        for worker in list(self.__retiring):
+            if not worker['process'].is_alive():
+                self.__retiring.remove(worker)
+                worker['process'].join()
+
+        load = queued
+        for worker in self.__workers:
+            requests = in_flight.get(worker['client_id'], 0)
+            if requests:
+                worker['active'] = now
+            load += requests
+        wanted = math.ceil(load / self.__target_load)
+        wanted = max(self.__min_workers, min(self.__max_workers, wanted))
+
+        while len(self.__workers) < wanted:
+            self.__spawn()
+        for worker in list(self.__workers):
+            if len(self.__workers) <= wanted:
+                break
+            if (
+                worker['client_id'] in in_flight and
+                now - worker['active'] >= self.__idle_timeout and
+                self.__retire(worker['client_id'])
+            ):
+                # counted first, stats() runs on other threads
+                self.__retired += 1
+                self.__retiring.append(worker)
+                self.__workers.remove(worker)
+                worker['retired'].set()
+
+    def stats(self):
+        """
+        :return: dict with the number of 'workers' providing the function
+                 (starting ones included), 'retiring' workers and the
+                 workers 'spawned' and 'retired' so far
+        """
+        return {'workers': len(self.__workers),
+                'retiring': len(self.__retiring),
+                'spawned': self.__spawned,
+                'retired': self.__retired}
+
+    @property
+    def n_workers(self):
+        return len(self.__workers)
+
+    def __spawn(self):
+        connection = self.__connect()
+        retired = self.__context.Event()
+        process = self.__context.Process(target=run_worker,
+                                         args=(connection,
+                                               self.__name,
+                                               self.__func,
+                                               self.__options,
+                                               retired),
+                                         name='{}-worker'.format(self.__name))
+        try:
+            process.start()
+        finally:
+            # the broker sees EOF as soon as the worker exits
+            connection.close()
+        self.__workers.append({'process': process,
+                               'client_id': connection.client_id,
+                               'retired': retired,
+                               'active': time.monotonic()})
+        self.__spawned += 1
@@ -0,0 +1,188 @@
+import logging
+import time
+from itertools import count
+from queue import PriorityQueue
+from queue import Queue
+from threading import Lock
+
+from ipcbroker.connection import MessageConnection
+from ipcbroker.message import Priority
+from ipcbroker.threaded import Threaded
+
+
+class Router(Threaded):
+    """
+    Reads the messages of a share of the broker's client connections
+
+    Requests and return messages are handed to the callbacks of the
+    broker, a connection that hits EOF is removed and reported. The
+    requests read in one iteration are routed by their priority. The
+    router remembers when it last heard from each connection. A message
+    whose callback raised is reported and the router goes on.
+    """
+    POLL_TIMEOUT = 0.1
+    # messages read from one connection per iteration, the rest waits
+    # in the pipe and blocks the sender once the pipe is full
+    MAX_BATCH = 64
+
+    def __init__(self,
+                 route_request,
+                 route_return,
+                 disconnect,
+                 name=None,
+                 expire=None,
+                 fail=None):
+        """
+        :param route_request: called with connection and message for
+                              every message that is not a return message
+        :param route_return: called with connection and return message
+        :param disconnect: called with a connection that was closed
+        :param name: name of the worker thread
+        :param expire: called once per iteration to expire overdue
+                       requests, returns the seconds until the next
+                       deadline or None
+        :param fail: called with connection, message and exception when
+                     routing a message raised
+        """
+        super().__init__(name)
+        self.__route_request = route_request
+        self.__route_return = route_return
+        self.__disconnect = disconnect
+        self.__expire = expire
+        self.__fail = fail
+        self.__connections = list()
+        # (priority, arrival, connection, message) of requests
+        self.__message_queue = PriorityQueue()
+        self.__arrivals = count()
+        self.__return_queue = Queue()
+        # connection -> time of the last message read from it
+        self.__heard = dict()
+        # connections to close on the thread of the router
+        self.__dropped = list()
+
+        self.__connection_lock = Lock()
+
+        self.__logger = logging.getLogger(__name__)
+
+    def add_connection(self, connection: MessageConnection):
+        with self.__connection_lock:
+            self.__connections.append(connection)
+            self.__heard[connection] = time.monotonic()
+        # let a blocking wait pick up the new connection
+        self.wakeup()
+
+    def remove_connection(self, connection: MessageConnection):
+        with self.__connection_lock:
+            if connection in self.__connections:
+                self.__connections.remove(connection)
+            self.__heard.pop(connection, None)
+
+    def drop(self, connection: MessageConnection):
+        """
+        Close a connection and report it like a connection that hit EOF
+
+        The connection is closed by the thread of the router, which may
+        be waiting for it right now.
+
+        :return: False if the connection is dropped already
+        """
+        with self.__connection_lock:
+            if connection in self.__dropped:
+                return False
+            self.__dropped.append(connection)
+        self.wakeup()
+        return True
+
+    def heard(self, connection: MessageConnection):
+        """
+        :return: time.monotonic() of the last message read from the
+                 connection or of adding it, None if it is not read
+        """
+        with self.__connection_lock:
+            return self.__heard.get(connection)
+
+    def work(self):
+        with self.__connection_lock:
+            dropped = self.__dropped
+            self.__dropped = list()
+        for connection in dropped:
+            self.remove_connection(connection)
+            connection.close()
+            self.__disconnect(connection)
+
+        with self.__connection_lock:
+            connections = list(self.__connections)
+
+        # wake up in time for the next deadline
+        timeout = self.POLL_TIMEOUT
+        if self.__expire is not None:
+            next_deadline = self.__expire()
+            if next_deadline is not None:
+                timeout = min(timeout, next_deadline)
+
+        # block until a connection is readable
+        recv_cons = self.wait(connections, timeout)
+        now = time.monotonic()
+
+        # fill message queue
+        for recv_con in recv_cons:
+            try:
+                # read a bounded batch without blocking
+                for _ in range(self.MAX_BATCH):
+                    if not recv_con.poll():
+                        break
+                    message = recv_con.recv()
+                    self.__heard[recv_con] = now
+                    if message.traced:
+                        message.stamp('broker_receive')
+                    if message.action == 'return':
+                        self.__return_queue.put((recv_con, message))
+                    else:
+                        priority = message.priority
+                        if priority is None:
+                            priority = Priority.NORMAL
+                        self.__message_queue.put((priority,
+                                                  next(self.__arrivals),
+                                                  recv_con,
+                                                  message))
+            except (EOFError, OSError):
+                self.__logger.error('Error receiving from pipe')
+                self.remove_connection(recv_con)
+                self.__disconnect(recv_con)
+
+        # answers first, they complete requests
+        while not self.__return_queue.empty():
+            recv_con, message = self.__return_queue.get()
+            self.__route(self.__route_return, recv_con, message)
+
+        qsize = self.__message_queue.qsize()
+        if qsize > 0:
+            self.__logger.debug('{} messages queued'.format(qsize))
+            # process messages in queue
+            while not self.__message_queue.empty():
+                _, _, recv_con, message = self.__message_queue.get()
+                self.__route(self.__route_request, recv_con, message)
+
+    def __route(self, route, connection: MessageConnection, message):
+        """
+        Hand a message to a callback, an exception is logged and reported
+        instead of stopping the router
+        """
+        try:
+            route(connection, message)
+        except Exception as exception:
+            self.__logger.exception('Error routing {} of client {}'.format(
+                message.action, connection.client_id))
+            if self.__fail is not None:
+                self.__fail(connection, message, exception)
+
+    @property
+    def n_connections(self):
+        return len(self.__connections)
+
+    @property
+    def n_queued(self):
+        """
+        Number of messages read but not routed yet
+        """
+        return self.__message_queue.qsize() + self.__return_queue.qsize()
@@ -0,0 +1,93 @@
+import logging
+from queue import Queue
+from threading import Lock
+from threading import Thread
+
+from ipcbroker.connection import MessageConnection
+from ipcbroker.message import Message
+from ipcbroker.sharedmem import discard
+
+
+class Sender:
+    """
+    Sends messages to connections on a thread of its own
+
+    A router that sends itself blocks once the pipe to a client is full.
+    If that client is blocked sending to the broker at the same time,
+    nobody reads either pipe again. With a sender the router keeps
+    reading while a send is blocked. Messages are sent in the order they
+    were queued. The thread is started on the first send.
+
+    A connection that does not read gets at most max_queued messages
+    queued, further sends to it fail. Blocking the router instead would
+    bring back the deadlock.
+    """
+    def __init__(self, name=None, max_queued=None):
+        """
+        :param name: name of the thread
+        :param max_queued: messages queued per connection, None for no
+                           limit
+        """
+        self.__name = name
+        self.__max_queued = max_queued
+        self.__queue = Queue()
+        # connection -> messages queued and not sent yet
+        self.__queued = dict()
+        self.__thread = None
+        self.__lock = Lock()
+
+        self.__logger = logging.getLogger(__name__)
+
+    def send(self, connection: MessageConnection, message: Message):
+        """
+        Queue a message for a connection
+
+        :return: False if the queue of the connection is full
+        """
+        if self.__thread is None:
+            self.__start()
+        with self.__lock:
+            queued = self.__queued.get(connection, 0)
+            if self.__max_queued is not None and queued >= self.__max_queued:
+                return False
+            self.__queued[connection] = queued + 1
+        self.__queue.put((connection, message))
+        return True
+
+    def stop(self):
+        """
+        Send the queued messages and stop the thread
+        """
+        with self.__lock:
+            thread = self.__thread
+            self.__thread = None
+        if thread is not None:
+            self.__queue.put(None)
+            thread.join()
+
+    def __start(self):
+        with self.__lock:
+            if self.__thread is not None:
+                return
+            self.__thread = Thread(target=self.__run,
+                                   name=self.__name,
+                                   daemon=True)
+            self.__thread.start()
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            connection, message = item
+            if message.traced:
+                message.stamp('broker_forward')
+            try:
+                connection.send(message)
+            except (EOFError, OSError):
+                self.__logger.error('Error sending to pipe')
+                discard(message)
+            with self.__lock:
+                queued = self.__queued.pop(connection) - 1
+                if queued:
+                    self.__queued[connection] = queued
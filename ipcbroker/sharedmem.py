@@ -0,0 +1,300 @@
+import atexit
+import io
+import os
+import pickle
+import struct
+from threading import Lock
+
+from ipcbroker.message import Flag
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+
+def _rebuild_buffer(buffer, kind):
+    if kind == 'bytes':
+        return bytes(buffer)
+    if kind == 'bytearray':
+        return bytearray(buffer)
+    return memoryview(bytearray(buffer))
+
+
+BUFFER_TYPES = {bytes: 'bytes',
+                bytearray: 'bytearray',
+                memoryview: 'memoryview'}
+
+
+class SharedPayload:
+    """
+    Payload whose large buffers were moved to shared memory segments
+
+    Only the pickled remainder and the segment handles travel through
+    the pipes and the broker.
+    """
+    def __init__(self, data: bytes, handles: list):
+        self.data = data
+        # (segment name, number of bytes, kind) per moved buffer, kind
+        # is the buffer type or None for protocol 5 out-of-band buffers
+        self.handles = handles
+
+
+class SegmentPool:
+    """
+    Shared memory segments owned by a process
+
+    A segment holds the buffer of one message and starts with a flag
+    that is set while the buffer was not read. Only the owner sets it,
+    when it hands out a free segment, and only the one reader of the
+    message (or whoever drops the message unread) clears it. The flag
+    changes with a single store, so no lock is needed across processes.
+    The owner recycles segments whose flag is cleared and unlinks all of
+    them when the pool is closed.
+    """
+    HEADER = struct.Struct('q')
+    MIN_SEGMENT_SIZE = 1 << 16
+    MAX_FREE_SEGMENTS = 8
+
+    def __init__(self):
+        if shared_memory is None:
+            raise RuntimeError('Shared memory requires Python 3.8 or newer')
+        self.__segments = dict()
+        self.__lock = Lock()
+
+    def dumps(self, obj, threshold: int):
+        """
+        Serialize an object, buffers of at least threshold bytes are
+        placed in shared memory
+
+        bytes, bytearray and memoryview objects as well as objects
+        pickling their data as out-of-band buffers (protocol 5) are
+        moved.
+
+        :param obj: object to serialize
+        :param threshold: minimum buffer size in bytes
+        :return: the serialized object and whether shared memory is used
+        """
+        stream = io.BytesIO()
+        pickler = _Pickler(stream, threshold, self.__store)
+        pickler.dump(obj)
+        if not pickler.handles:
+            return stream.getvalue(), False
+        shared = SharedPayload(stream.getvalue(), pickler.handles)
+        return pickle.dumps(shared, pickle.HIGHEST_PROTOCOL), True
+
+    def loads(self, payload: SharedPayload):
+        """
+        Restore a payload created by dumps()
+
+        The data is copied out of the segments, which are released to
+        their owner afterwards.
+
+        :param payload: the shared payload
+        :return: the restored object
+        """
+        segments = list()
+        views = list()
+        try:
+            for name, size, kind in payload.handles:
+                segment = self.__attach(name)
+                segments.append(segment)
+                offset = self.HEADER.size
+                views.append(segment.buf[offset:offset + size])
+            unpickler = _Unpickler(io.BytesIO(payload.data), payload.handles,
+                                   views)
+            return unpickler.load()
+        finally:
+            for view in views:
+                view.release()
+            for segment in segments:
+                self.__release(segment)
+
+    @property
+    def n_used(self):
+        """
+        Number of segments holding a buffer that was not read
+        """
+        with self.__lock:
+            return sum(self.HEADER.unpack_from(segment.buf)[0] != 0
+                       for segment in self.__segments.values())
+
+    def release(self, payload: SharedPayload):
+        """
+        Release the segments of a payload that is dropped without being
+        read, e.g. a request that timed out before a provider took it
+
+        :param payload: the shared payload
+        """
+        for name, _, _ in payload.handles:
+            try:
+                segment = self.__attach(name)
+            except FileNotFoundError:
+                # the owner is gone and unlinked it
+                continue
+            self.__release(segment)
+
+    def close(self):
+        """
+        Unlink all segments of the pool
+        """
+        with self.__lock:
+            for segment in self.__segments.values():
+                self.__unlink(segment)
+            self.__segments.clear()
+
+    def __store(self, view: memoryview):
+        """
+        Copy a buffer into a segment
+
+        :param view: the buffer
+        :return: name of the segment
+        """
+        segment = self.__acquire(view.nbytes)
+        offset = self.HEADER.size
+        segment.buf[offset:offset + view.nbytes] = view
+        return segment.name
+
+    def __acquire(self, size):
+        size += self.HEADER.size
+        with self.__lock:
+            # smallest free segment that is large enough
+            free = [segment for segment in self.__segments.values()
+                    if self.HEADER.unpack_from(segment.buf)[0] == 0]
+            candidates = [segment for segment in free if segment.size >= size]
+            if candidates:
+                segment = min(candidates, key=lambda s: s.size)
+            else:
+                # drop free segments above the limit, largest first
+                free.sort(key=lambda s: s.size)
+                while len(free) >= self.MAX_FREE_SEGMENTS:
+                    unused = free.pop()
+                    del self.__segments[unused.name]
+                    self.__unlink(unused)
+                segment_size = self.MIN_SEGMENT_SIZE
+                while segment_size < size:
+                    segment_size <<= 1
+                segment = shared_memory.SharedMemory(create=True,
+                                                     size=segment_size)
+                self.__segments[segment.name] = segment
+            self.HEADER.pack_into(segment.buf, 0, 1)
+            return segment
+
+    def __attach(self, name):
+        with self.__lock:
+            if name in self.__segments:
+                return self.__segments[name]
+        try:
+            # the owner is responsible for unlinking
+            return shared_memory.SharedMemory(name, track=False)
+        except TypeError:  # Python < 3.13
+            segment = shared_memory.SharedMemory(name)
+            if os.name == 'posix':
+                # otherwise the resource tracker of this process would
+                # unlink the segment when the process ends
+                resource_tracker.unregister(segment._name, 'shared_memory')
+            return segment
+
+    @staticmethod
+    def __unlink(segment):
+        segment.close()
+        if os.name == 'posix':
+            # a reader sharing the resource tracker may have unregistered
+            # the segment already, unlink() expects it to be registered
+            resource_tracker.register(segment._name, 'shared_memory')
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+
+    def __release(self, segment):
+        self.HEADER.pack_into(segment.buf, 0, 0)
+        if segment.name not in self.__segments:
+            segment.close()
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file, threshold, store):
+        super().__init__(file, 5, buffer_callback=self.__buffer_callback)
+        self.__threshold = threshold
+        self.__store = store
+        self.handles = list()
+
+    def persistent_id(self, obj):
+        # the C pickler skips reducer_override() for bytes and bytearray
+        kind = BUFFER_TYPES.get(type(obj))
+        if kind is None:
+            return None
+        view = memoryview(obj)
+        if view.nbytes < self.__threshold or not view.contiguous:
+            return None
+        self.handles.append((self.__store(view.cast('B')), view.nbytes, kind))
+        return len(self.handles) - 1
+
+    def reducer_override(self, obj):
+        # memoryviews can not be pickled in-band otherwise
+        if type(obj) is memoryview:
+            return _rebuild_buffer, (obj.tobytes(), 'memoryview')
+        return NotImplemented
+
+    def __buffer_callback(self, buffer):
+        view = buffer.raw()
+        if view.nbytes < self.__threshold:
+            return True
+        self.handles.append((self.__store(view), view.nbytes, None))
+        return False
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, handles, views):
+        # the unpickled object may keep out-of-band buffers, copy them
+        buffers = [bytearray(view)
+                   for view, (_, _, kind) in zip(views, handles)
+                   if kind is None]
+        super().__init__(file, buffers=buffers)
+        self.__handles = handles
+        self.__views = views
+
+    def persistent_load(self, pid):
+        return _rebuild_buffer(self.__views[pid], self.__handles[pid][2])
+
+
+_pools = dict()
+_pools_lock = Lock()
+
+
+def discard(message):
+    """
+    Release the segments of a message that is dropped without being
+    read
+
+    :param message: the Message, nothing happens unless its payload is
+                    in shared memory
+    """
+    if not message.flags & Flag.SHARED_MEMORY:
+        return
+    payload = message.payload
+    if isinstance(payload, SharedPayload):
+        get_pool().release(payload)
+
+
+def get_pool():
+    """
+    Segment pool of the current process
+
+    :return: the pool
+    """
+    with _pools_lock:
+        # a forked child must not reuse the segments of its parent
+        pid = os.getpid()
+        if pid not in _pools:
+            _pools[pid] = SegmentPool()
+        return _pools[pid]
+
+
+@atexit.register
+def _close_pool():
+    pool = _pools.get(os.getpid())
+    if pool is not None:
+        pool.close()
@@ -0,0 +1,102 @@
+from bisect import bisect_left
+
+# upper bounds of the histogram buckets in seconds, 1 us to ~36 min
+BUCKETS = tuple(1e-6 * 2 ** exponent for exponent in range(32))
+
+
+class Histogram:
+    """
+    Latency histogram with exponential buckets
+
+    Recording a value is a bisect and two additions, percentiles are
+    estimated from the bucket bounds.
+    """
+    def __init__(self):
+        self.__counts = [0] * (len(BUCKETS) + 1)
+        self.__count = 0
+        self.__sum = 0.0
+        self.__max = 0.0
+
+    def record(self, seconds):
+        """
+        Add a measurement
+
+        :param seconds: the measured time
+        """
+        self.__counts[bisect_left(BUCKETS, seconds)] += 1
+        self.__count += 1
+        self.__sum += seconds
+        if seconds > self.__max:
+            self.__max = seconds
+
+    def percentile(self, percent):
+        """
+        Estimate a percentile
+
+        :param percent: the percentile, e.g. 99
+        :return: upper bound of the bucket the percentile is in, None if
+                 nothing was recorded
+        """
+        if not self.__count:
+            return None
+        rank = self.__count * percent / 100.0
+        seen = 0
+        for bound, count in zip(BUCKETS, self.__counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.__max)
+        return self.__max
+
+    def snapshot(self):
+        """
+        :return: dict with count, mean, max, p50, p90, p99 and the non
+                 empty buckets as (upper bound, count) pairs
+        """
+        buckets = [(bound, count)
+                   for bound, count in zip(BUCKETS + (float('inf'),),
+                                           self.__counts)
+                   if count]
+        return {'count': self.__count,
+                'mean': self.__sum / self.__count if self.__count else None,
+                'max': self.__max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': buckets}
+
+
+class CallStats:
+    """
+    Calls, errors and latency of one function
+    """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.rejected = 0
+        # calls answered by an identical call in flight
+        self.coalesced = 0
+        # calls sent again after their provider disconnected
+        self.failovers = 0
+        self.latency = Histogram()
+
+    def record(self, seconds, error=False):
+        """
+        Add a finished call
+
+        :param seconds: time from request to return message
+        :param error: the call raised
+        """
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.latency.record(seconds)
+
+    def snapshot(self):
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'timeouts': self.timeouts,
+                'rejected': self.rejected,
+                'coalesced': self.coalesced,
+                'failovers': self.failovers,
+                'latency': self.latency.snapshot()}
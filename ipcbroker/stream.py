@@ -0,0 +1,133 @@
+import weakref
+from queue import Empty
+from queue import Queue
+from threading import Condition
+
+# marks the end of a stream in the queue of a StreamProxy
+_END = object()
+
+
+class StreamCredits:
+    """
+    Credits of the producer of a stream
+
+    The producer takes a credit per item it sends and waits while it has
+    none, the consumer gives credits back as it consumes items.
+    """
+    def __init__(self, window):
+        self.__credits = window
+        self.__cancelled = False
+        self.__condition = Condition()
+
+    def take(self, timeout=None):
+        """
+        Wait for a credit
+
+        :param timeout: seconds to wait, None to wait forever
+        :return: False if the stream was cancelled
+        :raises TimeoutError: if the consumer gave no credit in time
+        """
+        with self.__condition:
+            if not self.__condition.wait_for(
+                    lambda: self.__credits > 0 or self.__cancelled,
+                    timeout):
+                raise TimeoutError('Consumer of the stream is gone')
+            self.__credits -= 1
+            return not self.__cancelled
+
+    def give(self, credits):
+        with self.__condition:
+            self.__credits += credits
+            self.__condition.notify()
+
+    def cancel(self):
+        with self.__condition:
+            self.__cancelled = True
+            self.__condition.notify()
+
+
+class StreamProxy:
+    """
+    Lazy iterator over the items a remote function streams
+
+    Items are buffered up to the window of the stream. Consumed items are
+    acknowledged in batches of half the window, which allows the
+    producer to send more. close() cancels the stream, so does dropping
+    the last reference to an open stream.
+    """
+    # seconds to wait for an item before checking for cancellation
+    POLL_TIMEOUT = 0.1
+
+    def __init__(self, future, window, acknowledge, pump):
+        """
+        :param future: future resolved when the stream ended
+        :param window: items the producer may send ahead
+        :param acknowledge: called with the number of consumed items
+        :param pump: called with a timeout to read messages, returns
+                     False without reading if the worker thread does
+        """
+        self.__future = future
+        self.__queue = Queue()
+        self.__batch = max(1, window // 2)
+        self.__consumed = 0
+        self.__acknowledge = acknowledge
+        self.__pump = pump
+        # an abandoned stream must not keep its producer waiting
+        self.__finalizer = weakref.finalize(self, future.cancel)
+        self.__finalizer.atexit = False
+
+    def put(self, item):
+        """
+        Add an item received for the stream
+        """
+        self.__queue.put(item)
+
+    def end(self):
+        """
+        Mark the end of the stream, its future is resolved
+        """
+        self.__queue.put(_END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.__get()
+        if item is _END:
+            if not self.__future.cancelled():
+                # raises the exception of a failed producer
+                self.__future.result()
+            raise StopIteration
+        self.__consumed += 1
+        if self.__consumed >= self.__batch:
+            self.__acknowledge(self.__consumed)
+            self.__consumed = 0
+        return item
+
+    def __get(self):
+        while True:
+            # buffered items are dropped once the stream is closed
+            if self.__future.cancelled():
+                return _END
+            try:
+                return self.__queue.get_nowait()
+            except Empty:
+                pass
+            # read the connection here unless the worker thread does
+            if not self.__pump(self.POLL_TIMEOUT):
+                try:
+                    return self.__queue.get(timeout=self.POLL_TIMEOUT)
+                except Empty:
+                    pass
+
+    def close(self):
+        """
+        Stop the stream, the producer stops at its next item
+        """
+        self.__finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,6 +1,9 @@
-from time import sleep
+from multiprocessing import Pipe
+from multiprocessing.connection import wait
 from threading import Thread
 from threading import Event
+from threading import Lock
+from threading import current_thread
 
 
 class Threaded:
@@ -9,13 +12,51 @@ class Threaded:
         self.__threaded_thread = None
         self.__threaded_stop_event = Event()
 
+        # self-pipe to interrupt a blocking wait()
+        self.__threaded_wakeup_recv, self.__threaded_wakeup_send = Pipe(False)
+        self.__threaded_wakeup_pending = Event()
+        # guards the pending flag together with the pipe
+        self.__threaded_wakeup_lock = Lock()
+
     def work(self):
         pass
 
+    def wait(self, connections, timeout=None):
+        """
+        Block until one of the connections is readable
+
+        The wait is interrupted early by wakeup() and stop().
+
+        :param connections: connections to wait for
+        :param timeout: maximum time to block, None blocks until woken up
+        :return: list of readable connections
+        """
+        connections = list(connections)
+        connections.append(self.__threaded_wakeup_recv)
+        ready = wait(connections, timeout)
+        if self.__threaded_wakeup_recv in ready:
+            ready.remove(self.__threaded_wakeup_recv)
+            # a wakeup() between draining and clearing would leave the
+            # flag set without a byte in the pipe
+            with self.__threaded_wakeup_lock:
+                while self.__threaded_wakeup_recv.poll():
+                    self.__threaded_wakeup_recv.recv_bytes()
+                self.__threaded_wakeup_pending.clear()
+        return ready
+
+    def wakeup(self):
+        """
+        Interrupt a blocking wait() of the worker
+        """
+        # one byte in the pipe is enough to wake the worker
+        with self.__threaded_wakeup_lock:
+            if not self.__threaded_wakeup_pending.is_set():
+                self.__threaded_wakeup_pending.set()
+                self.__threaded_wakeup_send.send_bytes(b'\0')
+
     def __thread_worker(self):
         while not self.__threaded_stop_event.is_set():
             self.work()
-            sleep(0.01)
 
     def start(self):
         self.__threaded_stop_event.clear()
@@ -39,8 +80,20 @@ class Threaded:
         ):
             raise Exception('Thread is already stoped')
         self.__threaded_stop_event.set()
+        self.wakeup()
         self.__threaded_thread.join()
         return self
 
     def is_alive(self):
-        return self.__threaded_thread.is_alive()
+        return (
+            self.__threaded_thread is not None and
+            self.__threaded_thread.is_alive()
+        )
+
+    def is_worker_thread(self):
+        """
+        Check if the calling thread is the worker thread
+
+        :return: True if called from within work()
+        """
+        return current_thread() is self.__threaded_thread
@@ -0,0 +1,186 @@
+import json
+import logging
+import random
+from collections import deque
+from threading import Lock
+
+from ipcbroker.stats import Histogram
+
+# names of the spans between two hops in exported traces
+SEGMENTS = {
+    ('call', 'send'): 'caller',
+    ('send', 'broker_receive'): 'to broker',
+    ('broker_receive', 'broker_forward'): 'broker',
+    ('broker_forward', 'provider_receive'): 'to provider',
+    ('send', 'provider_receive'): 'to provider',
+    ('provider_receive', 'handler_start'): 'provider queue',
+    ('handler_start', 'handler_end'): 'handler',
+    ('handler_end', 'reply'): 'reply',
+}
+# spans after the reply of the provider
+RETURN_SEGMENTS = {
+    ('reply', 'broker_receive'): 'return to broker',
+    ('broker_receive', 'broker_forward'): 'broker return',
+    ('broker_forward', 'receive'): 'return to caller',
+    ('reply', 'receive'): 'return to caller',
+}
+
+
+def segments(stamps):
+    """
+    Split the timestamps of a trace into the spans between them
+
+    :param stamps: (hop, time.monotonic()) pairs
+    :return: list of (span name, start, seconds)
+    """
+    spans = list()
+    names = SEGMENTS
+    for (hop, start), (next_hop, end) in zip(stamps, stamps[1:]):
+        if hop == 'reply':
+            names = RETURN_SEGMENTS
+        name = names.get((hop, next_hop),
+                         '{} - {}'.format(hop, next_hop))
+        # clocks of other processes may be slightly off
+        spans.append((name, start, max(end - start, 0.0)))
+    return spans
+
+
+class Tracer:
+    """
+    Samples the calls of a client and collects their traces
+
+    A sampled request carries timestamps of the hops it passes, see
+    ipcbroker.message.TRACE_HOPS; the provider sends them back with its
+    return message. Each finished trace is kept (up to max_traces), added
+    to the histogram of each of its spans and passed to the hooks.
+    Timestamps are time.monotonic() of the process that took them, which
+    is one clock for all processes of a host on Linux.
+    """
+    def __init__(self, rate=1.0, max_traces=10000, hooks=()):
+        """
+        :param rate: share of the calls that are traced, between 0 and 1
+        :param max_traces: number of traces kept for export
+        :param hooks: callables called with every finished trace, a dict
+                      with 'name', 'com_id' and 'stamps'
+        """
+        self.rate = rate
+        self.__traces = deque(maxlen=max_traces)
+        self.__hooks = list(hooks)
+        # span name -> Histogram of its seconds
+        self.__spans = dict()
+        self.__lock = Lock()
+
+        self.__logger = logging.getLogger(__name__)
+
+    @property
+    def rate(self):
+        return self.__rate
+
+    @rate.setter
+    def rate(self, rate):
+        if not 0.0 <= rate <= 1.0:
+            raise ValueError('rate has to be between 0 and 1')
+        self.__rate = rate
+
+    def sample(self):
+        """
+        :return: True if the next call is traced
+        """
+        return self.__rate >= 1.0 or random.random() < self.__rate
+
+    def add_hook(self, hook):
+        with self.__lock:
+            self.__hooks.append(hook)
+
+    def remove_hook(self, hook):
+        with self.__lock:
+            self.__hooks.remove(hook)
+
+    def record(self, name, com_id, stamps):
+        """
+        Add a finished trace
+
+        :param name: name of the called function
+        :param com_id: id of the call
+        :param stamps: (hop, time.monotonic()) pairs
+        """
+        trace = {'name': name, 'com_id': com_id, 'stamps': stamps}
+        with self.__lock:
+            self.__traces.append(trace)
+            for span, _, seconds in segments(stamps):
+                histogram = self.__spans.get(span)
+                if histogram is None:
+                    histogram = self.__spans[span] = Histogram()
+                histogram.record(seconds)
+            hooks = list(self.__hooks)
+        for hook in hooks:
+            try:
+                hook(trace)
+            except Exception:
+                self.__logger.exception('Trace hook failed')
+
+    def traces(self):
+        """
+        :return: list of the kept traces, oldest first
+        """
+        with self.__lock:
+            return list(self.__traces)
+
+    def clear(self):
+        with self.__lock:
+            self.__traces.clear()
+            self.__spans.clear()
+
+    def stats(self):
+        """
+        :return: span name -> histogram snapshot of its seconds
+        """
+        with self.__lock:
+            return {span: histogram.snapshot()
+                    for span, histogram in self.__spans.items()}
+
+    def chrome_trace(self):
+        """
+        The kept traces in the Chrome trace event format
+
+        Every call is a row of its own (pid: client id of the caller,
+        tid: call counter) with one event for the whole call and one
+        event per span. Open the exported file in chrome://tracing or
+        Perfetto.
+
+        :return: dict ready for json.dump()
+        """
+        events = list()
+        for trace in self.traces():
+            stamps = trace['stamps']
+            if not stamps:
+                continue
+            pid = trace['com_id'] >> 32
+            tid = trace['com_id'] & 0xffffffff
+            start = stamps[0][1]
+            events.append({'name': trace['name'],
+                           'cat': 'call',
+                           'ph': 'X',
+                           'ts': start * 1e6,
+                           'dur': max(stamps[-1][1] - start, 0.0) * 1e6,
+                           'pid': pid,
+                           'tid': tid,
+                           'args': {'com_id': trace['com_id']}})
+            for span, span_start, seconds in segments(stamps):
+                events.append({'name': span,
+                               'cat': 'hop',
+                               'ph': 'X',
+                               'ts': span_start * 1e6,
+                               'dur': seconds * 1e6,
+                               'pid': pid,
+                               'tid': tid})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        """
+        Write chrome_trace() to a JSON file
+
+        :param path: path of the file
+        """
+        with open(path, 'w') as file:
+            json.dump(self.chrome_trace(), file)
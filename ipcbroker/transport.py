@@ -0,0 +1,133 @@
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client as connect_listener
+from multiprocessing.connection import Connection
+
+from ipcbroker.compression import CODECS
+from ipcbroker.compression import COMPRESSION_THRESHOLD
+from ipcbroker.compression import get_codec
+from ipcbroker.connection import MessageConnection
+
+
+class RemoteBroker:
+    """
+    A broker listening on a socket, see Broker.listen()
+
+    Clients take it in place of a Broker, e.g.
+    ``Client(RemoteBroker(('host', 6000), b'secret'))``. Every client gets
+    a connection of its own, so they can be created at any time and in any
+    process.
+    """
+    def __init__(self, address, authkey=None):
+        """
+        :param address: path of a Unix domain socket or (host, port)
+        :param authkey: key the broker was started with
+        """
+        self.__address = address
+        self.__authkey = authkey
+
+    def register_client(self, compact=None, compression=None):
+        """
+        Connect a client to the broker
+
+        :param compact: use compact binary framing on the connection,
+                        defaults to the setting of the broker
+        :param compression: Codec or codec name of the connection, False
+                            for none, defaults to the setting of the
+                            broker
+        :return: a connection to communicate with the broker
+        """
+        return connect(self.__address, self.__authkey, compact, compression)
+
+    @property
+    def address(self):
+        return self.__address
+
+
+def connect(address, authkey=None, compact=None, compression=None):
+    """
+    Connect to a listening broker
+
+    The broker answers the requested framing and codec with the client
+    id, the framing and the compression of the connection. A codec the
+    broker does not know is not used.
+
+    :param address: path of a Unix domain socket or (host, port)
+    :param authkey: key the broker was started with
+    :param compact: use compact binary framing, None for the setting of
+                    the broker
+    :param compression: Codec or codec name, False for none, None for the
+                        setting of the broker
+    :return: a MessageConnection
+    """
+    if compression:
+        compression = get_codec(compression).name
+    connection = connect_listener(address, authkey=authkey)
+    try:
+        connection.send({'compact': compact, 'compression': compression})
+        answer = connection.recv()
+    except (EOFError, OSError):
+        connection.close()
+        raise
+    return MessageConnection(connection,
+                             answer['compact'],
+                             answer['client_id'],
+                             answer['compression'],
+                             answer['compression_threshold'])
+
+
+def accept(connection: Connection,
+           client_id,
+           compact,
+           compression=None,
+           compression_threshold=COMPRESSION_THRESHOLD,
+           timeout=None):
+    """
+    Answer the handshake of connect()
+
+    :param connection: a connection accepted by a listener
+    :param client_id: id of the new client
+    :param compact: framing of the broker, used unless the client asks
+                    for one
+    :param compression: Codec of the broker, used unless the client asks
+                        for one
+    :param compression_threshold: smallest payload in bytes both ends
+                                  compress
+    :param timeout: seconds to wait for the request of the client, None
+                    to wait for ever
+    :return: a MessageConnection
+    """
+    if timeout is not None and not connection.poll(timeout):
+        raise TimeoutError('No handshake from the client')
+    request = connection.recv()
+    if request.get('compact') is not None:
+        compact = request['compact']
+    name = None if compression is None else compression.name
+    if request.get('compression') is not None:
+        name = request['compression'] or None
+        if name not in CODECS:
+            name = None
+    connection.send({'client_id': client_id,
+                     'compact': compact,
+                     'compression': name,
+                     'compression_threshold': compression_threshold})
+    return MessageConnection(connection,
+                             compact,
+                             client_id,
+                             name,
+                             compression_threshold)
+
+
+def close_listener(listener):
+    """
+    Close a listener and wake up the thread blocked in its accept()
+
+    accept() is not interrupted by close(), a connection wakes it up. The
+    thread has to check if its listener was closed. The connection does
+    not authenticate: if the thread is not waiting in accept() any more,
+    nobody would answer.
+    """
+    try:
+        connect_listener(listener.address).close()
+    except (EOFError, OSError, AuthenticationError):
+        pass
+    listener.close()
@@ -2,12 +2,19 @@ import setuptools
 
 setuptools.setup(
     name='ipcbroker',
-    packages=['ipcbroker'],
+    packages=['ipcbroker', 'ipcbroker.benchmark'],
     version='0.4',
     description='Interprocess communication framework',
     author='Matthias Gilch',
     author_email='matthias.gilch.mg@gmail.com',
     url='https://github.com/DaGuich/ipcbroker',
     download_url='https://github.com/DaGuich/ipcbroker/archive/0.4.tar.gz',
-    keywords=['IPC', 'interprocess', 'communication', 'broker', 'client']
+    keywords=['IPC', 'interprocess', 'communication', 'broker', 'client'],
+    # shared memory segments and worker pools need Python 3.8
+    python_requires='>=3.8',
+    entry_points={
+        'console_scripts': [
+            'ipcbroker-benchmark = ipcbroker.benchmark.__main__:main'
+        ]
+    }
 )
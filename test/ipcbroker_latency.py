@@ -0,0 +1,35 @@
+import statistics
+import time
+
+import ipcbroker
+
+
+def echo(value):
+    return value
+
+
+if __name__ == '__main__':
+    broker = ipcbroker.Broker().start()
+    provider = ipcbroker.Client(broker).start()
+    caller = ipcbroker.Client(broker).start()
+    provider.register_function('echo', echo)
+
+    # warm up
+    for i in range(10):
+        caller.echo(i)
+
+    samples = list()
+    for i in range(200):
+        start = time.perf_counter()
+        caller.echo(i)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+
+    print('round trips: {}'.format(len(samples)))
+    print('p50: {:.3f} ms'.format(statistics.median(samples) * 1000))
+    print('p99: {:.3f} ms'.format(samples[int(len(samples) * 0.99)] * 1000))
+    print('mean: {:.3f} ms'.format(statistics.mean(samples) * 1000))
+
+    caller.stop()
+    provider.stop()
+    broker.stop()
@@ -1,9 +1,35 @@
+from queue import Full
+from threading import Event, Thread, Timer
 from unittest import TestCase
+import asyncio
+import gc
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import socket
+import subprocess
+import sys
 import time
+import zlib
 
 # from ipcbroker.broker import Broker
 # from ipcbroker.client import Client
-from ipcbroker import Broker, Client
+from ipcbroker import (AsyncClient, Broker, Client, Priority,
+                       RemoteBroker, Tracer)
+from ipcbroker.benchmark import compare, run, run_case
+from ipcbroker.cache import ResultCache
+from ipcbroker.compression import Codec, get_codec
+from ipcbroker.connection import Compressor
+from ipcbroker.lanes import LaneQueue
+from ipcbroker.message import Flag, Message
+from ipcbroker.policy import Policy, get_policy
+from ipcbroker.sender import Sender
+from ipcbroker.sharedmem import get_pool
+from ipcbroker.stats import Histogram
+from ipcbroker.stream import StreamCredits
+from ipcbroker.threaded import Threaded
 
 
 def add(a, b):
@@ -14,6 +40,14 @@ def sub(a, b):
     return a - b
 
 
+def div(a, b):
+    return a / b
+
+
+def echo(value):
+    return value
+
+
 def long_running_method():
     time.sleep(2)
     return True
@@ -50,6 +84,19 @@ class IpcBrokerTestCase(TestCase):
         self.assertEqual(self.broker.n_functions, 1)
         ca.stop()
 
+    def test_malformed_request(self):
+        connection = self.broker.register_client()
+        # the router answers with the exception and goes on
+        connection.send(Message('register_function', None, 1))
+        self.assertTrue(connection.poll(5))
+        with self.assertRaises(TypeError):
+            connection.recv().payload
+        ca = Client(self.broker, 'tmr_ca').start()
+        ca.register_function('add', add)
+        self.assertEqual(ca.add(1, 2), 3)
+        connection.close()
+        ca.stop()
+
     def test_call_function_local(self):
         ca = Client(self.broker, 'tcfl_ca').start()
         ca.register_function('add', add)
@@ -106,3 +153,1424 @@ class IpcBrokerTestCase(TestCase):
         ca.stop()
         cb.stop()
 
+    def test_call_async(self):
+        ca = Client(self.broker, 'tca_ca').start()
+        cb = Client(self.broker, 'tca_cb').start()
+        success = ca.register_function('add', add)
+        self.assertTrue(success)
+        futures = [cb.call_async('add', i, i) for i in range(20)]
+        self.assertEqual([future.result(5) for future in futures],
+                         [i + i for i in range(20)])
+        self.assertEqual(cb.futures.add(3, 4).result(5), 7)
+        self.assertEqual(ca.futures.add(3, 4).result(5), 7)
+        ca.stop()
+        cb.stop()
+
+    def test_shared_memory(self):
+        ca = Client(self.broker, 'tsm_ca',
+                    shared_memory_threshold=1 << 16).start()
+        cb = Client(self.broker, 'tsm_cb',
+                    shared_memory_threshold=1 << 16).start()
+        success = ca.register_function('echo', echo)
+        self.assertTrue(success)
+        data = bytes(range(256)) * 8192
+        self.assertEqual(cb.echo(data), data)
+        result = cb.echo({'frame': bytearray(data), 'id': 1})
+        self.assertEqual(result, {'frame': bytearray(data), 'id': 1})
+        self.assertEqual(cb.echo(memoryview(data)).tobytes(), data)
+        self.assertEqual(cb.echo(b'small'), b'small')
+        ca.stop()
+        cb.stop()
+
+    def test_call_many(self):
+        ca = Client(self.broker, 'tcm_ca').start()
+        cb = Client(self.broker, 'tcm_cb').start()
+        ca.register_function('add', add)
+        ca.register_function('div', div)
+        args = [(i, i) for i in range(1000)]
+        self.assertEqual(cb.call_many('add', args),
+                         [i + i for i in range(1000)])
+        self.assertEqual(ca.call_many('add', args),
+                         [i + i for i in range(1000)])
+        results = cb.call_many('div', [(4, 2), (1, 0), (9, 3)])
+        self.assertEqual(results[0], 2)
+        self.assertIsInstance(results[1], ZeroDivisionError)
+        self.assertEqual(results[2], 3)
+        self.assertEqual(cb.map('add', [1, 2, 3], [4, 5, 6]), [5, 7, 9])
+        with self.assertRaises(ZeroDivisionError):
+            cb.map('div', [1, 2], [1, 0])
+        ca.stop()
+        cb.stop()
+
+    def test_multiple_providers(self):
+        ca = Client(self.broker, 'tmp_ca').start()
+        cb = Client(self.broker, 'tmp_cb').start()
+        cc = Client(self.broker, 'tmp_cc').start()
+        self.assertTrue(ca.register_function('who', lambda: 'a'))
+        self.assertTrue(cb.register_function('who', lambda: 'b'))
+        self.assertEqual(self.broker.n_functions, 1)
+        results = [cc.who() for _ in range(4)]
+        self.assertEqual(sorted(results), ['a', 'a', 'b', 'b'])
+        ca.stop()
+        cb.stop()
+        cc.stop()
+
+    def test_executor(self):
+        ca = Client(self.broker, 'te_ca').start()
+        cb = Client(self.broker, 'te_cb').start()
+        ca.register_function('slow',
+                             lambda: time.sleep(1) or 'slow',
+                             executor='thread')
+        ca.register_function('add', add, executor='process')
+        ca.register_function('div', div)
+        slow = cb.call_async('slow')
+        # answered while the slow call is still running
+        self.assertEqual(cb.add(1, 2), 3)
+        self.assertFalse(slow.done())
+        self.assertEqual(slow.result(5), 'slow')
+        with self.assertRaises(ZeroDivisionError):
+            cb.div(1, 0)
+        ca.stop()
+        cb.stop()
+
+    def test_max_concurrency(self):
+        ca = Client(self.broker, 'tmc_ca').start()
+        cb = Client(self.broker, 'tmc_cb').start()
+        running = list()
+
+        def count_running():
+            running.append(1)
+            time.sleep(0.1)
+            result = len(running)
+            running.pop()
+            return result
+
+        ca.register_function('count_running',
+                             count_running,
+                             executor='thread',
+                             max_concurrency=2)
+        futures = [cb.call_async('count_running') for _ in range(6)]
+        self.assertEqual(max(future.result(5) for future in futures), 2)
+        ca.stop()
+        cb.stop()
+
+    def test_notify(self):
+        ca = Client(self.broker, 'tn_ca').start()
+        cb = Client(self.broker, 'tn_cb').start()
+        received = list()
+        ca.register_function('log', received.append)
+        cb.notify.log('first')
+        cb.notify('log', 'second')
+        cb.notify.unknown('dropped')
+        # a regular call is answered after the notifications ran
+        ca.register_function('count', lambda: len(received))
+        self.assertEqual(cb.count(), 2)
+        self.assertEqual(received, ['first', 'second'])
+        ca.stop()
+        cb.stop()
+
+    def test_publish_subscribe(self):
+        ca = Client(self.broker, 'tps_ca').start()
+        cb = Client(self.broker, 'tps_cb').start()
+        cc = Client(self.broker, 'tps_cc').start()
+        received_a = list()
+        received_b = list()
+        self.assertTrue(ca.subscribe('prices', received_a.append))
+        self.assertTrue(cb.subscribe('prices', received_b.append))
+        cc.publish('prices', {'EUR': 1.1})
+        cc.publish('other', 'ignored')
+        deadline = time.time() + 5
+        while (not received_a or not received_b) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(received_a, [{'EUR': 1.1}])
+        self.assertEqual(received_b, [{'EUR': 1.1}])
+
+        cb.unsubscribe('prices')
+        cc.publish('prices', 'second')
+        while len(received_a) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(received_a, [{'EUR': 1.1}, 'second'])
+        self.assertEqual(received_b, [{'EUR': 1.1}])
+        ca.stop()
+        cb.stop()
+        cc.stop()
+
+    def test_cache(self):
+        ca = Client(self.broker, 'tc_ca').start()
+        cb = Client(self.broker, 'tc_cb').start()
+        calls = list()
+
+        def lookup(key):
+            calls.append(key)
+            return key.upper()
+
+        ca.register_function('lookup', lookup, cacheable=True)
+        ca.register_function('div', div, cacheable=True)
+        self.assertEqual(cb.lookup('a'), 'A')
+        self.assertEqual(cb.lookup('a'), 'A')
+        self.assertEqual(cb.lookup('b'), 'B')
+        self.assertEqual(calls, ['a', 'b'])
+        self.assertEqual(self.broker.cache_stats()['lookup'],
+                         {'hits': 1, 'misses': 2, 'entries': 2})
+
+        # errors are not cached
+        for _ in range(2):
+            with self.assertRaises(ZeroDivisionError):
+                cb.div(1, 0)
+        self.assertEqual(self.broker.cache_stats()['div']['entries'], 0)
+
+        cb.invalidate_cache('lookup')
+        self.assertEqual(cb.lookup('a'), 'A')
+        self.assertEqual(calls, ['a', 'b', 'a'])
+        ca.stop()
+        cb.stop()
+
+    def test_cache_options(self):
+        ca = Client(self.broker, 'tco_ca').start()
+        with self.assertRaises(TypeError):
+            ca.register_function('add', add, cacheable=True, ttl='x')
+        with self.assertRaises(ValueError):
+            ca.register_function('add', add, cacheable=True,
+                                 max_entries=0)
+        self.assertEqual(self.broker.n_functions, 0)
+        self.assertTrue(ca.register_function('add', add, cacheable=True,
+                                             ttl=0.5))
+
+        async def main():
+            cb = AsyncClient(self.broker).start()
+            with self.assertRaises(ValueError):
+                await cb.register_function('sub', sub, cacheable=True,
+                                           ttl=-1)
+            cb.stop()
+
+        asyncio.run(main())
+        self.assertEqual(self.broker.n_functions, 1)
+        ca.stop()
+
+    def test_cache_shared_memory(self):
+        ca = Client(self.broker, 'tcs_ca').start()
+        cb = Client(self.broker, 'tcs_cb',
+                    shared_memory_threshold=1 << 16).start()
+        ca.register_function('first', lambda data: data[0], cacheable=True)
+        # the segment of the first call is reused by the second one, the
+        # handles of both requests are equal
+        self.assertEqual(cb.first(bytes([1]) * (1 << 17)), 1)
+        self.assertEqual(cb.first(bytes([2]) * (1 << 17)), 2)
+        self.assertEqual(self.broker.cache_stats()['first']['hits'], 0)
+        ca.stop()
+        cb.stop()
+
+    def test_call_timeout(self):
+        ca = Client(self.broker, 'tct_ca').start()
+        cb = Client(self.broker, 'tct_cb').start()
+        ca.register_function('sleep', time.sleep, executor='thread')
+        start = time.time()
+        with self.assertRaises(TimeoutError):
+            cb.call('sleep', 1, timeout=0.2)
+        self.assertLess(time.time() - start, 0.9)
+        self.assertIsNone(cb.call('sleep', 0, timeout=1))
+
+        # the broker forgets cancelled calls
+        future = cb.call_async('sleep', 1)
+        self.assertTrue(future.cancel())
+        deadline = time.time() + 5
+        while self.broker.n_open_messages and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.broker.n_open_messages, 0)
+        ca.stop()
+        cb.stop()
+
+    def test_stats(self):
+        ca = Client(self.broker, 'ts_ca').start()
+        cb = Client(self.broker, 'ts_cb').start()
+        ca.register_function('add', add)
+        ca.register_function('div', div)
+        self.assertEqual(cb.add(1, 2), 3)
+        self.assertEqual(cb.add(3, 4), 7)
+        with self.assertRaises(ZeroDivisionError):
+            cb.div(1, 0)
+
+        stats = self.broker.stats()
+        self.assertEqual(stats['clients'], 2)
+        self.assertEqual(stats['open_messages'], 0)
+        self.assertEqual(stats['functions']['add']['calls'], 2)
+        self.assertEqual(stats['functions']['add']['errors'], 0)
+        self.assertEqual(stats['functions']['add']['latency']['count'], 2)
+        self.assertEqual(stats['functions']['div']['errors'], 1)
+        self.assertGreater(stats['connections'][ca.client_id]['bytes_sent'],
+                           0)
+
+        stats = cb.stats()
+        self.assertEqual(stats['functions']['add']['calls'], 2)
+        self.assertEqual(stats['functions']['div']['errors'], 1)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertGreater(stats['connection']['bytes_received'], 0)
+        self.assertEqual(cb.broker_stats()['functions']['add']['calls'], 2)
+        ca.stop()
+        cb.stop()
+
+    def test_peer(self):
+        ca = Client(self.broker, 'tp_ca').start()
+        cb = Client(self.broker, 'tp_cb').start()
+        ca.register_function('add', add)
+        self.assertFalse(cb.connect_peer('add'))
+        ca.listen()
+        self.assertFalse(cb.connect_peer('unknown'))
+        self.assertTrue(cb.connect_peer('add'))
+
+        # direct calls do not pass the broker
+        self.assertEqual(cb.add(1, 2), 3)
+        self.assertEqual(cb.futures.add(3, 4).result(5), 7)
+        self.assertNotIn('add', self.broker.stats()['functions'])
+
+        # without the direct connection calls go through the broker
+        ca.stop_listening()
+        self.assertEqual(cb.add(5, 6), 11)
+        self.assertEqual(self.broker.stats()['functions']['add']['calls'], 1)
+        ca.stop()
+        cb.stop()
+
+    def test_cancel(self):
+        ca = Client(self.broker, 'tcn_ca').start()
+        cb = Client(self.broker, 'tcn_cb').start()
+        calls = list()
+
+        def slow(value):
+            calls.append(value)
+            time.sleep(0.3)
+            return value
+
+        ca.register_function('slow',
+                             slow,
+                             executor='thread',
+                             max_concurrency=1)
+        first = cb.call_async('slow', 1)
+        second = cb.call_async('slow', 2)
+        time.sleep(0.1)
+        self.assertTrue(second.cancel())
+        self.assertEqual(first.result(5), 1)
+        self.assertEqual(cb.slow(3), 3)
+        self.assertEqual(calls, [1, 3])
+        ca.stop()
+        cb.stop()
+
+    def test_stream(self):
+        ca = Client(self.broker, 'tst_ca').start()
+        cb = Client(self.broker, 'tst_cb').start()
+        produced = list()
+
+        def count(n):
+            for i in range(n):
+                produced.append(i)
+                yield i
+
+        def fail():
+            yield 1
+            raise ValueError('failed')
+
+        ca.register_function('count', count)
+        ca.register_function('fail', fail)
+        self.assertEqual(list(cb.stream('count', 50, window=4)),
+                         list(range(50)))
+        self.assertEqual(list(cb.stream('count', 0)), [])
+
+        # the producer stays within the window of the consumer
+        del produced[:]
+        stream = cb.stream('count', 100, window=4)
+        self.assertEqual(next(stream), 0)
+        time.sleep(0.2)
+        self.assertLessEqual(len(produced), 6)
+        stream.close()
+        self.assertEqual(list(stream), [])
+        time.sleep(0.1)
+        self.assertLess(len(produced), 100)
+
+        stream = cb.stream('fail')
+        self.assertEqual(next(stream), 1)
+        with self.assertRaises(ValueError):
+            next(stream)
+        ca.stop()
+        cb.stop()
+
+    def test_stream_abandoned(self):
+        ca = Client(self.broker, 'tsa_ca').start()
+        cb = Client(self.broker, 'tsa_cb').start()
+        closed = Event()
+
+        def count():
+            try:
+                yield from itertools.count()
+            finally:
+                closed.set()
+
+        ca.register_function('count', count)
+        stream = cb.stream('count', window=2)
+        self.assertEqual(next(stream), 0)
+        # dropped without close(), the producer must not wait forever
+        del stream
+        gc.collect()
+        self.assertTrue(closed.wait(5))
+
+        credits = StreamCredits(0)
+        with self.assertRaises(TimeoutError):
+            credits.take(0.05)
+        credits.cancel()
+        self.assertFalse(credits.take(0.05))
+        ca.stop()
+        cb.stop()
+
+    def test_coalesce(self):
+        ca = Client(self.broker, 'tco_ca').start()
+        cb = Client(self.broker, 'tco_cb').start()
+        cc = Client(self.broker, 'tco_cc').start()
+        calls = list()
+
+        def slow(value):
+            calls.append(value)
+            time.sleep(0.2)
+            return 1 / value
+
+        ca.register_function('slow', slow, executor='thread', coalesce=True)
+        futures = [client.call_async('slow', 1)
+                   for client in (cb, cc) for _ in range(5)]
+        other = cb.call_async('slow', 2)
+        failed = cc.call_async('slow', 0)
+        # the first caller gives up, the others still get the result
+        self.assertTrue(futures[0].cancel())
+        self.assertEqual([future.result(5) for future in futures[1:]],
+                         [1.0] * 9)
+        self.assertEqual(other.result(5), 0.5)
+        with self.assertRaises(ZeroDivisionError):
+            failed.result(5)
+        self.assertEqual(sorted(calls), [0, 1, 2])
+        self.assertEqual(self.broker.stats()['functions']['slow']['coalesced'],
+                         9)
+
+        # answered calls are not coalesced with later ones
+        self.assertEqual(cb.slow(1), 1.0)
+        self.assertEqual(sorted(calls), [0, 1, 1, 2])
+        self.assertEqual(self.broker.n_open_messages, 0)
+        ca.stop()
+        cb.stop()
+        cc.stop()
+
+    def test_coalesce_timeout(self):
+        ca = Client(self.broker, 'tcot_ca').start()
+        cb = Client(self.broker, 'tcot_cb', timeout=0.3).start()
+        cc = Client(self.broker, 'tcot_cc', timeout=5).start()
+        calls = list()
+
+        def slow(value):
+            calls.append(value)
+            time.sleep(0.6)
+            return value
+
+        ca.register_function('slow', slow, executor='thread', coalesce=True)
+        leader = cb.call_async('slow', 1)
+        follower = cc.call_async('slow', 1)
+        # the call goes on for the follower with the longer timeout
+        with self.assertRaises(TimeoutError):
+            leader.result(5)
+        self.assertEqual(follower.result(5), 1)
+        self.assertEqual(calls, [1])
+        self.assertEqual(self.broker.n_open_messages, 0)
+        ca.stop()
+        cb.stop()
+        cc.stop()
+
+    def test_stream_peer(self):
+        ca = Client(self.broker, 'tsp_ca').start()
+        cb = Client(self.broker, 'tsp_cb').start()
+        ca.register_function('count', lambda n: iter(range(n)))
+        ca.listen()
+        cb.connect_peer('count')
+        self.assertEqual(list(cb.stream('count', 20, window=2)),
+                         list(range(20)))
+        self.assertEqual(self.broker.n_open_messages, 0)
+        ca.stop()
+        cb.stop()
+
+
+class LeastOutstandingIpcBrokerTestCase(TestCase):
+    def setUp(self):
+        self.broker = Broker('broker', policy='least_outstanding').start()
+
+    def tearDown(self):
+        self.broker.stop()
+
+    def test_least_outstanding(self):
+        ca = Client(self.broker, 'tlo_ca').start()
+        cb = Client(self.broker, 'tlo_cb').start()
+        cc = Client(self.broker, 'tlo_cc').start()
+        ca.register_function('who', lambda: time.sleep(0.5) or 'a')
+        cb.register_function('who', lambda: 'b')
+        # the first request keeps a busy, round robin would use it again
+        slow = cc.call_async('who')
+        time.sleep(0.1)
+        self.assertEqual(cc.who(), 'b')
+        self.assertEqual(cc.who(), 'b')
+        self.assertEqual(slow.result(5), 'a')
+        ca.stop()
+        cb.stop()
+        cc.stop()
+
+    def test_custom_policy(self):
+        class Incomplete(Policy):
+            pass
+
+        class Last(Policy):
+            def select(self, name, providers, outstanding):
+                return providers[-1]
+
+        # subclasses have to implement select()
+        with self.assertRaises(TypeError):
+            Incomplete()
+        policy = Last()
+        self.assertIs(get_policy(policy), policy)
+        self.assertEqual(policy.select('who', ['a', 'b'], dict()), 'b')
+
+
+class TimeoutIpcBrokerTestCase(TestCase):
+    def setUp(self):
+        self.broker = Broker('broker', timeout=0.2).start()
+
+    def tearDown(self):
+        self.broker.stop()
+
+    def test_broker_timeout(self):
+        ca = Client(self.broker, 'tbt_ca').start()
+        cb = Client(self.broker, 'tbt_cb').start()
+        ca.register_function('sleep', time.sleep, executor='thread')
+        with self.assertRaises(TimeoutError):
+            cb.call_async('sleep', 1).result(5)
+        self.assertEqual(self.broker.n_open_messages, 0)
+        self.assertIsNone(cb.sleep(0))
+        ca.stop()
+        cb.stop()
+
+    def test_answered_deadlines(self):
+        ca = Client(self.broker, 'tad_ca').start()
+        cb = Client(self.broker, 'tad_cb', timeout=30).start()
+        ca.register_function('add', add)
+        ca.register_function('sleep', time.sleep, executor='thread')
+        # the heap is rebuilt while the answered calls pile up in it
+        for _ in range(Broker.MIN_STALE_DEADLINES * 3 // 256):
+            futures = [cb.call_async('add', i, i) for i in range(256)]
+            self.assertEqual([future.result(5) for future in futures],
+                             [i + i for i in range(256)])
+        # the broker still answers expired calls with the default timeout
+        cc = Client(self.broker, 'tad_cc').start()
+        with self.assertRaises(TimeoutError):
+            cc.call_async('sleep', 1).result(5)
+        self.assertEqual(self.broker.n_open_messages, 0)
+        ca.stop()
+        cb.stop()
+        cc.stop()
+
+
+class FlowControlIpcBrokerTestCase(TestCase):
+    def tearDown(self):
+        self.broker.stop()
+
+    def start_clients(self, **broker_options):
+        self.broker = Broker('broker',
+                             max_outstanding=1,
+                             queue_size=1,
+                             **broker_options).start()
+        ca = Client(self.broker, 'tfc_ca').start()
+        cb = Client(self.broker, 'tfc_cb').start()
+
+        def slow(value):
+            time.sleep(0.2)
+            return value
+
+        ca.register_function('slow', slow, executor='thread')
+        return ca, cb
+
+    def test_fail(self):
+        ca, cb = self.start_clients(overflow='fail')
+        futures = [cb.call_async('slow', value) for value in range(3)]
+        with self.assertRaises(Full):
+            futures[2].result(5)
+        self.assertEqual(self.broker.n_queued_messages, 1)
+        self.assertEqual([future.result(5) for future in futures[:2]],
+                         [0, 1])
+        self.assertEqual(self.broker.n_open_messages, 0)
+        ca.stop()
+        cb.stop()
+
+    def test_shed(self):
+        ca, cb = self.start_clients(overflow='shed')
+        futures = [cb.call_async('slow', value) for value in range(3)]
+        with self.assertRaises(Full):
+            futures[1].result(5)
+        self.assertEqual(futures[0].result(5), 0)
+        self.assertEqual(futures[2].result(5), 2)
+        ca.stop()
+        cb.stop()
+
+    def test_shared_memory_release(self):
+        self.broker = Broker('broker',
+                             max_outstanding=1,
+                             queue_size=1).start()
+        ca = Client(self.broker, 'tsmr_ca').start()
+        cb = Client(self.broker, 'tsmr_cb',
+                    shared_memory_threshold=1 << 16).start()
+
+        def sleep(seconds, data=None):
+            time.sleep(seconds)
+
+        ca.register_function('sleep', sleep, executor='thread')
+        data = bytes(1 << 16)
+        busy = cb.call_async('sleep', 0.3)
+        # queued until it times out, then refused by the full queue
+        with self.assertRaises(TimeoutError):
+            cb.call('sleep', 0, data, timeout=0.1)
+        queued = cb.call_async('sleep', 0)
+        with self.assertRaises(Full):
+            cb.call('sleep', 0, data)
+        busy.result(5)
+        queued.result(5)
+        # the requests were never read, their segments are free again
+        self.assertEqual(get_pool().n_used, 0)
+        ca.stop()
+        cb.stop()
+
+    def test_max_in_flight(self):
+        self.broker = Broker('broker').start()
+        ca = Client(self.broker, 'tmif_ca').start()
+        cb = Client(self.broker, 'tmif_cb', max_in_flight=1,
+                    overflow='fail').start()
+        ca.register_function('sleep', time.sleep, executor='thread')
+        future = cb.call_async('sleep', 0.2)
+        with self.assertRaises(Full):
+            cb.call_async('sleep', 0)
+        future.result(5)
+        self.assertIsNone(cb.sleep(0))
+        ca.stop()
+        cb.stop()
+
+    def test_send_queue(self):
+        self.broker = Broker('broker', send_queue_size=4).start()
+        ca = Client(self.broker, 'tsq_ca').start()
+        cb = Client(self.broker, 'tsq_cb').start()
+        ca.register_function('echo', echo)
+        # connected, but nobody reads the connection
+        ca.stop()
+        for _ in range(100):
+            cb.notify.echo('x' * 10000)
+        deadline = time.monotonic() + 5
+        while self.broker.n_clients > 1:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        self.assertEqual(self.broker.n_functions, 0)
+        cb.stop()
+
+    def test_priority(self):
+        self.broker = Broker('broker', max_outstanding=1).start()
+        ca = Client(self.broker, 'tpri_ca').start()
+        cb = Client(self.broker, 'tpri_cb').start()
+        calls = list()
+
+        def work(value):
+            calls.append(value)
+            time.sleep(0.02)
+            return value
+
+        ca.register_function('work',
+                             work,
+                             executor='thread',
+                             priority=Priority.LOW)
+        bulk = [cb.call_async('work', value) for value in range(20)]
+        time.sleep(0.05)
+        self.assertEqual(cb.call('work', 'urgent', priority=Priority.HIGH),
+                         'urgent')
+        # overtakes the queued bulk calls
+        self.assertLess(calls.index('urgent'), 6)
+        self.assertEqual([future.result(5) for future in bulk],
+                         list(range(20)))
+        lanes = self.broker.stats()['lanes']
+        self.assertEqual(lanes['high']['wait']['count'], 1)
+        self.assertEqual(lanes['low']['wait']['count'], 20)
+        self.assertEqual(lanes['low']['queued'], 0)
+        ca.stop()
+        cb.stop()
+
+
+class FailoverIpcBrokerTestCase(TestCase):
+    def tearDown(self):
+        self.broker.stop()
+
+    def start_clients(self, **broker_options):
+        self.broker = Broker('broker', heartbeat=0.05, **broker_options)
+        self.broker.start()
+        ca = Client(self.broker, 'tfo_ca').start()
+        cb = Client(self.broker, 'tfo_cb').start()
+        cc = Client(self.broker, 'tfo_cc').start()
+        ca.register_function('who', lambda: 'a')
+        cb.register_function('who', lambda: 'b')
+        # answers pings while it is idle
+        time.sleep(0.3)
+        self.assertEqual(self.broker.n_clients, 3)
+        # a hung client: connected, but nobody reads the connection
+        ca.stop()
+        return ca, cb, cc
+
+    def test_failover(self):
+        ca, cb, cc = self.start_clients(failover=True)
+        futures = [cc.call_async('who') for _ in range(2)]
+        self.assertEqual([future.result(5) for future in futures],
+                         ['b', 'b'])
+        self.assertEqual(self.broker.n_clients, 2)
+        self.assertEqual(self.broker.n_open_messages, 0)
+        stats = self.broker.stats()['functions']['who']
+        self.assertEqual(stats['failovers'], 1)
+        self.assertEqual(cc.who(), 'b')
+        cb.stop()
+        cc.stop()
+
+    def test_fail(self):
+        ca, cb, cc = self.start_clients()
+        futures = [cc.call_async('who') for _ in range(2)]
+        results = list()
+        for future in futures:
+            try:
+                results.append(future.result(5))
+            except ConnectionError:
+                results.append(None)
+        self.assertEqual(results.count('b'), 1)
+        self.assertEqual(results.count(None), 1)
+        self.assertEqual(self.broker.n_open_messages, 0)
+        cb.stop()
+        cc.stop()
+
+    def test_busy(self):
+        self.broker = Broker('broker', heartbeat=0.05).start()
+        ca = Client(self.broker, 'tfb_ca').start()
+        cb = Client(self.broker, 'tfb_cb').start()
+        cc = Client(self.broker, 'tfb_cc').start()
+
+        def nap():
+            # runs inline, for many heartbeat intervals
+            time.sleep(0.5)
+            return 'nap'
+
+        ca.register_function('nap', nap)
+        cb.register_function('nap', nap)
+        time.sleep(0.3)
+        futures = [cc.call_async('nap') for _ in range(2)]
+        self.assertEqual([future.result(5) for future in futures],
+                         ['nap', 'nap'])
+        self.assertEqual(self.broker.n_clients, 3)
+        ca.stop()
+        cb.stop()
+        cc.stop()
+
+
+class TracingIpcBrokerTestCase(TestCase):
+    def setUp(self):
+        self.broker = Broker('broker').start()
+        self.tracer = Tracer()
+        self.provider = Client(self.broker, 'tt_provider').start()
+        self.provider.register_function('add', add)
+        self.provider.register_function('div', div)
+        self.client = Client(self.broker,
+                             'tt_client',
+                             tracer=self.tracer).start()
+
+    def tearDown(self):
+        self.client.stop()
+        self.provider.stop()
+        self.broker.stop()
+
+    def test_trace(self):
+        traces = list()
+        self.tracer.add_hook(traces.append)
+        self.assertEqual(self.client.add(1, 2), 3)
+        with self.assertRaises(ZeroDivisionError):
+            self.client.div(1, 0)
+        self.assertEqual([trace['name'] for trace in traces],
+                         ['add', 'div'])
+        self.assertEqual(self.tracer.traces(), traces)
+        for trace in traces:
+            hops = [hop for hop, _ in trace['stamps']]
+            self.assertEqual(hops, ['call', 'send',
+                                    'broker_receive', 'broker_forward',
+                                    'provider_receive',
+                                    'handler_start', 'handler_end',
+                                    'reply',
+                                    'broker_receive', 'broker_forward',
+                                    'receive'])
+            times = [stamp for _, stamp in trace['stamps']]
+            self.assertEqual(times, sorted(times))
+        stats = self.tracer.stats()
+        self.assertEqual(stats['handler']['count'], 2)
+        self.assertEqual(stats['broker return']['count'], 2)
+
+        events = json.loads(json.dumps(self.tracer.chrome_trace()))
+        events = events['traceEvents']
+        calls = [event for event in events if event['cat'] == 'call']
+        self.assertEqual([event['name'] for event in calls],
+                         ['add', 'div'])
+        self.assertEqual(len(events), 2 + 2 * 10)
+        self.assertTrue(all(event['dur'] >= 0 for event in events))
+
+    def test_sampling(self):
+        self.tracer.rate = 0
+        self.assertEqual(self.client.add(1, 2), 3)
+        self.assertEqual(self.tracer.traces(), [])
+        with self.assertRaises(ValueError):
+            self.tracer.rate = 2
+        # untraced clients and broker actions are not traced
+        self.tracer.rate = 1
+        self.assertEqual(self.provider.add(1, 2), 3)
+        self.client.broker_stats()
+        self.assertEqual(self.tracer.traces(), [])
+
+    def test_failing_hook(self):
+        def fail(trace):
+            raise RuntimeError(trace)
+        self.tracer.add_hook(fail)
+        self.assertEqual(self.client.add(1, 2), 3)
+        self.assertEqual(len(self.tracer.traces()), 1)
+        self.tracer.clear()
+        self.assertEqual(self.tracer.traces(), [])
+
+
+class CompactIpcBrokerTestCase(IpcBrokerTestCase):
+    def setUp(self):
+        self.broker = Broker('broker', compact=True).start()
+
+
+class ShardedIpcBrokerTestCase(IpcBrokerTestCase):
+    def setUp(self):
+        self.broker = Broker('broker', shards=3).start()
+
+    def test_shard_timeout(self):
+        ca = Client(self.broker, 'sst_ca').start()
+        ca.register_function('sleep', time.sleep, executor='thread')
+        # the callers read by the other routers are expired by the first
+        callers = [Client(self.broker, 'sst_c{}'.format(index),
+                          timeout=0.2).start()
+                   for index in range(3)]
+        for caller in callers:
+            with self.assertRaises(TimeoutError):
+                caller.call_async('sleep', 1).result(5)
+            caller.stop()
+        self.assertEqual(self.broker.n_open_messages, 0)
+        ca.stop()
+
+
+class CompressedIpcBrokerTestCase(IpcBrokerTestCase):
+    def setUp(self):
+        self.broker = Broker('broker',
+                             compact=True,
+                             compression='zlib',
+                             compression_threshold=0).start()
+
+    def test_compression(self):
+        ca = Client(self.broker, 'tcm_ca').start()
+        cb = Client(self.broker, 'tcm_cb').start()
+        ca.register_function('echo', echo)
+        text = 'GET /index.html 200\n' * 1000
+        self.assertEqual(cb.echo(text), text)
+        noise = os.urandom(10000)
+        self.assertEqual(cb.echo(noise), noise)
+
+        # the broker forwards the payloads the clients compressed
+        stats = self.broker.stats()['compression']
+        self.assertEqual(stats['zlib']['compressed'], 0)
+        stats = cb.stats()['connection']['compression']
+        self.assertEqual(stats['codec'], 'zlib')
+        self.assertGreaterEqual(stats['compressed'], 1)
+        self.assertGreaterEqual(stats['skipped'], 1)
+        self.assertLess(stats['ratio'], 0.1)
+        ca.stop()
+        cb.stop()
+
+
+class FastZlibCodec(Codec):
+    name = 'fast_zlib'
+    codec_id = 200
+
+    def compress(self, data):
+        return zlib.compress(data, 1)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class CompressionTestCase(TestCase):
+    def test_compressor(self):
+        compressor = Compressor('zlib', threshold=100)
+        small = Message('echo', 'a' * 10, 1)
+        self.assertIs(compressor.compress(small), small)
+        large = compressor.compress(Message('echo', 'a' * 1000, 2))
+        self.assertTrue(large.flags & Flag.COMPRESSED)
+        self.assertIs(compressor.compress(large), large)
+        parsed = Message.from_bytes(large.to_bytes())
+        self.assertEqual(parsed.payload, 'a' * 1000)
+
+        # incompressible payloads are tried less often
+        for index in range(Compressor.MAX_MISSES + 8):
+            message = Message('echo', os.urandom(1000), index)
+            self.assertIs(compressor.compress(message), message)
+        stats = compressor.stats()
+        self.assertEqual(stats['compressed'], 1)
+        self.assertEqual(stats['skipped'], Compressor.MAX_MISSES + 8)
+
+    def test_codec(self):
+        with self.assertRaises(ValueError):
+            get_codec('unknown')
+        # codecs have to implement compress() and decompress()
+        with self.assertRaises(TypeError):
+            type('Incomplete', (Codec,), {'compress': zlib.compress})()
+        compressor = Compressor(FastZlibCodec())
+        self.assertIs(get_codec('fast_zlib'), compressor.codec)
+        message = compressor.compress(Message('echo', 'abc' * 1000, 1))
+        self.assertTrue(message.flags & Flag.COMPRESSED)
+        self.assertEqual(message.raw_payload[0], FastZlibCodec.codec_id)
+        self.assertEqual(Message.from_bytes(message.to_bytes()).payload,
+                         'abc' * 1000)
+        # the id belongs to fast_zlib
+        other = type('OtherCodec', (FastZlibCodec,), {'name': 'other'})
+        with self.assertRaises(ValueError):
+            get_codec(other())
+
+
+class MessageTestCase(TestCase):
+    def test_compact_frame(self):
+        message = Message('add',
+                          {'args': (1, 2), 'kwargs': {}},
+                          42,
+                          Flag.LONG_RUNNING)
+        parsed = Message.from_bytes(message.to_bytes())
+        self.assertEqual(parsed.com_id, 42)
+        self.assertEqual(parsed.action, 'add')
+        self.assertEqual(parsed.flags, Flag.LONG_RUNNING)
+        self.assertEqual(parsed.payload, {'args': (1, 2), 'kwargs': {}})
+
+        parsed = Message.from_bytes(Message('return', 'OK', 7).to_bytes())
+        self.assertEqual(parsed.action, 'return')
+        self.assertEqual(parsed.payload, 'OK')
+        self.assertIsNone(parsed.timeout)
+
+        parsed = Message.from_bytes(Message('add', None, 1,
+                                            timeout=2.5).to_bytes())
+        self.assertEqual(parsed.timeout, 2.5)
+        self.assertIsNone(parsed.priority)
+
+        parsed = Message.from_bytes(Message('add', None, 1,
+                                            priority=Priority.LOW).to_bytes())
+        self.assertEqual(parsed.priority, Priority.LOW)
+
+    def test_exception_payload(self):
+        message = Message('return', KeyError('missing'), 1)
+        self.assertTrue(message.flags & Flag.ERROR)
+        with self.assertRaises(KeyError):
+            Message.from_bytes(message.to_bytes()).payload
+
+    def test_trace(self):
+        message = Message('add', None, 1)
+        message.stamp('call')
+        self.assertFalse(message.traced)
+        self.assertIsNone(message.trace)
+
+        message = Message('add', None, 1, Flag.TRACED)
+        message.stamp('call')
+        message.to_bytes()
+        message.stamp('send')
+        for parsed in (Message.from_bytes(message.to_bytes()),
+                       pickle.loads(pickle.dumps(message))):
+            self.assertTrue(parsed.traced)
+            self.assertEqual([hop for hop, _ in parsed.trace],
+                             ['call', 'send'])
+            self.assertEqual(parsed.trace, message.trace)
+            self.assertIsNone(parsed.payload)
+
+        reply = Message('return', 3, 1, trace=message.trace)
+        self.assertTrue(reply.flags & Flag.TRACED)
+        self.assertEqual(Message.from_bytes(reply.to_bytes()).payload, 3)
+
+
+def provide_add(remote, stopped):
+    # runs in a process of its own
+    client = Client(remote).start()
+    client.register_function('add', add)
+    stopped.wait(10)
+    client.stop()
+    client.close()
+
+
+def slow_echo(value):
+    time.sleep(0.2)
+    return value
+
+
+def crash():
+    os._exit(1)
+
+
+def provide_crash(remote):
+    # dies on the first call
+    client = Client(remote).start()
+    client.register_function('who', crash)
+    time.sleep(10)
+    client.stop()
+
+
+class TransportTestCase(TestCase):
+    def setUp(self):
+        self.broker = Broker('broker').start()
+        self.brokers = [self.broker]
+
+    def tearDown(self):
+        for broker in self.brokers:
+            broker.stop()
+
+    def test_unix_socket(self):
+        remote = RemoteBroker(self.broker.listen())
+        ca = Client(remote, 'tus_ca').start()
+        cb = Client(self.broker, 'tus_cb').start()
+        ca.register_function('add', add)
+        self.assertEqual(cb.add(1, 2), 3)
+        self.assertEqual(self.broker.stats()['clients'], 2)
+        ca.stop()
+        ca.close()
+        time.sleep(0.2)
+        self.assertEqual(self.broker.stats()['clients'], 1)
+        with self.assertRaises(AttributeError):
+            cb.add(1, 2)
+        cb.stop()
+
+    def test_tcp(self):
+        address = self.broker.listen(('127.0.0.1', 0), b'secret')
+        ca = Client(RemoteBroker(address, b'secret'), 'ttcp_ca').start()
+        cb = Client(self.broker, 'ttcp_cb').start()
+        cb.register_function('sub', sub)
+        self.assertEqual(ca.sub(3, 2), 1)
+        ca.stop()
+        cb.stop()
+        with self.assertRaises(multiprocessing.AuthenticationError):
+            Client(RemoteBroker(address, b'wrong'))
+        with self.assertRaises(ValueError):
+            self.broker.listen(('127.0.0.1', 0))
+
+    def test_broker_lost(self):
+        remote = RemoteBroker(self.broker.listen())
+        ca = Client(self.broker, 'tbl_ca').start()
+        cb = Client(remote, 'tbl_cb').start()
+        ca.register_function('sleep', time.sleep, executor='thread')
+        future = cb.call_async('sleep', 1)
+        self.brokers.remove(self.broker)
+        Timer(0.1, self.broker.stop).start()
+        # no timeout, the lost connection ends the call
+        with self.assertRaises(ConnectionError):
+            cb.sleep(1)
+        with self.assertRaises(ConnectionError):
+            future.result(5)
+        with self.assertRaises(ConnectionError):
+            cb.call_async('sleep', 0)
+        ca.stop()
+        cb.stop()
+
+    def test_silent_client(self):
+        address = self.broker.listen(('127.0.0.1', 0), b'secret')
+        # connects and never answers the challenge
+        silent = socket.create_connection(address)
+        ca = Client(RemoteBroker(address, b'secret'), 'tsc_ca').start()
+        cb = Client(self.broker, 'tsc_cb').start()
+        cb.register_function('add', add)
+        self.assertEqual(ca.add(1, 2), 3)
+        silent.close()
+        ca.stop()
+        cb.stop()
+
+    def test_compression(self):
+        address = self.broker.listen()
+        connection = RemoteBroker(address).register_client(
+            compression='lzma')
+        self.assertEqual(connection.compression.name, 'lzma')
+        connection.close()
+        ca = Client(RemoteBroker(address), 'tcn_ca').start()
+        cb = Client(self.broker, 'tcn_cb').start()
+        ca.register_function('echo', echo)
+        self.assertIsNone(
+            self.broker.stats()['connections'][ca.client_id].get(
+                'compression'))
+        self.assertEqual(cb.echo('x' * 5000), 'x' * 5000)
+        ca.stop()
+        cb.stop()
+
+    def test_process(self):
+        # the process is started after the broker and connects itself
+        remote = RemoteBroker(self.broker.listen())
+        context = multiprocessing.get_context('spawn')
+        stopped = context.Event()
+        process = context.Process(target=provide_add,
+                                  args=(remote, stopped))
+        process.start()
+        ca = Client(self.broker, 'tpr_ca').start()
+        deadline = time.monotonic() + 10
+        while not self.broker.n_functions:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        self.assertEqual(ca.add(1, 2), 3)
+        stopped.set()
+        process.join(10)
+        ca.stop()
+
+    def test_crash(self):
+        broker = Broker('broker', failover=True).start()
+        self.brokers.append(broker)
+        remote = RemoteBroker(broker.listen())
+        context = multiprocessing.get_context('spawn')
+        process = context.Process(target=provide_crash, args=(remote,))
+        process.start()
+        ca = Client(broker, 'tcr_ca').start()
+        cb = Client(broker, 'tcr_cb').start()
+        deadline = time.monotonic() + 10
+        while not broker.n_functions:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        cb.register_function('who', lambda: 'b')
+        # round robin sends one of the calls to the process
+        futures = [ca.call_async('who') for _ in range(2)]
+        self.assertEqual([future.result(5) for future in futures],
+                         ['b', 'b'])
+        process.join(10)
+        stats = broker.stats()
+        self.assertEqual(stats['functions']['who']['failovers'], 1)
+        self.assertEqual(stats['clients'], 2)
+        ca.stop()
+        cb.stop()
+
+    def test_federation(self):
+        other = Broker('other', compact=True).start()
+        self.brokers.append(other)
+        self.broker.connect_broker(other.listen())
+        ca = Client(self.broker, 'tfe_ca').start()
+        cb = Client(other, 'tfe_cb').start()
+        ca.register_function('add', add)
+        cb.register_function('sub', sub)
+        time.sleep(0.1)
+        self.assertEqual(cb.add(1, 2), 3)
+        self.assertEqual(ca.sub(3, 2), 1)
+        self.assertEqual(self.broker.stats()['brokers'], 1)
+        self.assertEqual(other.stats()['brokers'], 1)
+
+        # the function is withdrawn with its last provider
+        ca.stop()
+        ca.close()
+        time.sleep(0.2)
+        with self.assertRaises(AttributeError):
+            cb.add(1, 2)
+        self.assertEqual(other.n_open_messages, 0)
+        cb.stop()
+
+
+# a client with a process pool in an interpreter of its own
+PROCESS_EXECUTOR_SCRIPT = '''
+import operator
+import ipcbroker
+broker = ipcbroker.Broker().start()
+ca = ipcbroker.Client(broker).start()
+cb = ipcbroker.Client(broker).start()
+ca.register_function('add', operator.add, executor='process')
+assert cb.add(1, 2) == 3
+ca.stop()
+cb.stop()
+broker.stop()
+'''
+
+
+class ExecutorPoolTestCase(TestCase):
+    def test_process_exit(self):
+        # the worker processes must not keep the interpreter alive
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run([sys.executable,
+                                 '-c',
+                                 PROCESS_EXECUTOR_SCRIPT],
+                                cwd=root,
+                                timeout=30)
+        self.assertEqual(result.returncode, 0)
+
+
+class WorkerPoolTestCase(TestCase):
+    def setUp(self):
+        # queued requests wait in the broker until a worker is free
+        self.broker = Broker('broker', max_outstanding=1).start()
+
+    def tearDown(self):
+        self.broker.stop()
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 10
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+    def test_scale(self):
+        pool = self.broker.spawn_pool('slow_echo',
+                                      slow_echo,
+                                      max_workers=3,
+                                      idle_timeout=0.5)
+        ca = Client(self.broker, 'tws_ca').start()
+        self.wait_for(lambda: self.broker.n_functions)
+        self.assertEqual(pool.n_workers, 1)
+        futures = [ca.call_async('slow_echo', value) for value in range(12)]
+        self.wait_for(lambda: pool.n_workers == 3)
+        self.assertEqual([future.result(10) for future in futures],
+                         list(range(12)))
+
+        # idle workers are retired after they answered their requests
+        self.wait_for(lambda: pool.n_workers == 1)
+        stats = self.broker.stats()['pools']['slow_echo']
+        self.assertEqual(stats['spawned'], 3)
+        self.assertEqual(stats['retired'], 2)
+        self.assertEqual(ca.slow_echo(1), 1)
+        self.wait_for(lambda: self.broker.n_clients == 2)
+        ca.stop()
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            self.broker.spawn_pool('echo', echo, min_workers=0)
+        self.broker.spawn_pool('echo', echo)
+        with self.assertRaises(KeyError):
+            self.broker.spawn_pool('echo', echo)
+
+
+class AsyncClientTestCase(TestCase):
+    def setUp(self):
+        self.broker = Broker('broker').start()
+
+    def tearDown(self):
+        self.broker.stop()
+
+    def test_call(self):
+        cb = Client(self.broker, 'tac_cb').start()
+        cb.register_function('add', add)
+
+        async def main():
+            ca = AsyncClient(self.broker).start()
+            self.assertEqual(await ca.add(1, 2), 3)
+            results = await asyncio.gather(*[ca.add(i, i)
+                                             for i in range(100)])
+            self.assertEqual(results, [i + i for i in range(100)])
+            with self.assertRaises(AttributeError):
+                await ca.call('missing')
+            ca.stop()
+
+        asyncio.run(main())
+        cb.stop()
+
+    def test_register_function(self):
+        cb = Client(self.broker, 'tarf_cb').start()
+
+        async def main():
+            ca = AsyncClient(self.broker).start()
+
+            async def slow_add(a, b):
+                await asyncio.sleep(0.1)
+                return a + b
+
+            self.assertTrue(await ca.register_function('slow_add', slow_add))
+            self.assertTrue(await ca.register_function('div', div))
+            with self.assertRaises(KeyError):
+                await ca.register_function('div', div)
+            self.assertEqual(await ca.slow_add(1, 2), 3)
+            loop = asyncio.get_running_loop()
+            # all calls run on the loop at the same time
+            start = time.monotonic()
+            results = await asyncio.gather(*[
+                loop.run_in_executor(None, cb.slow_add, i, 1)
+                for i in range(10)])
+            self.assertEqual(results, [i + 1 for i in range(10)])
+            self.assertLess(time.monotonic() - start, 0.9)
+            self.assertEqual(
+                await loop.run_in_executor(None, cb.call_many, 'slow_add',
+                                           [(1, 2), (3, 4)]),
+                [3, 7])
+            with self.assertRaises(ZeroDivisionError):
+                await loop.run_in_executor(None, cb.div, 1, 0)
+            ca.stop()
+
+        asyncio.run(main())
+        cb.stop()
+
+    def test_timeout(self):
+        cb = Client(self.broker, 'tat_cb').start()
+        cb.register_function('sleep', time.sleep, executor='thread')
+
+        async def main():
+            ca = AsyncClient(self.broker).start()
+            with self.assertRaises(TimeoutError):
+                await ca.call('sleep', 1, timeout=0.1)
+            task = asyncio.ensure_future(ca.sleep(1))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0.1)
+            self.assertEqual(self.broker.n_open_messages, 0)
+            ca.stop()
+            ca.close()
+
+        asyncio.run(main())
+        cb.stop()
+
+
+class BenchmarkTestCase(TestCase):
+    def test_run_case(self):
+        # large payloads from several callers used to deadlock the broker
+        result = run_case('thread', 2, 1 << 20, 5, warmup=1)
+        self.assertEqual(result['calls'], 10)
+        self.assertGreater(result['calls_per_second'], 0)
+        self.assertLessEqual(result['p50'], result['p99'])
+
+    def test_compare(self):
+        baseline = run(modes=('local',), sizes=(16, 1024), calls=10)
+        current = run(modes=('local',), sizes=(16,), calls=10)
+        cases = compare(baseline, current)
+        self.assertEqual([case for case, _, _ in cases], [('local', 1, 16)])
+
+
+class WakeupRace(Event):
+    """
+    Pending flag of a Threaded that receives a wakeup() while wait()
+    clears it
+    """
+    def __init__(self, threaded):
+        super().__init__()
+        self.threaded = threaded
+        self.raced = False
+
+    def clear(self):
+        super().clear()
+        if not self.raced:
+            self.raced = True
+            thread = Thread(target=self.threaded.wakeup)
+            thread.start()
+            thread.join(0.5)
+
+
+class ThreadedTestCase(TestCase):
+    def test_wakeup(self):
+        threaded = Threaded()
+        threaded._Threaded__threaded_wakeup_pending = WakeupRace(threaded)
+        threaded.wakeup()
+        threaded.wait([], 1)
+        threaded.wait([], 1)
+        # the wakeup that raced with the first wait() was not lost
+        Timer(0.1, threaded.wakeup).start()
+        start = time.monotonic()
+        threaded.wait([], 5)
+        self.assertLess(time.monotonic() - start, 2)
+
+
+class BlockedConnection:
+    def __init__(self):
+        self.sent = list()
+        self.unblocked = Event()
+
+    def send(self, message):
+        self.unblocked.wait(5)
+        self.sent.append(message)
+
+
+class SenderTestCase(TestCase):
+    def test_max_queued(self):
+        sender = Sender(max_queued=2)
+        blocked = BlockedConnection()
+        other = BlockedConnection()
+        other.unblocked.set()
+        messages = [Message('echo', value, value) for value in range(3)]
+        self.assertTrue(sender.send(blocked, messages[0]))
+        self.assertTrue(sender.send(blocked, messages[1]))
+        self.assertFalse(sender.send(blocked, messages[2]))
+        self.assertTrue(sender.send(other, messages[2]))
+        blocked.unblocked.set()
+        sender.stop()
+        self.assertEqual(blocked.sent, messages[:2])
+        self.assertEqual(other.sent, messages[2:])
+
+
+class HistogramTestCase(TestCase):
+    def test_percentiles(self):
+        histogram = Histogram()
+        self.assertIsNone(histogram.percentile(50))
+        for _ in range(98):
+            histogram.record(0.001)
+        histogram.record(0.5)
+        histogram.record(1.0)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 100)
+        self.assertEqual(snapshot['max'], 1.0)
+        self.assertLess(snapshot['p50'], 0.002)
+        self.assertGreaterEqual(snapshot['p50'], 0.001)
+        self.assertGreaterEqual(snapshot['p99'], 0.5)
+        self.assertEqual(sum(count for _, count in snapshot['buckets']), 100)
+
+
+class LaneQueueTestCase(TestCase):
+    def test_weights(self):
+        queue = LaneQueue((4, 2, 1))
+        for value in range(70):
+            queue.append(('low', value), Priority.LOW)
+            queue.append(('normal', value), Priority.NORMAL)
+            queue.append(('high', value), Priority.HIGH)
+        self.assertEqual(queue.lengths(), [70, 70, 70])
+        lanes = [queue.popleft()[0] for _ in range(70)]
+        # shares of the weights, the low lane does not starve
+        self.assertEqual(lanes.count('high'), 40)
+        self.assertEqual(lanes.count('normal'), 20)
+        self.assertEqual(lanes.count('low'), 10)
+        self.assertEqual(len(queue), 140)
+
+    def test_order(self):
+        queue = LaneQueue()
+        queue.append(1, Priority.LOW)
+        queue.append(2, Priority.LOW)
+        queue.append(3)
+        self.assertEqual(queue.victim(), (1, Priority.LOW))
+        self.assertEqual(queue.peek(), 3)
+        self.assertEqual(queue.popleft(), 3)
+        queue.remove(2, Priority.LOW)
+        self.assertEqual(list(queue), [1])
+        self.assertEqual(queue.popleft(), 1)
+        with self.assertRaises(IndexError):
+            queue.popleft()
+        with self.assertRaises(ValueError):
+            LaneQueue((1, 0, 1))
+
+
+class ResultCacheTestCase(TestCase):
+    def test_ttl(self):
+        cache = ResultCache(ttl=0.1)
+        key = cache.key(b'args')
+        cache.put(key, b'result')
+        self.assertEqual(cache.get(key), b'result')
+        time.sleep(0.2)
+        self.assertIsNone(cache.get(key))
+
+    def test_lru(self):
+        cache = ResultCache(max_entries=2)
+        keys = [cache.key(bytes([i])) for i in range(3)]
+        cache.put(keys[0], b'0')
+        cache.put(keys[1], b'1')
+        cache.get(keys[0])
+        cache.put(keys[2], b'2')
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertEqual(cache.get(keys[0]), b'0')
+        self.assertEqual(cache.stats(),
+                         {'hits': 2, 'misses': 1, 'entries': 2})
+
+    def test_options(self):
+        with self.assertRaises(TypeError):
+            ResultCache(ttl='x')
+        with self.assertRaises(ValueError):
+            ResultCache(ttl=0)
+        with self.assertRaises(TypeError):
+            ResultCache(max_entries=None)
+        with self.assertRaises(ValueError):
+            ResultCache(max_entries=0)